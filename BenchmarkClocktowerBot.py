@@ -0,0 +1,239 @@
+import argparse
+import gc
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+from typing import Dict, List
+
+sys.path.append('../ClocktowerBot')
+
+import discord
+
+from ClocktowerBot import CharacterRecord, CharacterSearch, CharacterData, GameState, ChannelLocks, createBot
+from LoadTestClocktowerBot import SimulatedGuild, SimulatedRest, percentile
+
+"""
+Standalone benchmarks for the bot's hot paths, run with: python BenchmarkClocktowerBot.py
+Times are wall clock per call, so run them on an otherwise idle machine
+The first run writes benchmark_baseline.json, later runs fail when a hot path is slower than its baseline by more than --threshold
+Run with --save to accept the current times as the new baseline, e.g. after an intended change or on a different machine
+"""
+
+CHARACTER_TYPES = ["Townsfolk","Outsider","Minion","Demon","Traveller","Fabled"]
+GUILD_SIZES = [10,1000,100000] #Members of the synthetic guilds
+SCRIPT_SIZES = [20,200,2000] #Characters of the synthetic scripts
+PLAYER_COUNT = 20 #Players of a full game
+BASELINE_PATH = "benchmark_baseline.json"
+
+def makeWord(rng: random.Random) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for i in range(rng.randint(3,9)))
+
+def makeRecords(count: int,seed: int = 0) -> List[CharacterRecord]: #Synthetic characters, roughly the shape of the real ones
+    rng = random.Random(seed)
+    records = []
+    names = set()
+    while len(records) < count:
+        name = " ".join(makeWord(rng).capitalize() for i in range(rng.randint(1,2)))
+        if name in names:
+            continue
+        names.add(name)
+        summary = " ".join(makeWord(rng) for i in range(rng.randint(8,25))) + "."
+        records.append(CharacterRecord(name,f"Edition {len(records) // 25}",summary,rng.choice(CHARACTER_TYPES),"https://example.com",None))
+    return records
+
+def makeQueries(records: List[CharacterRecord],count: int,seed: int = 1) -> List[str]: #Mix of what users type: name prefixes, typos, types and junk
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        name = rng.choice(records).name.lower()
+        kind = i % 4
+        if kind == 0: #Prefix as typed letter by letter
+            queries.append(name[:rng.randint(1,len(name))])
+        elif kind == 1: #Typo, one letter dropped
+            drop = rng.randrange(len(name))
+            queries.append(name[:drop] + name[drop+1:])
+        elif kind == 2:
+            queries.append(rng.choice(CHARACTER_TYPES).lower()[:rng.randint(2,6)])
+        else:
+            queries.append(makeWord(rng))
+    return queries
+
+def benchmarkAutocomplete(characterCount: int,queryCount: int = 2000) -> dict: #Latency of one autocomplete request against a script of characterCount characters
+    records = makeRecords(characterCount)
+    start = time.perf_counter()
+    search = CharacterSearch(records)
+    buildTime = time.perf_counter() - start
+    samples = []
+    for query in makeQueries(records,queryCount):
+        start = time.perf_counter()
+        search.getChoices(query)
+        samples.append(time.perf_counter() - start)
+    return {
+        "characters": characterCount,
+        "build_ms": buildTime * 1000,
+        "p50_ms": percentile(samples,50) * 1000,
+        "p99_ms": percentile(samples,99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+def timeCall(function,repeats: int = 7,target: float = 0.01) -> float: #Fastest seconds per call of several repeats, each making enough calls to take about target seconds
+    def run(number: int) -> float:
+        start = time.perf_counter()
+        for i in range(number):
+            function()
+        return time.perf_counter() - start
+    enabled = gc.isenabled()
+    gc.disable() #Like timeit, a collection landing in one repeat is not the code's cost
+    try:
+        number = 1
+        while run(number) < target and number < (1 << 20): #Calibrate, and warm up
+            number *= 2
+        return min(run(number) / number for repeat in range(repeats)) #Noise only ever adds time
+    finally:
+        if enabled:
+            gc.enable()
+
+def makeGame(memberCount: int) -> tuple: #A guild of memberCount members with a full game set up in it
+    guild = SimulatedGuild(SimulatedRest(),memberCount)
+    members = guild.members
+    gameState = GameState()
+    gameState.setStoryTeller(members[0])
+    for member in members[1:PLAYER_COUNT + 1]:
+        gameState.addPlayer(member)
+    return guild, gameState
+
+def benchmarkGameState(memberCount: int) -> Dict[str,float]:
+    guild, gameState = makeGame(memberCount)
+    members = guild.members
+    player, outsider = members[1], members[-1]
+    crowd = members[:PLAYER_COUNT * 2] #What a busy voice channel holds, half of them players
+    return {
+        f"GameState.isMemberPlayer[{memberCount}]": timeCall(lambda: (gameState.isMemberPlayer(player),gameState.isMemberPlayer(outsider))),
+        f"GameState.filterPlayers[{memberCount}]": timeCall(lambda: gameState.filterPlayers(crowd)),
+        f"GameState.getPlayersAsMembers[{memberCount}]": timeCall(lambda: gameState.getPlayersAsMembers(guild)),
+        f"GameState.getAllUsers[{memberCount}]": timeCall(lambda: gameState.getAllUsers(guild)),
+    }
+
+def benchmarkChannelLocks(memberCount: int) -> Dict[str,float]:
+    guild, gameState = makeGame(memberCount)
+    room = guild.lobby
+    players = gameState.getPlayersAsMembers(guild)
+    locks = ChannelLocks({room: False},{room: []})
+    locks.addMembersToRoom(room,players[:-1]) #A full room, one player joins and leaves
+    def lockCycle():
+        locks.lockRoom(room)
+        locks.isRoomLocked(room)
+        locks.unlockRoom(room)
+    return {
+        f"ChannelLocks.addRemoveMember[{memberCount}]": timeCall(lambda: (locks.addMembersToRoom(room,players[-1:]),locks.removeMembersToRoom(room,players[-1:]))),
+        f"ChannelLocks.lockCycle[{memberCount}]": timeCall(lockCycle),
+    }
+
+def benchmarkCharacterData(characterCount: int) -> Dict[str,float]:
+    records = makeRecords(characterCount)
+    characterData = CharacterData(items=records)
+    name = records[len(records) // 2].name
+    return {
+        f"CharacterData.getEmbedOfCharacter[{characterCount}]": timeCall(lambda: characterData.getEmbedOfCharacter(name)),
+        f"CharacterData.getEmbedOfCharacter.typed[{characterCount}]": timeCall(lambda: characterData.getEmbedOfCharacter(name.upper())), #Typed instead of picked
+        f"CharacterData.getChoices[{characterCount}]": timeCall(characterData.getChoices),
+        f"CharacterSearch.getChoices[{characterCount}]": timeCall(lambda: characterData.search.getChoices(name[:3].lower())),
+    }
+
+def makeMemberPayload(id: int) -> dict: #A member as the gateway sends it
+    return {"user": {"id": str(id),"username": f"member{id}","discriminator": "0","avatar": None,"global_name": None},"roles": [],"joined_at": "2024-01-01T00:00:00+00:00","deaf": False,"mute": False,"flags": 0}
+
+def benchmarkGatewayCache(memberCount: int,mode: str,voiceCount: int = 50) -> dict: #Time and memory to take in one large guild in a gateway mode of the bot
+    state = createBot(mode)._connection
+    guildId = 1
+    voiceIds = range(10,10 + voiceCount)
+    guildData = { #A large guild's GUILD_CREATE only has the members in voice
+        "id": str(guildId),"name": "Benchmark","roles": [{"id": str(guildId),"name": "@everyone","permissions": "0","position": 0,"color": 0,"hoist": False,"managed": False,"mentionable": False}],
+        "channels": [{"id": "2","type": 2,"name": "Lobby","position": 0,"permission_overwrites": [],"bitrate": 64000,"user_limit": 0}],
+        "members": [makeMemberPayload(id) for id in voiceIds],
+        "voice_states": [{"user_id": str(id),"channel_id": "2","session_id": "s","deaf": False,"mute": False,"self_deaf": False,"self_mute": False,"suppress": False} for id in voiceIds],
+        "presences": [],"member_count": memberCount,"large": True,
+    }
+    chunks = []
+    if state._chunk_guilds: #Full mode asks for every member, with presences, in chunks of 1000
+        for start in range(10,10 + memberCount,1000):
+            ids = range(start,min(start + 1000,10 + memberCount))
+            chunks.append({"guild_id": str(guildId),"members": [makeMemberPayload(id) for id in ids],"presences": [{"user": {"id": str(id)},"status": "online","activities": [],"client_status": {"desktop": "online"}} for id in ids[::3]]})
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    guild = state._add_guild_from_data(guildData)
+    for chunk in chunks:
+        state.parse_guild_members_chunk(chunk)
+        for member in chunk["members"]: #What a finished chunk request does with every member
+            guild._add_member(discord.Member(data=member,guild=guild,state=state))
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"mode": mode,"members": memberCount,"startup_ms": elapsed * 1000,"cache_mb": memory / 2**20,"cached": len(guild.members),"intents": state._intents.value}
+
+def runSuite() -> Dict[str,float]: #Seconds per call of every hot path
+    results = {}
+    for count in GUILD_SIZES:
+        results.update(benchmarkGameState(count))
+        results.update(benchmarkChannelLocks(count))
+    for count in SCRIPT_SIZES:
+        results.update(benchmarkCharacterData(count))
+    return results
+
+def getRegressions(results: Dict[str,float],baseline: Dict[str,float],threshold: float,floor: float = 1e-6) -> List[str]: #Names of results slower than baseline by more than threshold, ignoring differences under floor seconds
+    regressions = []
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before != None and seconds > before * (1 + threshold) and seconds - before > floor:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the bot's hot paths and compares them to a baseline")
+    parser.add_argument("--baseline",default=BASELINE_PATH)
+    parser.add_argument("--save",action="store_true",help="Write the results as the new baseline")
+    parser.add_argument("--threshold",type=float,default=0.5,help="Allowed slowdown, 0.5 fails a path taking 1.5 times its baseline")
+    args = parser.parse_args()
+
+    print("Autocomplete latency (Discord allows 3000ms for the whole interaction)")
+    for count in [25,250,2500,10000]:
+        result = benchmarkAutocomplete(count)
+        print(f"{result['characters']:>6} characters: build {result['build_ms']:8.2f}ms  p50 {result['p50_ms']:.3f}ms  p99 {result['p99_ms']:.3f}ms  max {result['max_ms']:.3f}ms")
+
+    print("\nGateway cache of one large guild (CTB_GATEWAY)")
+    for count in [1000,10000,100000]:
+        for mode in ["full","slim"]:
+            result = benchmarkGatewayCache(count,mode)
+            print(f"{result['members']:>6} members {result['mode']:<4}: startup {result['startup_ms']:9.1f}ms  cache {result['cache_mb']:8.2f}MB  {result['cached']:>6} members cached  intents {result['intents']}")
+
+    results = runSuite()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    print(f"\n{'hot path':<52}{'us/call':>10}{'baseline':>10}")
+    for name, seconds in results.items():
+        before = f"{baseline[name] * 1e6:10.2f}" if name in baseline else f"{'-':>10}"
+        print(f"{name:<52}{seconds * 1e6:10.2f}{before}")
+
+    if args.save or len(baseline) == 0:
+        with open(args.baseline,"w") as file:
+            json.dump({"python": sys.version.split()[0],"results": results},file,indent=2)
+        print(f"Wrote baseline to {args.baseline}")
+    else:
+        regressions = getRegressions(results,baseline,args.threshold)
+        if len(regressions) > 0: #Time again before failing, a slow path has to be slow twice
+            print(f"Timing again: {len(regressions)} paths over the threshold")
+            rerun = runSuite()
+            results = {name: min(seconds,rerun[name]) for name, seconds in results.items()}
+            regressions = getRegressions(results,baseline,args.threshold)
+        for name in regressions:
+            print(f"Regressed: {name} {results[name] * 1e6:.2f}us, baseline {baseline[name] * 1e6:.2f}us")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions")
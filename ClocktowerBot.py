@@ -1,15 +1,47 @@
 import os
 import discord
-from enum import Enum
+from enum import Enum, IntEnum
 from discord.ext import commands   # Import the discord.py extension "commands"
 from discord import Embed, Interaction, app_commands
 from discord.utils import get
 from dotenv import load_dotenv
 from typing import List
+from typing import Dict, Tuple
 from typing import TypedDict
 import asyncio
 import logging
 import xml.etree.ElementTree as ET
+import bisect
+import heapq
+import itertools
+import collections
+import json
+import pickle
+import hashlib
+import time
+import contextvars
+import functools
+import queue
+import logging.handlers
+from datetime import datetime, timezone
+from aiohttp import web
+try: #Optional, commands are only traced if OpenTelemetry is installed
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+STARTED_AT = time.perf_counter() #When the bot started, for the startup time reported once it is ready
+
+#Loggers of each part of the bot, their levels are set separately with CTB_LOG_LEVELS
+log = logging.getLogger("ctb") #Startup, shutdown and anything not below
+characterLog = logging.getLogger("ctb.characters") #Loading characters and scripts
+commandLog = logging.getLogger("ctb.commands")
+transitionLog = logging.getLogger("ctb.transitions") #Moving players and changing roles between phases
+roomLog = logging.getLogger("ctb.rooms") #Locking and opening public rooms
+voiceLog = logging.getLogger("ctb.voice") #Voice state updates, one per member moving so they are debug only
+journalLog = logging.getLogger("ctb.journal")
+
+currentSession = contextvars.ContextVar("currentSession",default=None) #Guild id of the session the running task works for, added to log records
 
 #Dictionary types
 RoomLock = TypedDict('Roomlock', {'channel': discord.VoiceChannel, 'locked': bool})
@@ -51,9 +83,63 @@ class VotingType(Enum): #Voting styles that may be used when a player nominates
     pointCountdown = 3 #Players vote on a player publicly, after a countdown votes are tallied.
     #Used specifically for the Boomdandies ability, who requires players pick a specific player to kill.
 
+#Permission overwrites of each kind of game channel, keyed by the bot role they apply to, EVERYONE or OWNER
+#Resolved against a guild with GameCommands.getOverwrites and applied with one edit per channel, only when the channel differs
+EVERYONE = "everyone" #The guild's @everyone role
+OWNER = "owner" #The player a private room belongs to
+OVERWRITE_TEMPLATES = {
+    "storytellerText": {
+        EVERYONE: discord.PermissionOverwrite(read_messages=False),
+        Role.storyTeller: discord.PermissionOverwrite(read_messages=True),
+    },
+    "storytellerVoice": {
+        EVERYONE: discord.PermissionOverwrite(read_messages=False),
+        Role.storyTeller: discord.PermissionOverwrite(read_messages=True),
+    },
+    "townText": {
+        EVERYONE: discord.PermissionOverwrite(read_messages=True,send_messages=False),
+        Role.day: discord.PermissionOverwrite(send_messages=True),
+        Role.storyTeller: discord.PermissionOverwrite(send_messages=True),
+    },
+    "townVoice": {
+        EVERYONE: discord.PermissionOverwrite(read_messages=False),
+        Role.day: discord.PermissionOverwrite(read_messages=True),
+        Role.storyTeller: discord.PermissionOverwrite(read_messages=True),
+    },
+    "publicRooms": {
+        EVERYONE: discord.PermissionOverwrite(read_messages=False,connect=False),
+        Role.roam: discord.PermissionOverwrite(read_messages=True,connect=True),
+        Role.storyTeller: discord.PermissionOverwrite(read_messages=True,connect=True),
+    },
+    "privateRooms": {
+        EVERYONE: discord.PermissionOverwrite(read_messages=False),
+        OWNER: discord.PermissionOverwrite(read_messages=True),
+        Role.storyTeller: discord.PermissionOverwrite(read_messages=True),
+    },
+    "roleGatedPrivateRooms": { #Never changed once set up: the owner can always see their room, only with the Night role can they join it
+        EVERYONE: discord.PermissionOverwrite(read_messages=False,connect=False),
+        OWNER: discord.PermissionOverwrite(read_messages=True), #A member overwrite beats every role, so it must not set connect
+        Role.night: discord.PermissionOverwrite(connect=True), #Other players' rooms stay hidden, and a hidden room cannot be joined
+        Role.storyTeller: discord.PermissionOverwrite(read_messages=True,connect=True),
+    },
+}
+STATE_OVERWRITES = { #Changes to a template while a channel is in a state, (kind, state) -> overwrites replacing the template's
+    ("privateRooms","day"): {OWNER: discord.PermissionOverwrite(read_messages=False)}, #Players are kept out of their rooms from dawn to dusk
+    ("publicRooms","locked"): {Role.roam: discord.PermissionOverwrite(read_messages=True,connect=False)}, #Roaming players see a locked room but cannot join it
+}
+
+class MissingMember(discord.Object): #Stands in for a recovered player or storyteller who is not in the member cache, until refreshRoster finds them or for good if they left
+    def __init__(self,id: int):
+        super().__init__(id=id)
+        self.name = f"Unknown member {id}" #Shown in votes and announcements like a member's name
+        self.display_name = self.name
+        self.mention = f"<@{id}>"
+        self.voice = None #Cannot be moved
+        #No roles attribute, so the member cache and role edits never see a MissingMember
+
 class Player: #Class that holds the data on a player
     def __init__(self,member: discord.member):
-        self.member: discord.Member = member
+        self.member: discord.Member | MissingMember = member
         self.isAlive = True #If the game registers them as alive
         self.hasGhostVote = True #If the game registers the player as having their ghost vote
 
@@ -83,15 +169,19 @@ class GameState: #Class the holds the users set for the game
     def __init__(self):
         self.storyteller = None #Meber who is the storyteller
         self.players: List[Player] = [] #List of players in the game
+        self.playerIndex: Dict[int,Player] = {} #Dict (member id -> player), kept in step with self.players for O(1) lookups
+        self.memberCache: Dict[int,discord.Member] = {} #Dict (member id -> member), most recent resolved member of each player
         self.active = False #Whever the game is running or not
         self.channelReady = False #Whever the correct discord channels are in place
         self.channels = GameChannels() #Store game channels here
         self.channelLocks = ChannelLocks() #Stores player rights to talk in public rooms
-        self.playerChannelDict = {} #Dictionary to stores which players have which private room
+        self.playerChannelDict: Dict[int,discord.VoiceChannel] = {} #Dict (player id -> private room), by id so it outlives the member objects
         self.lockCooldown = 8 #How much time (in secs) it takes for a newly joined public room to lock
         self.openCooldown = 12 # How much time (in secs) a public room is open when a user runs the /open_door command
         self.votingCircledownDelay = 3 # How much delay (in secs) the circle vote has between each players vote being counted
         self.votingCountdownDelay = 10 # How much time (in secs) a countdown vote has until it ends
+        self.transitionConcurrency = 5 # How many discord calls a phase transition may have in flight at once
+        self.roleGatedRooms = ROOM_ACCESS == "roles" #Private room access follows the Night role instead of being toggled per player each night and dawn, fixed by /setup_channels
         self.gameDay = 1 #Determines which day the game is set,
         """
         dayphase : Current phase of the day, each "day" begins at night, game sarts at the first night followed by the first day
@@ -111,12 +201,14 @@ class GameState: #Class the holds the users set for the game
     def initStartGame(self):
         self.active = True
         self.gameDay = 1
-        self.gamePhase = 0
+        self.dayPhase = 0
         
     def endGame(self):
         self.active = False
         self.channelReady = False
         self.players = []
+        self.playerIndex = {}
+        self.memberCache = {}
         self.storyteller = None
         self.playerChannelDict = {}
 
@@ -124,27 +216,50 @@ class GameState: #Class the holds the users set for the game
         self.storyteller = member
 
     def isMemberPlayer(self,member:discord.Member) -> bool:
-        for player in self.players:
-            if player.member == member:
-                return True
-        return False
+        return member.id in self.playerIndex
+
+    def getPlayer(self,member: discord.Member) -> Player | None: #Returns the Player of a member, None if they are not playing
+        return self.playerIndex.get(member.id)
         
     def addPlayer(self,player: discord.Member):
-        if not (player in self.players):
-            self.players.append(Player(player))
+        if not (player.id in self.playerIndex):
+            newPlayer = Player(player)
+            self.players.append(newPlayer)
+            self.playerIndex[player.id] = newPlayer
+            if hasattr(player,"roles"): #A full member, keep it since a slim member cache only holds members in voice
+                self.memberCache[player.id] = player
 
     def removePlayer(self,player: discord.Member):
-        if player in self.players:
-            self.players.remove(Player(player))
+        oldPlayer = self.playerIndex.pop(player.id,None)
+        if oldPlayer != None:
+            self.players.remove(oldPlayer)
+            self.memberCache.pop(player.id,None)
+
+    def updateMember(self,member: discord.Member): #Called on member update events, replaces the cached member of a player
+        if member.id in self.playerIndex:
+            self.memberCache[member.id] = member
+
+    def replaceMember(self,member: discord.Member): #Swaps the stored member of a player or the storyteller for a fresh one, e.g. one recovered by id
+        player = self.playerIndex.get(member.id)
+        if player != None:
+            player.member = member
+            self.memberCache[member.id] = member
+        if self.storyteller != None and self.storyteller.id == member.id:
+            self.storyteller = member
+
+    def invalidateMember(self,member: discord.Member): #Forgets the cached member, it is resolved from the guild again on next use
+        self.memberCache.pop(member.id,None)
             
     def getPlayersAsMembers(self,guild: discord.Guild) -> List[discord.Member]: #Gets the most recent instance of the players in the game as a List{dsicord.Member}
         value = []
-        playerIds = []
         for player in self.players:
-            playerIds.append(player.member.id)
-        for member in guild.members:
-            if member.id in playerIds:
-                value.append(member)
+            member = self.memberCache.get(player.member.id)
+            if member == None: #Not cached yet or invalidated, resolve by id instead of scanning the guild
+                member = guild.get_member(player.member.id)
+                if member == None: #Player has left the guild
+                    continue
+                self.memberCache[member.id] = member
+            value.append(member)
         return value
     
     def getPlayers(self) -> List[Player]:
@@ -152,11 +267,11 @@ class GameState: #Class the holds the users set for the game
     
     def addPrivateRoom(self,player: discord.Member,room: discord.channel):
         if self.isMemberPlayer(player):
-            self.playerChannelDict[player] = room
+            self.playerChannelDict[player.id] = room
             
     def getRoomOfPlayer(self,player:discord.Member) -> discord.VoiceChannel:
         if self.isMemberPlayer(player):
-            return self.playerChannelDict[player]
+            return self.playerChannelDict[player.id]
         
     def incrementDayPhase(self):
         if self.dayPhase == 3: #if dusk
@@ -176,14 +291,28 @@ class GameState: #Class the holds the users set for the game
         
     def incrementDayCount(self):
         self.gameDay += 1
+
+    def getTime(self) -> Tuple[int,int]: #Returns the current (day, phase)
+        return (self.gameDay,self.dayPhase)
         
     def getAllUsers(self,guild: discord.Guild): #Returns all players and the storyteller as a List[discord.Member]
         value = self.getPlayersAsMembers(guild)
-        for member in guild.members:
-            if member.id == self.storyteller.id:
-                value.append(member)
+        storyteller = guild.get_member(self.storyteller.id)
+        if storyteller == None and hasattr(self.storyteller,"roles"): #Not in the member cache, e.g. not in voice
+            storyteller = self.storyteller
+        if storyteller != None:
+            value.append(storyteller)
         return value
+
+    def getRosterIds(self) -> List[int]: #Ids of the players and the storyteller
+        ids = [player.member.id for player in self.players]
+        if self.storyteller != None:
+            ids.append(self.storyteller.id)
+        return ids
     
+    def getDayPhaseName(self,dayPhase: int = None) -> str: #Short name of the current (or given) day phase, e.g. for metric labels
+        return ["night","dawn","midday","dusk"][self.dayPhase if dayPhase == None else dayPhase]
+
     def getGameTimeMsg(self) -> str: #Returns a string that summaries the current day phase
         if self.dayPhase == 0: #night
             if self.gameDay == 1: #First night
@@ -199,13 +328,69 @@ class GameState: #Class the holds the users set for the game
         else: #error state, should never be reached
             raise Exception(f"Expect dayPhase to be in range (0,3) got {self.dayPhase}")
         
+    def getDesiredRoles(self,player: Player) -> List[Role]: #Returns the bot roles a player should have for the current state of the game
+        roles = [Role.player]
+        roles.append(Role.alive if player.isAlive else Role.dead)
+        roles.append(Role.night if self.dayPhase == 0 else Role.day)
+        if self.dayPhase == 2: #Midday, players may visit public rooms
+            roles.append(Role.roam)
+        return roles
+
+    def getDesiredRoleMap(self) -> Dict[int,List[Role]]: #Dict (member id -> bot roles) of every player, taken when a change is queued so it applies the state it was queued for
+        return {player.member.id: self.getDesiredRoles(player) for player in self.players}
+
     def filterPlayers(self,members: List[discord.Member]) -> List[discord.Member]: #Given a list of members, returns which are players
         data = []
+        seen = set()
         for member in members:
-            if self.isMemberPlayer(member) and (not (member in data)):
+            if self.isMemberPlayer(member) and (not (member.id in seen)):
+                seen.add(member.id)
                 data.append(member)
         return data
 
+    def toSnapshot(self) -> dict: #Returns the state as plain data keyed by discord ids, what the game journal stores
+        return {
+            "storyteller": self.storyteller.id if self.storyteller != None else None,
+            "players": [{"id": player.member.id,"isAlive": player.isAlive,"hasGhostVote": player.hasGhostVote} for player in self.players],
+            "active": self.active,
+            "channelReady": self.channelReady,
+            "gameDay": self.gameDay,
+            "dayPhase": self.dayPhase,
+            "roleGatedRooms": self.roleGatedRooms,
+            "channels": self.channels.toSnapshot(),
+            "privateRooms": [[id,room.id] for id, room in self.playerChannelDict.items()], #Pairs of (player id, room id)
+            "lockedRooms": [room.id for room, locked in self.channelLocks.roomLock.items() if locked],
+        }
+
+    @staticmethod
+    def fromSnapshot(snapshot: dict,guild: discord.Guild) -> "GameState": #Rebuilds a state from a snapshot, reattaching to the guild's members and channels by id
+        def getMember(id: int):
+            member = guild.get_member(id)
+            return member if member != None else MissingMember(id) #Not cached or left the guild, keep the id so the roster is not changed
+        state = GameState()
+        if snapshot["storyteller"] != None:
+            state.setStoryTeller(getMember(snapshot["storyteller"]))
+        for data in snapshot["players"]:
+            member = getMember(data["id"])
+            state.addPlayer(member)
+            state.getPlayer(member).setIsAlive(data["isAlive"])
+            state.getPlayer(member).setHasGhostVote(data["hasGhostVote"])
+        state.active = snapshot["active"]
+        state.channelReady = snapshot["channelReady"]
+        state.setTime(snapshot["gameDay"],snapshot["dayPhase"])
+        state.roleGatedRooms = snapshot.get("roleGatedRooms",False) #Journals from before the mode existed used per player toggles
+        state.channels = GameChannels.fromSnapshot(snapshot["channels"],guild)
+        for memberId, roomId in snapshot["privateRooms"]:
+            player = state.playerIndex.get(memberId)
+            room = guild.get_channel(roomId)
+            if player != None and room != None:
+                state.addPrivateRoom(player.member,room)
+        state.channelLocks = ChannelLocks({room: False for room in state.channels.publicRooms},{room: [] for room in state.channels.publicRooms})
+        for room in state.channels.publicRooms:
+            if room.id in snapshot["lockedRooms"]:
+                state.channelLocks.lockRoom(room)
+        return state
+
         
 class GameChannels: #Holds the discord channels for use in the game
     def __init__(self):
@@ -228,6 +413,31 @@ class GameChannels: #Holds the discord channels for use in the game
     def getTownText(self) -> discord.TextChannel:
         return self.townText
 
+    def toSnapshot(self) -> dict: #Channel ids of the game, None for channels not set up
+        data = {}
+        for slot in ["category","storytellerText","storytellerVoice","townText","townVoice"]:
+            channel = getattr(self,slot)
+            data[slot] = channel.id if channel != None else None
+        data["publicRooms"] = [room.id for room in self.publicRooms]
+        data["privateRooms"] = [room.id for room in self.privateRooms]
+        return data
+
+    @staticmethod
+    def fromSnapshot(data: dict,guild: discord.Guild) -> "GameChannels": #Reattaches to existing channels by id, channels deleted since are dropped
+        channels = GameChannels()
+        for slot in ["category","storytellerText","storytellerVoice","townText","townVoice"]:
+            if data[slot] != None:
+                setattr(channels,slot,guild.get_channel(data[slot]))
+        for id in data["publicRooms"]:
+            room = guild.get_channel(id)
+            if room != None:
+                channels.addPublicRoom(room)
+        for id in data["privateRooms"]:
+            room = guild.get_channel(id)
+            if room != None:
+                channels.addPrivateRoom(room)
+        return channels
+
 """
 Public rooms in the bot are designed so that once users join a private room, it prevents other users joining later from listening in
 This is done so players can have private conservsations aka whisper to eachother, a vital part of the game
@@ -235,9 +445,16 @@ The class holds which channels are locked and which users are allowed to speak u
 "Locking" a room in this context refers to deafening non-whitelisted members
 """
 class ChannelLocks: #Holds the data on which discord channels auto deafen users when they join
-    def __init__(self, roomLock: RoomLock = dict(), roomMembers: RoomMembers = dict()):
-        self.roomLock = roomLock #Dict (channel -> bool) if a channel is in the lcoked state, new users are forced deafened
-        self.roomMembers = roomMembers #Dict (channel -> [members]) which users are allowed to speak in the channel
+    def __init__(self, roomLock: RoomLock = None, roomMembers: RoomMembers = None):
+        #Defaults are made per instance, a shared default dict would leak room state between sessions
+        self.roomLock = roomLock if roomLock != None else {} #Dict (channel -> bool) if a channel is in the lcoked state, new users are forced deafened
+        self.roomMembers = roomMembers if roomMembers != None else {} #Dict (channel -> [members]) which users are allowed to speak in the channel
+        self.roomMutex: Dict[int,asyncio.Lock] = {} #Dict (channel id -> lock), events in one room run in order while different rooms run in parallel
+
+    def getRoomMutex(self,room: discord.VoiceChannel) -> asyncio.Lock: #Returns the lock that orders the join, leave, open and lock events of a room
+        if not (room.id in self.roomMutex):
+            self.roomMutex[room.id] = TimedLock("room")
+        return self.roomMutex[room.id]
         
     def lockRoom(self,room: discord.VoiceChannel): #Lock a room
         if (room in self.roomLock) and (room in self.roomMembers):
@@ -269,74 +486,1795 @@ class ChannelLocks: #Holds the data on which discord channels auto deafen users
         if room in self.roomMembers:
             return self.roomMembers[room]
         
+class CharacterRecord: #Compact, pre-rendered data of one character
+    __slots__ = ('name','edition','summary','type','wiki','image','embed')
+
+    def __init__(self,name: str,edition: str,summary: str,type: str,wiki: str,image: str):
+        self.name = name
+        self.edition = edition #Edition the character comes from
+        self.summary = summary #Ability text
+        self.type = type #Townsfolk, Outsider, Minion, Demon etc
+        self.wiki = wiki #Wiki url, None if the character has no page
+        self.image = image #Thumbnail url, None if the character has no image
+        self.embed = self.renderEmbed() #Embed payload built once, lookups only copy it
+
+    def renderEmbed(self) -> dict: #Builds the character summary embed as a payload dict
+        embed = discord.embeds.Embed()
+        embed.colour = discord.Color.brand_red()
+        
+        embed.title = f"Character Summary"
+        embed.add_field(name="Character",value=self.name,inline=False)
+        embed.add_field(name="Ability",value=self.summary,inline=False)
+        embed.add_field(name="Type",value=self.type,inline=False)
+        if self.wiki != None: #Homebrew characters might not have a wiki page
+            embed.add_field(name="Wiki link",value=f"[Character info]({self.wiki})")
+        
+        if self.image != None:
+            embed.set_thumbnail(url=self.image)
+        return embed.to_dict()
+
+    def getEmbed(self) -> discord.Embed: #Returns a new embed that can be changed without touching the pre-rendered payload
+        data = dict(self.embed)
+        data['fields'] = [dict(field) for field in data['fields']] #Embed.from_dict keeps references to these, copy the mutable parts
+        if 'thumbnail' in data:
+            data['thumbnail'] = dict(data['thumbnail'])
+        return discord.Embed.from_dict(data)
+
+"""
+Search index over characters for slash command autocomplete, Discord only shows 25 suggestions and expects them within its interaction deadline
+Matches are ranked: name prefix, prefix of a word in the name, prefix of the character type, prefix of a word of its ability, then a fuzzy match of the name
+Prefix lookups are binary searches over sorted keys and fuzzy matching only scores names sharing a trigram with the query, so neither scans every character
+"""
+class CharacterSearch:
+    def __init__(self,records: List[CharacterRecord]):
+        self.records = records
+        self.exact: Dict[str,CharacterRecord] = {} #Dict (lowercase name -> record)
+        self.names: List[Tuple[str,int]] = [] #Sorted (lowercase name, record index)
+        self.nameWords: List[Tuple[str,int]] = [] #Sorted (word of a name, record index)
+        self.typeWords: List[Tuple[str,int]] = [] #Sorted (lowercase type, record index)
+        self.textWords: List[Tuple[str,int]] = [] #Sorted (word of an ability, record index)
+        self.trigrams: Dict[str,List[int]] = {} #Dict (trigram of a name -> record indexes)
+        for i, record in enumerate(records):
+            name = record.name.lower()
+            self.exact[name] = record
+            self.names.append((name,i))
+            for word in name.split():
+                self.nameWords.append((word,i))
+            self.typeWords.append(((record.type or "").lower(),i))
+            for word in set(self.splitWords((record.summary or "").lower())):
+                self.textWords.append((word,i))
+            for trigram in self.getTrigrams(name):
+                self.trigrams.setdefault(trigram,[]).append(i)
+        self.names.sort()
+        self.nameWords.sort()
+        self.typeWords.sort()
+        self.textWords.sort()
+
+    @staticmethod
+    def splitWords(text: str) -> List[str]: #Splits text into words, dropping punctuation
+        return "".join(char if char.isalnum() else " " for char in text).split()
+
+    @staticmethod
+    def getTrigrams(text: str) -> set:
+        padded = f"  {text} "
+        return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+    def getExact(self,name: str) -> CharacterRecord | None: #Case insensitive lookup of a full name
+        return self.exact.get(name.strip().lower())
+
+    def prefixMatches(self,keys: List[Tuple[str,int]],prefix: str): #Yields record indexes of every key starting with prefix
+        i = bisect.bisect_left(keys,(prefix,-1))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            yield keys[i][1]
+            i += 1
+
+    def fuzzyMatches(self,query: str): #Yields record indexes of names sharing enough trigrams with the query, best first
+        queryTrigrams = self.getTrigrams(query)
+        scores: Dict[int,int] = {}
+        for trigram in queryTrigrams:
+            for i in self.trigrams.get(trigram,[]):
+                scores[i] = scores.get(i,0) + 1
+        threshold = max(1,len(queryTrigrams) // 3)
+        ranked = sorted((i for i, score in scores.items() if score >= threshold),key=lambda i: (-scores[i],self.records[i].name))
+        yield from ranked
+
+    def search(self,query: str,limit: int = 25) -> List[CharacterRecord]:
+        query = query.strip().lower()
+        if query == "":
+            return [self.records[i] for name, i in self.names[:limit]]
+        found: List[int] = []
+        seen = set()
+        stages = [
+            self.prefixMatches(self.names,query),
+            self.prefixMatches(self.nameWords,query),
+            self.prefixMatches(self.typeWords,query),
+            self.prefixMatches(self.textWords,query),
+            self.fuzzyMatches(query),
+        ]
+        for stage in stages:
+            for i in stage:
+                if not (i in seen):
+                    seen.add(i)
+                    found.append(i)
+                    if len(found) >= limit:
+                        return [self.records[i] for i in found]
+        return [self.records[i] for i in found]
+
+    def getChoices(self,query: str,limit: int = 25) -> List[app_commands.Choice[str]]: #Autocomplete choices for a query
+        return [app_commands.Choice(name=record.name,value=record.name) for record in self.search(query,limit)]
+
+class CharacterReference: #A character a script lists by id only, resolved against characters loaded before it
+    __slots__ = ('id','edition')
+
+    def __init__(self,id: str,edition: str):
+        self.id = id
+        self.edition = edition #Script that references the character
+
 class CharacterData: #handles the reading of characters.xml and outputs character data
-    def __init__(self,path: str):
-        #XML parser
-        print(os.getcwd())
-        self.tree = ET.parse(path) #Holds character lists for all the editions
-        self.choices = self.getChoices()
+    def __init__(self,path: str = None,items: List[CharacterRecord | CharacterReference] = None):
+        self.records: List[CharacterRecord] = [] #Every character in file order
+        self.byName: Dict[str,CharacterRecord] = {} #Dict (character name -> record)
+        self.byId: Dict[str,CharacterRecord] = {} #Dict (script id -> record)
+        self.byEdition: Dict[str,List[CharacterRecord]] = {} #Dict (edition name -> records)
+        self.byType: Dict[str,List[CharacterRecord]] = {} #Dict (character type -> records)
+        if path != None:
+            #XML parser
+            items = self.readTree(ET.parse(path)) #The tree is only walked once here, then dropped
+        for item in items or []:
+            if isinstance(item,CharacterReference):
+                self.addReference(item)
+            else:
+                self.addRecord(item)
+        self.search = CharacterSearch(self.records) #Autocomplete index, Discord caps static choices at 25
+
+    @staticmethod
+    def getId(name: str) -> str: #Id used by community scripts, e.g. "Fortune Teller" -> "fortuneteller"
+        return "".join(char for char in name.lower() if char.isalnum())
+
+    @staticmethod
+    def readTree(tree: ET.ElementTree) -> List[CharacterRecord]: #Reads every character of every edition
+        records = []
+        for edition in tree.getroot().findall('edition'):
+            editionName = edition.attrib.get('name')
+            for character in edition.findall('character'):
+                image = character.findtext('image')
+                records.append(CharacterRecord(
+                    character.attrib['name'],
+                    editionName,
+                    character.findtext('summary'),
+                    character.findtext('type'),
+                    character.findtext('wiki'),
+                    None if image == "None" else image,
+                ))
+        return records
+
+    def addRecord(self,record: CharacterRecord):
+        if record.name in self.byName: #First edition to define a character wins, later editions only list it
+            self.addToEdition(self.byName[record.name],record.edition)
+            return
+        self.records.append(record)
+        self.byName[record.name] = record
+        self.byId[self.getId(record.name)] = record
+        self.byEdition.setdefault(record.edition,[]).append(record)
+        self.byType.setdefault(record.type,[]).append(record)
+
+    def addReference(self,reference: CharacterReference):
+        record = self.byId.get(self.getId(reference.id))
+        if record == None:
+            characterLog.warning("Script %s references unknown character: %s",reference.edition,reference.id)
+            return
+        self.addToEdition(record,reference.edition)
+
+    def addToEdition(self,record: CharacterRecord,edition: str):
+        characters = self.byEdition.setdefault(edition,[])
+        if not (record in characters):
+            characters.append(record)
         
     def getChoices(self) -> List[app_commands.Choice]: #Retuns the slash command choices
-        root = self.tree.getroot()
-        choices = []
-        for edition in root.findall('edition'):
-            for character in edition.findall('character'):
-                choices.append(app_commands.Choice(name=character.attrib['name'],value=character.attrib['name']))
-        return choices
+        return [app_commands.Choice(name=record.name,value=record.name) for record in self.records]
+
+    def getCharacter(self,characterName: str) -> CharacterRecord | None:
+        return self.byName.get(characterName)
+
+    def getCharactersOfEdition(self,edition: str) -> List[CharacterRecord]:
+        return self.byEdition.get(edition,[])
+
+    def getCharactersOfType(self,type: str) -> List[CharacterRecord]:
+        return self.byType.get(type,[])
     
     def getEmbedOfCharacter(self,characterName: str) -> discord.Embed | None: #Gets a given character's information as a discord embed
-        root = self.tree.getroot()
-        embed = None
-        for edition in root.findall('edition'):
-            for character in edition.findall('character'):
-                if character.attrib['name'] == characterName: #If this is our character
-                    embed = discord.embeds.Embed()
-                    embed.colour = discord.Color.brand_red()
-                    
-                    embed.title = f"Character Summary"
-                    embed.add_field(name="Character",value=characterName,inline=False)
-                    embed.add_field(name="Ability",value=character.find('summary').text,inline=False)
-                    embed.add_field(name="Type",value=character.find('type').text,inline=False)
-                    embed.add_field(name="Wiki link",value=f"[Character info]({character.find('wiki').text})")
-                    
-                    if character.find('image').text != "None":
-                        embed.set_thumbnail(url=character.find('image').text)
+        record = self.byName.get(characterName)
+        if record == None: #Users may type a name instead of picking a suggestion
+            record = self.search.getExact(characterName)
+        if record == None:
+            return None
+        return record.getEmbed()
+   
+"""
+Loads characters from the base characters.xml plus every edition file in a scripts directory
+Editions may be XML in the same format as characters.xml or JSON in the community script format, a list of character ids and homebrew characters
+Parsed files are kept per file and in a compiled cache on disk, so only changed files are parsed again and a cold start with an unchanged cache parses nothing
+"""
+class CharacterLoader:
+    cacheVersion = 1 #Bump when CharacterRecord changes, older caches are ignored
+    teamTypes = {
+        "townsfolk": "Townsfolk",
+        "outsider": "Outsider",
+        "minion": "Minion",
+        "demon": "Demon",
+        "traveler": "Traveller",
+        "traveller": "Traveller",
+        "fabled": "Fabled",
+    }
+
+    def __init__(self,basePath: str,scriptsDir: str = None,cachePath: str = None):
+        self.basePath = basePath #The official characters, always loaded first
+        self.scriptsDir = scriptsDir #Directory of extra edition files, None to only load the base file
+        self.cachePath = cachePath #Where the compiled cache is stored, None to not keep one
+        self.files: Dict[str,Tuple[Tuple[int,int],list]] = {} #Dict (path -> (stamp, parsed items)), only touched by one load at a time
+        self.stamps: Dict[str,Tuple[int,int]] = {} #Stamps of the files the current index was built from
+        self.loadCache()
+
+    def getPaths(self) -> List[str]: #Base file first, then edition files in name order so the result does not depend on the file system
+        paths = [self.basePath]
+        if self.scriptsDir != None and os.path.isdir(self.scriptsDir):
+            for name in sorted(os.listdir(self.scriptsDir)):
+                if name.lower().endswith((".xml",".json")):
+                    paths.append(os.path.join(self.scriptsDir,name))
+        return paths
+
+    def getStamps(self) -> Dict[str,Tuple[int,int]]: #Modified time and size of every file, a change in either means the file is parsed again
+        stamps = {}
+        for path in self.getPaths():
+            try:
+                stat = os.stat(path)
+                stamps[path] = (stat.st_mtime_ns,stat.st_size)
+            except OSError: #Removed between listing and stat
+                pass
+        return stamps
+
+    def hasChanged(self) -> bool:
+        return self.getStamps() != self.stamps
+
+    def parseFile(self,path: str) -> List[CharacterRecord | CharacterReference]:
+        if path.lower().endswith(".json"):
+            return self.parseScript(path)
+        return CharacterData.readTree(ET.parse(path))
+
+    def parseScript(self,path: str) -> List[CharacterRecord | CharacterReference]: #Reads a community script JSON file
+        with open(path,encoding="utf-8") as file:
+            script = json.load(file)
+        edition = os.path.splitext(os.path.basename(path))[0]
+        items = []
+        for entry in script:
+            if isinstance(entry,str): #Official character by id
+                items.append(CharacterReference(entry,edition))
+            elif entry.get("id") == "_meta": #Script details, its name is used as the edition
+                edition = entry.get("name",edition)
+            elif "ability" in entry: #Homebrew character
+                items.append(CharacterRecord(
+                    entry.get("name",entry["id"]),
+                    edition,
+                    entry["ability"],
+                    self.teamTypes.get(str(entry.get("team","")).lower(),str(entry.get("team","")).capitalize()),
+                    entry.get("wiki"),
+                    entry.get("image") if isinstance(entry.get("image"),str) else None, #Some scripts give a list of images
+                ))
+            else: #Official character written as {"id": ...}
+                items.append(CharacterReference(entry["id"],edition))
+        for item in items: #The _meta entry may come after characters that were read with the file name as edition
+            item.edition = edition
+        return items
+
+    def load(self) -> CharacterData: #Builds a new index, parsing only new or changed files. Safe to run in a worker thread
+        stamps = self.getStamps()
+        changed = False
+        items = []
+        for path, stamp in stamps.items():
+            cached = self.files.get(path)
+            if cached == None or cached[0] != stamp:
+                try:
+                    cached = (stamp,self.parseFile(path))
+                except Exception as e: #A broken edition file should not stop the others loading
+                    if path == self.basePath:
+                        raise
+                    characterLog.warning("Could not load characters from %s: %s",path,e)
+                    cached = (stamp,[])
+                self.files[path] = cached
+                changed = True
+            items += cached[1]
+        for path in list(self.files.keys()):
+            if not (path in stamps): #File was removed
+                del self.files[path]
+                changed = True
+        if changed:
+            self.saveCache()
+        self.stamps = stamps
+        return CharacterData(items=items)
+
+    def loadCache(self):
+        if self.cachePath == None or not os.path.exists(self.cachePath):
+            return
+        try:
+            with open(self.cachePath,"rb") as file:
+                cache = pickle.load(file)
+            if cache.get("version") == self.cacheVersion:
+                self.files = cache["files"]
+        except Exception as e: #A bad cache only costs a full parse
+            characterLog.warning("Could not read character cache: %s",e)
+
+    def saveCache(self):
+        if self.cachePath == None:
+            return
+        try:
+            temporaryPath = self.cachePath + ".tmp"
+            with open(temporaryPath,"wb") as file:
+                pickle.dump({"version": self.cacheVersion,"files": self.files},file,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporaryPath,self.cachePath) #Readers never see a half written cache
+        except Exception as e:
+            characterLog.warning("Could not write character cache: %s",e)
+
+"""
+Caches the ids of the bot's roles and channels in a guild so they can be resolved with a dict lookup instead of a scan of every role or channel
+Filled in when roles and channels are set up and kept fresh by role and channel events, a miss falls back to a single scan
+"""
+class GuildHandles:
+    roleNames = {role.value: role for role in Role} #Dict (role name -> Role)
+    channelNames = [
+        ChannelNames.category.value,
+        ChannelNames.storytellerText.value,
+        ChannelNames.storytellerVoice.value,
+        ChannelNames.townText.value,
+        ChannelNames.townVoice.value,
+    ] + ChannelNames.dayRooms.value
 
-                    return embed
+    def __init__(self):
+        self.roleIds: Dict[Role,int] = {} #Dict (Role -> role id)
+        self.channelIds: Dict[str,int] = {} #Dict (ChannelNames name -> channel id)
+
+    def getRole(self,guild: discord.Guild,role: Role) -> discord.Role | None:
+        roleId = self.roleIds.get(role)
+        if roleId != None:
+            found = guild.get_role(roleId)
+            if found != None:
+                return found
+        found = get(guild.roles, name=role.value) #Not cached yet, scan once
+        if found != None:
+            self.roleIds[role] = found.id
+        return found
+
+    def setRole(self,role: discord.Role): #Cache a role if it is one of the bot's roles
+        if role.name in self.roleNames:
+            self.roleIds[self.roleNames[role.name]] = role.id
+
+    def removeRole(self,role: discord.Role):
+        for key, roleId in list(self.roleIds.items()):
+            if roleId == role.id:
+                del self.roleIds[key]
+
+    def getChannel(self,guild: discord.Guild,name: str) -> discord.abc.GuildChannel | None:
+        channelId = self.channelIds.get(name)
+        if channelId != None:
+            found = guild.get_channel(channelId)
+            if found != None:
+                return found
+        if name == ChannelNames.category.value: #The category can be found by a scan, other names are only known once the category is
+            found = get(guild.categories, name=name)
+            if found != None:
+                self.channelIds[name] = found.id
+            return found
         return None
-   
-#logging
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
 
+    def setChannel(self,channel: discord.abc.GuildChannel): #Cache a channel if it is one of the game's named channels
+        if not (channel.name in self.channelNames):
+            return
+        if channel.name == ChannelNames.category.value:
+            if channel.type == discord.ChannelType.category:
+                self.channelIds[channel.name] = channel.id
+        elif channel.category_id != None and channel.category_id == self.channelIds.get(ChannelNames.category.value): #Only channels inside the game category
+            self.channelIds[channel.name] = channel.id
+
+    def removeChannel(self,channel: discord.abc.GuildChannel):
+        for key, channelId in list(self.channelIds.items()):
+            if channelId == channel.id:
+                del self.channelIds[key]
+
+"""
+Works out the edit needed to give a player exactly the bot roles the game state says they should have
+Roles that are not managed by the bot are left as they are, and players already in the desired state need no edit at all
+"""
+class RoleReconciler:
+    managedRoles = [Role.player, Role.day, Role.night, Role.roam, Role.alive, Role.dead] #Storyteller role is never set by a transition
+
+    def __init__(self,guild: discord.Guild,handles: GuildHandles):
+        self.roles = {role: handles.getRole(guild,role) for role in self.managedRoles} #Dict (Role -> discord.Role)
+        self.managed = {role.id for role in self.roles.values() if role != None} #Ids of the managed roles that exist on the server
+
+    def getRoleEdit(self,desiredRoles: Dict[int,List[Role]],member: discord.Member) -> List[discord.Role] | None: #Returns the full new role list of a member given GameState.getDesiredRoleMap(), None if no edit is needed
+        if not (member.id in desiredRoles): #Not a player
+            return None
+        desired = [self.roles[role] for role in desiredRoles[member.id] if self.roles[role] != None]
+        desiredIds = {role.id for role in desired}
+        current = member.roles #Copied below, the cached list is never changed in place
+        newRoles = [role for role in current if not (role.id in self.managed) or (role.id in desiredIds)]
+        currentIds = {role.id for role in current}
+        for role in desired:
+            if not (role.id in currentIds):
+                newRoles.append(role)
+        if len(newRoles) == len(current) and all(role.id in currentIds for role in newRoles):
+            return None
+        return newRoles
+
+class RestPriority(IntEnum): #Order discord calls are made in when they have to wait, lowest first
+    #Interaction responses come first of all: they go through the interaction's webhook, which has its own limits, so they are never queued
+    voice = 1 #Moving players and opening or locking public and private rooms, players are waiting on them
+    roles = 2 #Role edits of phase changes
+    provisioning = 3 #Creating, editing and deleting channels and roles
+    announcement = 4 #Messages to the town
 
+"""
+Client side scheduler every discord call of the cog goes through, one per bot since the global rate limit is per bot
+Calls wait for a token of the global limit (and of their rate limit bucket if bucketLimit is set), waiting calls are let through in priority order
+A call waiting on a full or backed off bucket never holds up calls to other buckets, even ones of a lower priority
+A 429 backs off only the bucket it came from, the call is retried once the bucket's retry_after has passed
+"""
+class RestScheduler:
+    def __init__(self,globalLimit: int = 50,bucketLimit: int = 0,window: float = 1.0,margin: float = 0.1,retries: int = 3):
+        self.globalLimit = globalLimit #Calls per window across every bucket, discord allows 50 per second
+        self.bucketLimit = bucketLimit #Calls per window against one bucket, 0 to leave pacing buckets to discord.py, which does it from discord's rate limit headers
+        self.window = window + margin #Seconds the limits are counted over, the margin covers calls sent a window apart arriving closer together
+        self.retries = retries #How many times a call answered with a 429 is retried
+        self.sent: Dict[object,collections.deque] = {} #Dict (bucket key or "global" -> loop times of the calls let through in the last window)
+        self.blockedUntil: Dict[object,float] = {} #Dict (bucket key -> loop time), buckets backed off after a 429
+        self.waiting: List[Tuple[int,int,object,asyncio.Future]] = [] #Sorted [(priority, arrival, bucket key, future set when the call may go)]
+        self.arrivals = itertools.count() #Keeps calls of the same priority in arrival order
+        self.wakeup = asyncio.Event() #Set when a call arrives or a bucket backs off, so the dispatcher looks again
+        self.task = None #Dispatcher task, only running while calls are waiting
+
+    def getWait(self,key,limit: int,now: float) -> float: #Seconds until a call against key may go, 0 if it may go now
+        wait = self.blockedUntil.get(key,0) - now
+        times = self.sent.get(key)
+        if times != None:
+            while len(times) > 0 and times[0] <= now - self.window:
+                times.popleft()
+            if len(times) >= limit:
+                wait = max(wait,times[0] + self.window - now)
+        return max(wait,0)
+
+    def take(self,key,now: float):
+        self.sent.setdefault(key,collections.deque()).append(now)
+
+    def getQueueLength(self) -> int:
+        return len(self.waiting)
+
+    def backoff(self,bucket,seconds: float): #Stops calls against a bucket for seconds, other buckets are not affected
+        until = asyncio.get_running_loop().time() + seconds
+        self.blockedUntil[bucket] = max(self.blockedUntil.get(bucket,0),until)
+        self.wakeup.set()
+
+    def grant(self) -> float: #Lets through every waiting call that may go now, in priority order. Returns seconds until the next one may
+        now = asyncio.get_running_loop().time()
+        nextWait = float("inf")
+        kept = []
+        for entry in self.waiting:
+            priority, arrival, bucket, future = entry
+            if future.done(): #Cancelled while waiting
+                continue
+            wait = max(self.getWait("global",self.globalLimit,now),self.getWait(bucket,self.bucketLimit if self.bucketLimit > 0 else float("inf"),now)) #Backed off buckets wait even when unlimited
+            if wait > 0:
+                kept.append(entry)
+                nextWait = min(nextWait,wait)
+                continue
+            self.take("global",now)
+            if self.bucketLimit > 0:
+                self.take(bucket,now)
+            future.set_result(None)
+        self.waiting = kept
+        return nextWait
+
+    async def run(self): #Dispatcher, sleeps until a waiting call may go or something changes
+        while len(self.waiting) > 0:
+            self.wakeup.clear()
+            wait = self.grant()
+            if len(self.waiting) == 0:
+                break
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),wait)
+            except asyncio.TimeoutError:
+                pass
+        self.task = None
+
+    async def acquire(self,priority: RestPriority,bucket): #Waits until a call against bucket may be made
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self.waiting,(int(priority),next(self.arrivals),bucket,future),key=lambda entry: entry[:2])
+        self.wakeup.set()
+        if self.task == None:
+            self.task = asyncio.create_task(self.run())
+        start = time.perf_counter()
+        await future
+        metrics.restQueueSeconds.observe(time.perf_counter() - start,priority=priority.name)
+
+    async def call(self,priority: RestPriority,bucket,function,*args,**kwargs): #Makes function(*args, **kwargs) once the scheduler lets it, retrying 429s
+        for attempt in range(self.retries + 1):
+            await self.acquire(priority,bucket)
+            try:
+                return await function(*args,**kwargs)
+            except discord.RateLimited as e: #discord.py gave up waiting on a long rate limit
+                lastError = e
+                retryAfter = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    raise
+                lastError = e
+                retryAfter = float(e.response.headers.get("Retry-After",1))
+            if attempt == self.retries: #Out of retries, callers see the 429 itself
+                raise lastError
+            metrics.observeRateLimit("scheduler")
+            self.backoff(bucket,retryAfter)
+
+class ChannelSpec: #Describes one channel the game needs, so existing channels can be matched against it
+    def __init__(self,name: str,kind: discord.ChannelType,overwrites: dict,slot: str,player: discord.Member = None):
+        self.name = name #Name of the channel
+        self.kind = kind #discord.ChannelType.text or discord.ChannelType.voice
+        self.overwrites = overwrites #Dict (role or member -> discord.PermissionOverwrite) the channel should have
+        self.slot = slot #Attribute of GameChannels the channel is stored in
+        self.player = player #Member who owns the channel, only set for private rooms
+
+"""
+Plans the channel layout of a game against the channels that already exist in the game category
+Matching channels are reused and only have their overwrites edited if they differ, missing channels are created and leftover channels deleted
+All of the needed calls are made concurrently, so setting up again for the same players makes no calls at all
+"""
+class ChannelProvisioner:
+    def __init__(self,concurrency: int = 5,scheduler: RestScheduler = None):
+        self.concurrency = concurrency #How many calls may be in flight at once
+        self.scheduler = scheduler if scheduler != None else RestScheduler()
+        self.reused = 0 #Counts of what the last apply did, for reporting
+        self.fixed = 0
+        self.created = 0
+        self.deleted = 0
+
+    @staticmethod
+    def overwritesMatch(current: dict,desired: dict) -> bool: #Compares overwrites by target id, cached targets may be different objects for the same role or member
+        currentById = {target.id: overwrite for target, overwrite in current.items()}
+        desiredById = {target.id: overwrite for target, overwrite in desired.items() if target != None}
+        return currentById == desiredById
+
+    def plan(self,category: discord.CategoryChannel,specs: List[ChannelSpec]): #Returns (reuse [(spec, channel, needs fix)], create [spec], delete [channel])
+        existing: Dict[Tuple[str,discord.ChannelType],List] = {}
+        for channel in category.channels:
+            existing.setdefault((channel.name,channel.type),[]).append(channel)
+        reuse = []
+        create = []
+        for spec in specs:
+            matches = existing.get((spec.name,spec.kind))
+            if matches:
+                channel = matches.pop(0)
+                reuse.append((spec,channel,not self.overwritesMatch(channel.overwrites,spec.overwrites)))
+            else:
+                create.append(spec)
+        delete = [channel for channels in existing.values() for channel in channels]
+        return reuse, create, delete
+
+    async def apply(self,guild: discord.Guild,category: discord.CategoryChannel,specs: List[ChannelSpec]) -> List[Tuple[ChannelSpec,discord.abc.GuildChannel]]: #Returns every spec paired with its channel, in spec order
+        reuse, create, delete = self.plan(category,specs)
+        self.reused = len(reuse)
+        self.fixed = len([needsFix for spec, channel, needsFix in reuse if needsFix])
+        self.created = len(create)
+        self.deleted = len(delete)
+        cap = asyncio.Semaphore(self.concurrency)
+        placed = {spec: channel for spec, channel, needsFix in reuse}
+        positions = {spec: i for i, spec in enumerate(specs)}
+
+        async def fix(spec: ChannelSpec,channel):
+            async with cap:
+                await self.scheduler.call(RestPriority.provisioning,("channel",channel.id),channel.edit,overwrites=spec.overwrites)
+
+        async def make(spec: ChannelSpec):
+            create = guild.create_text_channel if spec.kind == discord.ChannelType.text else guild.create_voice_channel
+            async with cap:
+                placed[spec] = await self.scheduler.call(RestPriority.provisioning,("channels",guild.id),create,name=spec.name,overwrites=spec.overwrites,category=category,position=positions[spec])
+
+        async def remove(channel):
+            async with cap:
+                await self.scheduler.call(RestPriority.provisioning,("channel",channel.id),channel.delete)
+
+        calls = [fix(spec,channel) for spec, channel, needsFix in reuse if needsFix]
+        calls += [make(spec) for spec in create]
+        calls += [remove(channel) for channel in delete]
+        await asyncio.gather(*calls)
+        return [(spec,placed[spec]) for spec in specs]
+
+    def summary(self) -> str:
+        return f"{self.reused} reused ({self.fixed} fixed), {self.created} created, {self.deleted} removed"
+
+class TransitionStep: #One discord call that a phase transition makes for every player
+    def __init__(self,name: str,bucket,action,priority: RestPriority):
+        self.name = name #Name of the step shown in transition summaries, unique within a transition
+        self.bucket = bucket #Function (member -> key) of the discord rate limit bucket the call is made against
+        self.action = action #Coroutine function (member, send -> None) making the call with send(function, *args), returns False if it was skipped
+        self.priority = priority #RestPriority the call is scheduled with
+
+"""
+Per player status of every step of a phase transition, each step is "pending" until it has run, then "ok", "skipped" or the error
+Players are kept by id, so a plan can be resumed with other member objects after a reconnect
+Resuming a plan only runs the steps that are not done, and steps check discord's current state first (the role step fetches members discord.py does not keep up to date), so running a transition again makes no duplicate calls
+"""
+class TransitionPlan:
+    done = ("ok","skipped") #Outcomes that need no retry
+
+    def __init__(self,members: List[discord.Member],steps: List[TransitionStep],phase: Tuple[int,int] = None):
+        self.steps = steps #Steps every player goes through, in order
+        self.phase = phase #(day, phase) the plan moves players for, None for transitions that are not phase changes
+        self.names: Dict[int,str] = {member.id: str(member) for member in members} #Dict (member id -> name) for the summary
+        self.status: Dict[int,Dict[str,str]] = {member.id: {step.name: "pending" for step in steps} for member in members} #Dict (member id -> Dict (step name -> status))
+        self.calls = 0 #Discord calls made by the latest run of the plan
+
+    def record(self,member: discord.Member,step: str,outcome: str):
+        self.status[member.id][step] = outcome
+        if outcome != "skipped":
+            self.calls += 1
+
+    def getRemainingSteps(self,member: discord.Member) -> List[TransitionStep]: #Steps of a player that are pending or failed
+        status = self.status.get(member.id,{})
+        return [step for step in self.steps if step.name in status and not (status[step.name] in self.done)]
+
+    def getFailures(self) -> Dict[str,List[Tuple[str,str]]]: #Returns the failed steps of each player that had any, by player name
+        failures = {}
+        for id, status in self.status.items():
+            failed = [(step,outcome) for step, outcome in status.items() if not (outcome in self.done) and outcome != "pending"]
+            if len(failed) > 0:
+                failures[self.names[id]] = failed
+        return failures
+
+    def getPendingCount(self) -> int: #Players none of whose remaining steps have run yet, e.g. the transition was cut short
+        return sum(1 for status in self.status.values() if "pending" in status.values() and all(outcome in self.done or outcome == "pending" for outcome in status.values()))
+
+    def isSuccess(self) -> bool:
+        return all(outcome in self.done for status in self.status.values() for outcome in status.values())
+
+    def getCallCount(self) -> int: #Discord calls the latest run made, skipped steps made none
+        return self.calls
+
+    def summary(self) -> str: #Returns a short human readable summary of the transition
+        failures = self.getFailures()
+        finished = sum(1 for status in self.status.values() if all(outcome in self.done for outcome in status.values()))
+        text = f"{finished}/{len(self.status)} players moved successfully"
+        for name, failed in failures.items():
+            steps = ", ".join(f"{step}: {outcome}" for step, outcome in failed)
+            text += f"\n{name} failed ({steps})"
+        pending = self.getPendingCount()
+        if pending > 0:
+            text += f"\n{pending} players not attempted yet"
+        return text
+
+"""
+Runs the discord calls of a phase transition for every player concurrently instead of one player after another
+Steps of a single player still run in order (e.g. a room has to be unlocked before a player can be moved into it), a failed step leaves the player's later steps pending
+The number of calls in flight is capped per transition, and every call goes through the RestScheduler with its step's priority and bucket
+"""
+class TransitionEngine:
+    def __init__(self,scheduler: RestScheduler = None):
+        self.scheduler = scheduler if scheduler != None else RestScheduler() #Shared with the rest of the bot
+
+    async def run(self,members: List[discord.Member],steps: List[TransitionStep],concurrency: int = 5,phase: Tuple[int,int] = None) -> TransitionPlan: #Plans the steps for every player and runs them
+        return await self.resume(TransitionPlan(members,steps,phase),members,concurrency)
+
+    async def resume(self,plan: TransitionPlan,members: List[discord.Member],concurrency: int = 5) -> TransitionPlan: #Runs the steps of the plan that are not done, for the members in it
+        cap = asyncio.Semaphore(concurrency)
+        plan.calls = 0
+
+        async def runPlayer(member: discord.Member):
+            for step in plan.getRemainingSteps(member):
+                try:
+                    send = functools.partial(self.scheduler.call,step.priority,step.bucket(member)) #Skipped steps never wait on the scheduler
+                    async with cap:
+                        result = await step.action(member,send)
+                    plan.record(member,step.name,"skipped" if result == False else "ok")
+                except Exception as e: #One failing player or step should not abort everyone elses transition
+                    transitionLog.warning("Transition step %s failed for %s: %s",step.name,member,e)
+                    plan.record(member,step.name,str(e))
+                    return #Later steps depend on this one, they stay pending for a retry
+
+        await asyncio.gather(*[runPlayer(member) for member in members if member.id in plan.status])
+        return plan
+
+"""
+Schedules the automatic locking of public rooms with a single timer per session instead of a sleeping task per join
+Each room has at most one pending deadline, scheduling a room again moves its deadline and cancelling drops it
+Rooms that fall due together are handed to the handler as one batch
+"""
+class RoomLockScheduler:
+    batchWindow = 0.25 #Rooms due within this many seconds of each other are locked in the same batch
+
+    def __init__(self,handler = None):
+        self.handler = handler #Coroutine function (rooms -> None) called with every due room
+        self.deadlines: Dict[int,float] = {} #Dict (channel id -> deadline in event loop time)
+        self.rooms: Dict[int,discord.VoiceChannel] = {} #Dict (channel id -> channel) of rooms with a pending deadline
+        self.heap: List[Tuple[float,int]] = [] #Heap of (deadline, channel id), entries not matching self.deadlines are stale and skipped
+        self.wakeup = asyncio.Event() #Set when deadlines change so the timer can re-check the earliest one
+        self.task = None #Timer task, only running while there are pending deadlines
+
+    def schedule(self,room: discord.VoiceChannel,delay: float): #Lock a room in delay seconds, replacing its pending deadline if it has one
+        deadline = asyncio.get_running_loop().time() + delay
+        self.deadlines[room.id] = deadline
+        self.rooms[room.id] = room
+        heapq.heappush(self.heap,(deadline,room.id))
+        self.wakeup.set()
+        if self.task == None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self,room: discord.VoiceChannel): #Drop a rooms pending deadline, if any
+        if self.deadlines.pop(room.id,None) != None:
+            self.rooms.pop(room.id,None)
+            self.wakeup.set()
+
+    def cancelAll(self):
+        self.deadlines = {}
+        self.rooms = {}
+        self.heap = []
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+    def isPending(self,room: discord.VoiceChannel) -> bool:
+        return room.id in self.deadlines
+
+    def getPendingCount(self) -> int:
+        return len(self.deadlines)
+
+    async def run(self): #Sleeps until the earliest deadline, then hands every due room to the handler
+        loop = asyncio.get_running_loop()
+        while len(self.deadlines) > 0:
+            while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]: #Drop stale entries
+                heapq.heappop(self.heap)
+            self.wakeup.clear()
+            delay = self.heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(),delay)
+                    continue #Deadlines changed, look at the earliest again
+                except asyncio.TimeoutError:
+                    pass
+            due = []
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now + self.batchWindow:
+                deadline, roomId = heapq.heappop(self.heap)
+                if self.deadlines.get(roomId) == deadline:
+                    del self.deadlines[roomId]
+                    due.append(self.rooms.pop(roomId))
+            if len(due) > 0 and self.handler != None:
+                try:
+                    await self.handler(due)
+                except Exception: #Keep the timer alive for the other rooms
+                    roomLog.exception("Exception has occured while locking rooms")
+        self.heap = []
+
+def formatLabels(labels: Tuple,extra: Tuple = ()) -> str: #Prometheus label set, e.g. {command="kill_player",le="0.5"}
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    text = ",".join('{}="{}"'.format(name,str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")) for name, value in pairs)
+    return "{" + text + "}"
+
+class MetricCounter: #Value that only goes up, one per label set
+    type = "counter"
+
+    def __init__(self,name: str,help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Tuple,float] = {} #Dict (sorted label pairs -> value)
+
+    def inc(self,amount: float = 1,**labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key,0) + amount
+
+    def get(self,**labels) -> float:
+        return self.values.get(tuple(sorted(labels.items())),0)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{formatLabels(key)} {value}" for key, value in self.values.items()]
+
+class MetricGauge: #Value read when the metrics are rendered, so it is never stale
+    type = "gauge"
+
+    def __init__(self,name: str,help: str,function):
+        self.name = name
+        self.help = help
+        self.function = function #Function () -> float
+
+    def render(self) -> List[str]:
+        return [f"{self.name} {self.function()}"]
+
+class MetricHistogram: #Counts observations into buckets, one set of buckets per label set
+    type = "histogram"
+    defaultBuckets = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30)
+
+    def __init__(self,name: str,help: str,buckets: Tuple = None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets if buckets != None else self.defaultBuckets
+        self.values: Dict[Tuple,list] = {} #Dict (sorted label pairs -> [count per bucket, sum, count])
+
+    def observe(self,value: float,**labels):
+        key = tuple(sorted(labels.items()))
+        data = self.values.get(key)
+        if data == None:
+            data = self.values[key] = [[0] * (len(self.buckets) + 1),0,0]
+        data[0][bisect.bisect_left(self.buckets,value)] += 1 #Last slot is past every bucket
+        data[1] += value
+        data[2] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucketCount in zip(list(self.buckets) + ["+Inf"],counts):
+                cumulative += bucketCount
+                lines.append(f"{self.name}_bucket{formatLabels(key,(('le',bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{formatLabels(key)} {total}")
+            lines.append(f"{self.name}_count{formatLabels(key)} {count}")
+        return lines
+
+class CommandTiming: #Where one command spent its time, shared with every task the command starts
+    def __init__(self,name: str,span = None):
+        self.name = name
+        self.start = time.perf_counter()
+        self.lockWait = 0 #Seconds spent waiting for the session's command lock
+        self.restTime = 0 #Seconds spent in discord calls, summed over calls made at the same time
+        self.restCalls = 0
+        self.span = span #OpenTelemetry span of the command, None if tracing is off
+
+currentCommand = contextvars.ContextVar("currentCommand",default=None) #CommandTiming of the command running in this task, if any
+
+"""
+Counters, gauges and histograms of the bot, rendered in the Prometheus text format
+Values are only changed from the event loop so they need no locking, gauges are read when rendered
+"""
+class Metrics:
+    def __init__(self):
+        self.metrics: Dict[str,object] = {} #Dict (name -> metric) in the order they were added
+        self.tracer = None #OpenTelemetry tracer, spans are only made if it is set
+        self.commandSeconds = self.add(MetricHistogram("ctb_command_seconds","Time from a command starting to it finishing"))
+        self.commandLockSeconds = self.add(MetricHistogram("ctb_command_lock_wait_seconds","Time a command waited for its session's command lock"))
+        self.commandRestSeconds = self.add(MetricHistogram("ctb_command_rest_seconds","Time a command spent in discord calls, summed over concurrent calls"))
+        self.commands = self.add(MetricCounter("ctb_commands_total","Commands run, by outcome"))
+        self.lockSeconds = self.add(MetricHistogram("ctb_lock_wait_seconds","Time spent acquiring a lock",(0.0001,0.001,0.005,0.01,0.05,0.1,0.5,1,5,10,30)))
+        self.lockContended = self.add(MetricCounter("ctb_lock_contended_total","Acquisitions of a lock that was already held"))
+        self.restRequests = self.add(MetricCounter("ctb_rest_requests_total","Discord REST requests, by route"))
+        self.restSeconds = self.add(MetricHistogram("ctb_rest_seconds","Time of a discord REST request, rate limit retries included"))
+        self.rateLimited = self.add(MetricCounter("ctb_rate_limited_total","429 responses from discord"))
+        self.transitionCalls = self.add(MetricHistogram("ctb_transition_rest_calls","Discord calls made by a phase transition",(0,5,10,20,40,60,80,120,200)))
+        self.events = self.add(MetricHistogram("ctb_gateway_event_seconds","Time handling a gateway event"))
+        self.applySeconds = self.add(MetricHistogram("ctb_apply_seconds","Time applying the discord side of a command after it answered",(0.05,0.1,0.25,0.5,1,2.5,5,10,30,60)))
+        self.restQueueSeconds = self.add(MetricHistogram("ctb_rest_queue_seconds","Time a discord call waited in the REST scheduler",(0.001,0.01,0.05,0.1,0.25,0.5,1,2.5,5,10,30)))
+
+    def add(self,metric):
+        self.metrics[metric.name] = metric #Adding a metric again replaces it, e.g. gauges of a reloaded cog
+        return metric
+
+    def gauge(self,name: str,help: str,function):
+        return self.add(MetricGauge(name,help,function))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def beginCommand(self,name: str,guildId: int = None) -> CommandTiming:
+        span = None
+        if self.tracer != None:
+            span = self.tracer.start_span(f"/{name}",attributes={"discord.guild_id": str(guildId)})
+        return CommandTiming(name,span)
+
+    def endCommand(self,timing: CommandTiming,outcome: str):
+        self.commandSeconds.observe(time.perf_counter() - timing.start,command=timing.name)
+        self.commandLockSeconds.observe(timing.lockWait,command=timing.name)
+        self.commandRestSeconds.observe(timing.restTime,command=timing.name)
+        self.commands.inc(command=timing.name,outcome=outcome)
+        if timing.span != None:
+            timing.span.set_attribute("ctb.outcome",outcome)
+            timing.span.set_attribute("ctb.lock_wait_seconds",timing.lockWait)
+            timing.span.set_attribute("ctb.rest_seconds",timing.restTime)
+            timing.span.set_attribute("ctb.rest_calls",timing.restCalls)
+            timing.span.end()
+
+    def observeLock(self,name: str,seconds: float,contended: bool):
+        self.lockSeconds.observe(seconds,lock=name)
+        if contended:
+            self.lockContended.inc(lock=name)
+        timing = currentCommand.get()
+        if timing != None and name == "command":
+            timing.lockWait += seconds
+
+    def observeRest(self,method: str,route: str,seconds: float):
+        self.restRequests.inc(method=method,route=route)
+        self.restSeconds.observe(seconds,method=method)
+        timing = currentCommand.get()
+        if timing != None:
+            timing.restTime += seconds
+            timing.restCalls += 1
+
+    def observeRateLimit(self,scope: str):
+        self.rateLimited.inc(scope=scope)
+
+    def observeTransition(self,phase: str,calls: int):
+        self.transitionCalls.observe(calls,phase=phase)
+
+    def observeEvent(self,event: str,seconds: float):
+        self.events.observe(seconds,event=event)
+
+class TimedLock(asyncio.Lock): #asyncio.Lock that reports how long acquiring it took and if it was already held
+    def __init__(self,name: str):
+        super().__init__()
+        self.name = name #Label of the lock in the metrics, e.g. "command" or "room"
+
+    async def acquire(self) -> bool:
+        contended = self.locked()
+        start = time.perf_counter()
+        await super().acquire()
+        metrics.observeLock(self.name,time.perf_counter() - start,contended)
+        return True
+
+class RateLimitCounter(logging.Handler): #Counts the 429s discord.py logs, it retries them itself so they never reach the bot
+    def emit(self,record: logging.LogRecord):
+        if not isinstance(record.msg,str):
+            return
+        if record.msg.startswith("We are being rate limited"):
+            metrics.observeRateLimit("bucket")
+        elif record.msg.startswith("Global rate limit has been hit"):
+            metrics.observeRateLimit("global")
+
+def timedEvent(function): #Decorator that times a gateway event listener, keeps its name so it is still registered as a listener
+    @functools.wraps(function)
+    async def wrapper(*args,**kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args,**kwargs)
+        finally:
+            metrics.observeEvent(function.__name__.removeprefix("on_"),time.perf_counter() - start)
+    return wrapper
+
+metrics = Metrics()
+rateLimitCounter = RateLimitCounter()
+
+"""
+Edits one message in place at most once per interval, so many changes in a short time cost one edit
+A change replaces any pending one, so the message always ends up showing the latest content
+"""
+class ThrottledMessage:
+    def __init__(self,edit,interval: float = 1.0):
+        self.edit = edit #Coroutine function (**fields) that edits the message
+        self.interval = interval #Least time (in secs) between two edits
+        self.pending = None #Fields of the next edit, None if there are no changes to show
+        self.lastEdit = None #Event loop time of the last edit
+        self.task = None #Task making the pending edit, only running while there is one
+        self.edits = 0 #How many edits were made
+
+    def update(self,**fields): #Shows fields on the next edit
+        self.pending = fields
+        if self.task == None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending != None:
+            if self.lastEdit != None:
+                await asyncio.sleep(max(0,self.lastEdit + self.interval - loop.time()))
+            fields, self.pending = self.pending, None #Changes made while editing are picked up by the next pass
+            self.lastEdit = loop.time()
+            try:
+                await self.edit(**fields)
+                self.edits += 1
+            except Exception as e:
+                commandLog.warning("Exception has occured while editing message: %s",e)
+
+    async def close(self,**fields): #Makes a last edit and waits until it is made
+        self.update(**fields)
+        await self.task
+
+"""
+One vote on a nomination
+Hands are raised and lowered in O(1) and become final once counted. Players vote in seating order starting clockwise of the nominee and ending on them, as in the official rules
+Who may vote is fixed when the vote starts, dead players vote with their ghost vote which is used up once it is counted
+Countdown votes count every hand at once when time runs out, blind votes hide hands until then, and point votes have every player pick a player instead of raising a hand
+"""
+class Vote:
+    def __init__(self,gameState: GameState,nominator: discord.Member,nominee: discord.Member,type: VotingType):
+        self.type = type
+        self.nominator = nominator
+        self.nominee = nominee
+        players = gameState.getPlayers()
+        start = 0
+        if nominee != None and gameState.isMemberPlayer(nominee):
+            start = players.index(gameState.getPlayer(nominee)) + 1
+        self.order: List[Player] = players[start:] + players[:start] #Players in the order they are counted
+        #Dict (member id -> player) of who may vote, every player points in a point vote
+        self.voters: Dict[int,Player] = {player.member.id: player for player in self.order if player.canVote() or type == VotingType.pointCountdown}
+        self.hands = set() #Ids of voters with their hand raised
+        self.counted: Dict[int,bool] = {} #Dict (member id -> voted) of counted voters
+        self.points: Dict[int,int] = {} #Dict (member id -> member id) of who each voter points at in a point vote
+        self.position = 0 #Index in self.order of the next player to count
+        self.closesAt = None #Unix time a countdown vote ends, shown with a discord timestamp that counts down without edits
+        self.required = (len([player for player in players if player.isAlive]) + 1) // 2 #Votes needed to put the nominee on the block, half the living players
+        self.finished = False
+
+    def setHand(self,member: discord.Member,raised: bool) -> str | None: #Raises or lowers a voters hand, returns why not if it cannot be changed
+        if self.finished:
+            return "The vote is over"
+        if not (member.id in self.voters):
+            return "You cannot vote in this vote"
+        if member.id in self.counted:
+            return "Your vote has already been counted"
+        if raised:
+            self.hands.add(member.id)
+        else:
+            self.hands.discard(member.id)
+        return None
+
+    def setPoint(self,member: discord.Member,targetId: int) -> str | None: #Points a voter at a player, returns why not if they cannot
+        if self.finished:
+            return "The vote is over"
+        if not (member.id in self.voters):
+            return "You cannot vote in this vote"
+        if not (targetId in self.voters):
+            return "You can only point at a player"
+        self.points[member.id] = targetId
+        return None
+
+    def isBlind(self) -> bool:
+        return self.type == VotingType.blindCountdownTally and not self.finished
+
+    def startCountdown(self,delay: float):
+        self.closesAt = int(time.time() + delay)
+
+    def countPlayer(self,player: Player) -> bool: #Counts a players hand, returns if it used up their ghost vote
+        if not (player.member.id in self.voters) or (player.member.id in self.counted):
+            return False
+        voted = player.member.id in self.hands
+        self.counted[player.member.id] = voted
+        if voted and not player.isAlive:
+            player.consumeGhostVote()
+            return True
+        return False
+
+    def countNext(self) -> List[Player]: #Moves the clock hand on by one player, returns players whose ghost vote was used
+        player = self.order[self.position]
+        self.position += 1
+        return [player] if self.countPlayer(player) else []
+
+    def countAll(self) -> List[Player]: #Counts every hand at once, returns players whose ghost vote was used
+        self.position = len(self.order)
+        if self.type == VotingType.pointCountdown: #Pointing is not a vote, ghost votes are kept
+            return []
+        return [player for player in self.order if self.countPlayer(player)]
+
+    def getPointTally(self) -> List[Tuple[Player,int]]: #Players pointed at, most pointed at first
+        tally: Dict[int,int] = {}
+        for targetId in self.points.values():
+            tally[targetId] = tally.get(targetId,0) + 1
+        return sorted([(self.voters[id],count) for id, count in tally.items()],key=lambda item: -item[1])
+
+    def isCounted(self) -> bool:
+        return self.position >= len(self.order)
+
+    def getVotes(self) -> int:
+        return sum(1 for voted in self.counted.values() if voted)
+
+    def finish(self):
+        self.finished = True
+
+    def getName(self,member: discord.Member) -> str:
+        return member.name if member != None else "Unknown"
+
+    def render(self) -> str: #Text of the vote message
+        if self.type == VotingType.pointCountdown:
+            return self.renderPoints()
+        lines = [f"**{self.getName(self.nominator)} has nominated {self.getName(self.nominee)}**"]
+        if self.closesAt != None and not self.finished:
+            lines.append(f"Voting closes <t:{self.closesAt}:R>")
+        if self.isBlind():
+            lines.append("Votes are hidden until the vote is over")
+        for i, player in enumerate(self.order):
+            id = player.member.id
+            if id in self.counted:
+                mark = ":white_check_mark:" if self.counted[id] else ":x:"
+            elif not (id in self.voters):
+                mark = ":skull:" #Dead without a ghost vote
+            elif id in self.hands and not self.isBlind():
+                mark = ":raised_hand:"
+            else:
+                mark = ":black_large_square:"
+            pointer = ":point_right: " if (self.type == VotingType.circleTally and i == self.position and not self.finished) else ""
+            ghost = " (ghost vote)" if (id in self.voters and not player.isAlive) else ""
+            lines.append(f"{pointer}{mark} {player.member.name}{ghost}")
+        if self.isBlind():
+            lines.append(f"{self.required} votes needed")
+        else:
+            lines.append(f"Votes: {self.getVotes()}, {self.required} needed")
+        if self.finished:
+            if self.getVotes() >= self.required:
+                lines.append(f"The vote is over, {self.getName(self.nominee)} is about to die with {self.getVotes()} votes")
+            else:
+                lines.append(f"The vote is over, {self.getName(self.nominee)} does not have enough votes")
+        return "\n".join(lines)
+
+    def renderPoints(self) -> str: #Text of a point vote message, points are public
+        lines = [f"**Every player points at a player**"]
+        if self.closesAt != None and not self.finished:
+            lines.append(f"Voting closes <t:{self.closesAt}:R>")
+        for player in self.order:
+            target = self.voters.get(self.points.get(player.member.id))
+            lines.append(f"{player.member.name} :point_right: {target.member.name if target != None else '...'}")
+        if self.finished:
+            tally = self.getPointTally()
+            if len(tally) == 0:
+                lines.append("The vote is over, no one was pointed at")
+            else:
+                most = [player.member.name for player, count in tally if count == tally[0][1]]
+                lines.append(f"The vote is over, most pointed at with {tally[0][1]}: {', '.join(most)}")
+        return "\n".join(lines)
+
+"""
+Append only journal of a session's game state, so a game survives a restart of the bot
+Each change is one JSON line in <name>.log, lines are buffered and written with one fsync per batch
+Every snapshotEvery events the whole state is written to <name>.snapshot.json and the log is cleared,
+so recovery replays at most one snapshot and snapshotEvery events however long the game ran
+"""
+class GameJournal:
+    flushDelay = 0.5 #How long (in secs) events are buffered before they are written to disk
+    snapshotEvery = 200 #How many events are logged before the log is compacted into a snapshot
+
+    def __init__(self,directory: str,name: str):
+        self.logPath = os.path.join(directory,f"{name}.log")
+        self.snapshotPath = os.path.join(directory,f"{name}.snapshot.json")
+        self.seq = 0 #Sequence number of the last recorded event
+        self.eventCount = 0 #Events recorded since the last snapshot
+        self.buffer: List[str] = [] #Encoded events waiting to be written
+        self.pendingSnapshot = None #Snapshot waiting to be written, replaces the log up to its sequence number
+        self.flushTask = None #Task that writes the buffer after flushDelay
+        self.flushLock = asyncio.Lock() #Only one batch is written at a time so batches stay in order
+
+    def exists(self) -> bool: #If there is anything to recover
+        return os.path.exists(self.logPath) or os.path.exists(self.snapshotPath)
+
+    def record(self,type: str,**data): #Buffers an event, it is written within flushDelay seconds
+        self.seq += 1
+        self.eventCount += 1
+        self.buffer.append(json.dumps({"seq": self.seq,"type": type,**data}))
+        self.scheduleFlush()
+
+    def needsSnapshot(self) -> bool:
+        return self.eventCount >= self.snapshotEvery
+
+    def snapshot(self,snapshot: dict): #Replaces the log with a snapshot of the state after the last recorded event
+        self.pendingSnapshot = {"seq": self.seq,"state": snapshot}
+        self.buffer = [] #Every buffered event is part of the snapshot
+        self.eventCount = 0
+        self.scheduleFlush()
+
+    def scheduleFlush(self):
+        if self.flushTask == None or self.flushTask.done():
+            self.flushTask = asyncio.create_task(self.flushLater())
+
+    async def flushLater(self):
+        await asyncio.sleep(self.flushDelay)
+        await self.flush()
+
+    async def flush(self): #Writes everything buffered so far, disk access runs in a worker thread
+        async with self.flushLock:
+            lines, self.buffer = self.buffer, []
+            snapshot, self.pendingSnapshot = self.pendingSnapshot, None
+            if len(lines) == 0 and snapshot == None:
+                return
+            try:
+                await asyncio.to_thread(self.write,lines,snapshot)
+            except Exception:
+                journalLog.exception("Could not write game journal")
+
+    def write(self,lines: List[str],snapshot: dict = None):
+        os.makedirs(os.path.dirname(self.logPath) or ".",exist_ok=True)
+        if snapshot != None:
+            temporaryPath = self.snapshotPath + ".tmp"
+            with open(temporaryPath,"w",encoding="utf-8") as file:
+                json.dump(snapshot,file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporaryPath,self.snapshotPath) #Readers never see a half written snapshot
+            GameJournal.syncDirectory(self.snapshotPath) #The new snapshot must be on disk before the events it replaces are dropped
+            with open(self.logPath,"w") as file: #Events up to the snapshot are no longer needed, a crash before this only leaves events replay skips by their seq
+                file.flush()
+                os.fsync(file.fileno())
+        if len(lines) > 0:
+            with open(self.logPath,"a",encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    @staticmethod
+    def syncDirectory(path: str): #Makes a rename in the directory of path durable, not possible on Windows where renames need no sync
+        try:
+            descriptor = os.open(os.path.dirname(path) or ".",os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def load(self) -> dict | None: #Replays the snapshot and the log after it, returns the recovered state or None if there is none. Safe to run in a worker thread
+        state = None
+        if os.path.exists(self.snapshotPath):
+            with open(self.snapshotPath,encoding="utf-8") as file:
+                snapshot = json.load(file)
+            state = snapshot["state"]
+            self.seq = snapshot["seq"]
+        if os.path.exists(self.logPath):
+            with open(self.logPath,encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except ValueError: #Torn last line from a crash mid write
+                        break
+                    if event["seq"] <= self.seq: #Already part of the snapshot
+                        continue
+                    if state == None:
+                        state = GameState().toSnapshot()
+                    GameJournal.applyEvent(state,event)
+                    self.seq = event["seq"]
+                    self.eventCount += 1
+        return state
+
+    @staticmethod
+    def applyEvent(state: dict,event: dict): #Applies one event to a snapshot, mirroring what the commands did to the GameState
+        type = event["type"]
+        players = {data["id"]: data for data in state["players"]}
+        if type == "playerAdded":
+            if not (event["member"] in players):
+                state["players"].append({"id": event["member"],"isAlive": True,"hasGhostVote": True})
+            state["channelReady"] = False
+        elif type == "playerRemoved":
+            state["players"] = [data for data in state["players"] if data["id"] != event["member"]]
+            state["channelReady"] = False
+        elif type == "storytellerSet":
+            state["storyteller"] = event["member"]
+        elif type == "channelsReady":
+            state["channels"] = event["channels"]
+            state["privateRooms"] = event["privateRooms"]
+            state["roleGatedRooms"] = event.get("roleGatedRooms",False)
+            state["lockedRooms"] = []
+            state["channelReady"] = True
+        elif type == "gameStarted":
+            state["active"] = True
+            state["gameDay"] = event["day"]
+            state["dayPhase"] = event["phase"]
+        elif type == "phaseAdvanced":
+            state["gameDay"] = event["day"]
+            state["dayPhase"] = event["phase"]
+        elif type in ["killed","revived"]:
+            if event["member"] in players:
+                players[event["member"]]["isAlive"] = (type == "revived")
+        elif type == "ghostVoteConsumed":
+            if event["member"] in players:
+                players[event["member"]]["hasGhostVote"] = False
+        elif type == "roomLocked":
+            if not (event["room"] in state["lockedRooms"]):
+                state["lockedRooms"].append(event["room"])
+        elif type == "roomUnlocked":
+            state["lockedRooms"] = [room for room in state["lockedRooms"] if room != event["room"]]
+        elif type == "gameEnded":
+            state.update(GameState().toSnapshot())
+        else:
+            journalLog.warning("Skipped unknown game journal event: %s",type)
+
+"""
+Applies the discord side of a session's commands in the background, one job at a time in the order the commands queued them
+Commands only change the game state under the command lock and answer straight away, so the lock is never held across REST calls
+A failing job is logged and the jobs after it still run, so one bad call can never wedge the session
+"""
+class ApplyQueue:
+    def __init__(self):
+        self.jobs: collections.deque = collections.deque() #Queue of (name, coroutine function) waiting to run
+        self.running = None #Name of the job being applied, None if idle
+        self.idle = asyncio.Event() #Set while there is nothing to apply
+        self.idle.set()
+        self.task = None #Worker task, only running while there are jobs
+
+    def submit(self,name: str,job): #Queues job() to run after every job queued before it
+        self.jobs.append((name,job))
+        self.idle.clear()
+        if self.task == None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        currentCommand.set(None) #REST calls of jobs are not part of the command that started the worker
+        while len(self.jobs) > 0:
+            name, job = self.jobs.popleft()
+            self.running = name
+            start = time.perf_counter()
+            outcome = "ok"
+            try:
+                await job()
+            except Exception:
+                outcome = "error"
+                commandLog.exception("Exception has occured while applying %s",name)
+            finally:
+                self.running = None
+            metrics.applySeconds.observe(time.perf_counter() - start,job=name,outcome=outcome)
+        self.idle.set()
+
+    def getPendingCount(self) -> int: #Jobs queued or running
+        return len(self.jobs) + (1 if self.running != None else 0)
+
+    async def join(self): #Waits until every queued job has been applied
+        await self.idle.wait()
+
+    def cancelAll(self): #Drops queued jobs and stops the running one, e.g. when the bot leaves the guild
+        self.jobs.clear()
+        if self.task != None:
+            self.task.cancel()
+        self.idle.set()
+
+class GameSession: #Holds everything one running game needs, so games in different guilds never share state or locks
+    def __init__(self,guildId: int,roomLockHandler = None,journalDir: str = None,scheduler: RestScheduler = None):
+        self.guildId = guildId #Guild the session belongs to
+        self.gameState = GameState() #Game state of this session only, holds its own ChannelLocks
+        self.commandLock = TimedLock("command") #Asyncio lock that handles discord command execution for this session
+        self.handles = GuildHandles() #Cached role and channel ids of the guild
+        self.transitionEngine = TransitionEngine(scheduler) #Runs the per player discord calls of phase transitions concurrently
+        self.roomLockScheduler = RoomLockScheduler(roomLockHandler) #Pending public room locks of this session
+        self.vote: Vote = None #Latest vote of this session, a new vote can start once it is finished
+        self.voteTask = None #Task counting the running vote
+        self.transitionPlan: TransitionPlan = None #Plan of the latest phase transition, retried by /retry_player_movement
+        self.applyQueue = ApplyQueue() #Discord side of the session's commands, applied after the commands answer
+        self.journal = GameJournal(journalDir,str(guildId)) if journalDir != None else None #Journal the game is recovered from after a restart, None if journaling is off
+
+    def record(self,type: str,**data): #Journals a change to the game state, compacting the journal when it has grown
+        if self.journal == None:
+            return
+        self.journal.record(type,**data)
+        if self.journal.needsSnapshot():
+            self.journal.snapshot(self.gameState.toSnapshot())
+
+    def snapshot(self): #Journals the whole game state at once, for changes that are not single events
+        if self.journal != None:
+            self.journal.snapshot(self.gameState.toSnapshot())
+
+    def isActive(self) -> bool:
+        return self.gameState.active
+
+class SessionRegistry: #Maps guilds to their game session
+    def __init__(self,roomLockHandler = None,journalDir: str = None,scheduler: RestScheduler = None):
+        self.roomLockHandler = roomLockHandler #Coroutine function (rooms -> None) given to each session's room lock scheduler
+        self.journalDir = journalDir #Directory of the game journals, None to not journal games
+        self.scheduler = scheduler if scheduler != None else RestScheduler() #REST scheduler shared by every session, the global rate limit is per bot
+        self.sessions: Dict[int,GameSession] = {} #Dict (guild id -> session)
+
+    def getSession(self,guild: discord.Guild) -> GameSession: #Returns the session of a guild, creating it on first use
+        session = self.sessions.get(guild.id)
+        if session == None:
+            #No await between the lookup and insert, so two events for a new guild cannot create two sessions
+            session = GameSession(guild.id,self.roomLockHandler,self.journalDir,self.scheduler)
+            self.sessions[guild.id] = session
+        return session
+
+    def hasSession(self,guild: discord.Guild) -> bool:
+        return guild.id in self.sessions
+
+    def removeSession(self,guild: discord.Guild): #Drops a session, e.g. when the bot leaves a guild
+        session = self.sessions.pop(guild.id,None)
+        if session != None:
+            session.roomLockScheduler.cancelAll()
+            session.applyQueue.cancelAll()
+
+    def getActiveSessions(self) -> List[GameSession]: #Returns every session with a running game
+        return [session for session in self.sessions.values() if session.isActive()]
+
+    def hasJournal(self,guild: discord.Guild) -> bool: #If a game of this guild was journaled before a restart
+        if self.journalDir == None:
+            return False
+        return GameJournal(self.journalDir,str(guild.id)).exists()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+"""
+Syncs the slash command tree to discord only when it changed since the last sync
+The commands of each scope (global or one guild) are hashed and the hashes kept in a file, an unchanged tree costs no REST call
+"""
+class CommandTreeSync:
+    def __init__(self,tree: app_commands.CommandTree,path: str):
+        self.tree = tree
+        self.path = path #JSON file of Dict ("<application id>:<scope>" -> hash)
+        self.hashes: Dict[str,str] = {}
+
+    def getHash(self,guild: discord.abc.Snowflake = None) -> str: #Hash of the commands discord would be sent for a scope
+        payload = [command.to_dict(self.tree) for command in self.tree.get_commands(guild=guild)]
+        payload.sort(key=lambda command: (command.get("type",1),command["name"]))
+        return hashlib.sha256(json.dumps(payload,sort_keys=True).encode()).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path,encoding="utf-8") as file:
+                self.hashes = json.load(file)
+        except FileNotFoundError:
+            self.hashes = {}
+        except (OSError,ValueError) as e: #Unreadable, every scope is synced again
+            log.warning("Could not read command tree hashes: %s",e)
+            self.hashes = {}
+
+    def save(self):
+        temporary = self.path + ".tmp"
+        with open(temporary,"w",encoding="utf-8") as file:
+            json.dump(self.hashes,file,indent=2)
+        os.replace(temporary,self.path)
+
+    async def sync(self,applicationId: int,guildIds: List[int] = (),force: bool = False) -> int: #Syncs every changed scope, the guilds in guildIds instead of globally if any are given. Returns how many scopes were synced
+        await asyncio.to_thread(self.load)
+        scopes = [discord.Object(id=guildId) for guildId in guildIds] + [None]
+        for guild in scopes[:-1]:
+            self.tree.copy_global_to(guild=guild) #Guild commands update at once, global ones can take an hour
+        if len(guildIds) > 0: #An empty global tree is synced, else the guilds would list every command twice
+            self.tree.clear_commands(guild=None)
+        synced = 0
+        for guild in scopes:
+            key = f"{applicationId}:{guild.id if guild != None else 'global'}"
+            commandHash = self.getHash(guild)
+            if not force and self.hashes.get(key) == commandHash:
+                log.info("Command tree of %s is unchanged, not syncing",key)
+                continue
+            commands = await self.tree.sync(guild=guild)
+            self.hashes[key] = commandHash #Only after discord accepted it, a failed sync is retried on next start
+            await asyncio.to_thread(self.save)
+            synced += 1
+            log.info("Synced %d commands to %s",len(commands),key)
+        return synced
+
+#logging
+class SessionFilter(logging.Filter): #Tags records with the session they were logged for, runs in the logging task so it sees its context
+    def filter(self,record: logging.LogRecord) -> bool:
+        if not hasattr(record,"session"): #Callers may pass extra={"session": ...} themselves
+            record.session = currentSession.get()
+        return True
+
+class JsonFormatter(logging.Formatter): #One JSON object per line, so logs can be searched by session, logger or level
+    def format(self,record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created,timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "session": getattr(record,"session",None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data,default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler): #Only puts records on a queue, the listener's thread formats and writes them
+    def prepare(self,record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__) #Copy, other handlers may still use the original
+        record.msg = record.getMessage() #Args and tracebacks may not be safe to use from another thread later
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def parseLogLevel(text: str) -> int | None: #"warning" -> logging.WARNING, None if it is not a level
+    level = logging.getLevelName(text.strip().upper())
+    return level if isinstance(level,int) else None
+
+def parseLogLevels(text: str) -> Dict[str,int]: #"ctb=INFO,discord.gateway=WARNING" -> Dict (logger -> level), entries that cannot be read are skipped with a warning
+    levels = {}
+    for item in text.split(","):
+        if item.strip() == "":
+            continue
+        name, separator, levelName = item.partition("=")
+        level = parseLogLevel(levelName)
+        if separator == "" or name.strip() == "" or level == None: #A typo should not stop the bot from starting
+            log.warning("Ignoring %r in CTB_LOG_LEVELS, expected logger=LEVEL with LEVEL one of DEBUG, INFO, WARNING, ERROR or CRITICAL",item.strip())
+            continue
+        levels[name.strip()] = level
+    return levels
+
+def setupLogging() -> logging.handlers.QueueListener: #Sends every record through a queue to a thread that writes them, start the returned listener
+    if LOG_ROTATE_WHEN != "": #Time based rotation, e.g. "midnight"
+        fileHandler = logging.handlers.TimedRotatingFileHandler(LOG_FILE,when=LOG_ROTATE_WHEN,backupCount=LOG_BACKUPS,encoding='utf-8')
+    else:
+        fileHandler = logging.handlers.RotatingFileHandler(LOG_FILE,maxBytes=LOG_MAX_BYTES,backupCount=LOG_BACKUPS,encoding='utf-8')
+    fileHandler.setFormatter(JsonFormatter())
+    consoleHandler = logging.StreamHandler()
+    consoleLevel = parseLogLevel(LOG_CONSOLE_LEVEL)
+    consoleHandler.setLevel(consoleLevel if consoleLevel != None else logging.INFO)
+    consoleHandler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s %(name)s: %(message)s"))
+
+    queueHandler = LogQueueHandler(queue.SimpleQueue())
+    queueHandler.addFilter(SessionFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG) #Loggers filter by their own level, the root lets everything they pass through
+    root.addHandler(queueHandler)
+    if consoleLevel == None:
+        log.warning("Ignoring CTB_LOG_CONSOLE_LEVEL=%r, it is not a level, using INFO",LOG_CONSOLE_LEVEL)
+    for name, level in parseLogLevels(LOG_LEVELS).items(): #After the queue handler is added, so warnings about bad entries are logged
+        logging.getLogger(name).setLevel(level)
+    return logging.handlers.QueueListener(queueHandler.queue,fileHandler,consoleHandler,respect_handler_level=True)
 
 #Bot token
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
+SCRIPTS_DIR = os.getenv('CTB_SCRIPTS_DIR','scripts') #Directory of extra edition files, watched while the bot runs
+SCRIPTS_POLL = float(os.getenv('CTB_SCRIPTS_POLL','5')) #How often (in secs) the scripts directory is checked for changes
+CHARACTER_CACHE = os.getenv('CTB_CHARACTER_CACHE','.character_cache.pickle') #Compiled character cache, skips parsing on a cold start
+JOURNAL_DIR = os.getenv('CTB_JOURNAL_DIR','journal') #Directory games are journaled to, so they can be recovered after a restart
+METRICS_HOST = os.getenv('CTB_METRICS_HOST','127.0.0.1') #Address the Prometheus metrics endpoint listens on
+METRICS_PORT = int(os.getenv('CTB_METRICS_PORT','0')) #Port of the metrics endpoint at /metrics, 0 to not serve metrics
+TRACING = os.getenv('CTB_TRACING','0') == '1' #Make an OpenTelemetry span per command, needs opentelemetry installed and configured
+COMMAND_HASHES = os.getenv('CTB_COMMAND_HASHES','.command_tree.json') #Hashes of the last synced command tree, so unchanged commands are not synced again
+SYNC_GUILDS = [int(id) for id in os.getenv('CTB_SYNC_GUILDS','').split(",") if id.strip() != ""] #Guild ids to sync commands to instead of globally, for testing changes to commands
+FORCE_SYNC = os.getenv('CTB_FORCE_SYNC','0') == '1' #Sync the command tree even if it is unchanged, e.g. after commands were removed by hand
+ROOM_ACCESS = os.getenv('CTB_ROOM_ACCESS','overwrites') #"overwrites" to open and close each private room every night and dawn, "roles" to let the Night role do it with no extra calls
+REST_GLOBAL_LIMIT = int(os.getenv('CTB_REST_GLOBAL_LIMIT','50')) #Discord calls per second across the whole bot, discord's global limit is 50
+REST_BUCKET_LIMIT = int(os.getenv('CTB_REST_BUCKET_LIMIT','0')) #Discord calls per second against one rate limit bucket, e.g. one channel or the members of one guild, 0 to leave it to discord.py's pacing from discord's rate limit headers
+GATEWAY_MODE = os.getenv('CTB_GATEWAY','slim') #"slim" to only receive the events the bot uses and cache few members, "full" for every intent and member
+LOG_FILE = os.getenv('CTB_LOG_FILE','discord.log') #JSON lines log of the bot and discord.py
+LOG_MAX_BYTES = int(os.getenv('CTB_LOG_MAX_BYTES',str(10 * 1024 * 1024))) #Size the log is rotated at
+LOG_ROTATE_WHEN = os.getenv('CTB_LOG_ROTATE_WHEN','') #Rotate by time instead of size, e.g. "midnight" or "h"
+LOG_BACKUPS = int(os.getenv('CTB_LOG_BACKUPS','5')) #Rotated logs kept
+LOG_CONSOLE_LEVEL = os.getenv('CTB_LOG_CONSOLE_LEVEL','INFO') #Lowest level also printed to the console
+LOG_LEVELS = os.getenv('CTB_LOG_LEVELS','ctb=INFO,discord=INFO,discord.gateway=WARNING') #Level of each subsystem, discord.http must stay at WARNING or lower for 429s to be counted
+
+def getMemoryUsage() -> int: #Resident memory of the bot in bytes, 0 where it cannot be read
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError,ValueError,AttributeError): #Not Linux
+        return 0
+
+def createBot(mode: str) -> commands.Bot: #The bot with the gateway intents and member cache of the mode
+    if mode == "full": #Every intent and every member of every guild, fetched at startup
+        return commands.Bot(intents=discord.Intents.all(),command_prefix="!")
+    #Slim: only the events the cog listens to, and only members in voice are cached by discord.py, players and the storyteller are kept by their GameState
+    intents = discord.Intents.none()
+    intents.guilds = True #Guilds, roles and channels
+    intents.members = True #Member updates and removals, and querying members by id
+    intents.voice_states = True #Moving players, locking public rooms
+    return commands.Bot(intents=intents,command_prefix="!",member_cache_flags=discord.MemberCacheFlags(voice=True,joined=False),chunk_guilds_at_startup=False)
 
 #Bot
-intents = discord.Intents.all()
-bot = commands.Bot(intents=intents,command_prefix="!")    
+bot = createBot(GATEWAY_MODE)
 
 class GameCommands(commands.Cog): #Cog that holds all the bots commands for running a clocktower game    
-    #locks
-    commandLock = asyncio.Lock() #Asyncio lock that handles discord command execution
-    voiceStateLock = asyncio.Lock() #Asyncio lock that handles member join channel events
-
-    gameState = GameState() # public game state
-    characterData = CharacterData('characters.xml') #public Handler reading and dsplay of character roles
-    
     def __init__(self, bot):
         self.bot = bot
+        self.characterLoader = CharacterLoader('characters.xml',SCRIPTS_DIR,CHARACTER_CACHE) #Loads the base characters and any edition scripts
+        self.characterData = self.characterLoader.load() #public Handler reading and dsplay of character roles, swapped whole when scripts change
+        self.scriptWatcher = None #Task that reloads characters when edition scripts change
+        self.recovered = False #If journaled games have been recovered, on_ready also runs on reconnects
+        self.scheduler = RestScheduler(REST_GLOBAL_LIMIT,REST_BUCKET_LIMIT) #Orders the cog's discord calls, so players are moved before channels are tidied
+        self.sessions = SessionRegistry(self.lockPublicRooms,JOURNAL_DIR,self.scheduler) #Game state and locks of each guild, commands in different guilds never wait on each other
+        self.metricsRunner = None #Runs the Prometheus metrics endpoint, None if it is not served
+        self.startupTime = None #Seconds from the bot starting to it first being ready
+        self.treeSync = None #Task syncing the command tree, started on the first ready
+
+    async def cog_load(self): #Start watching edition scripts once the cog is added
+        metrics.gauge("ctb_sessions","Guilds with a session",lambda: len(self.sessions.sessions))
+        metrics.gauge("ctb_active_games","Sessions with a game running",lambda: sum(1 for session in self.sessions.sessions.values() if session.gameState.active))
+        metrics.gauge("ctb_pending_room_locks","Public rooms waiting for their lock delay",lambda: sum(session.roomLockScheduler.getPendingCount() for session in self.sessions.sessions.values()))
+        metrics.gauge("ctb_running_votes","Votes being counted",lambda: sum(1 for session in self.sessions.sessions.values() if session.vote != None and not session.vote.finished))
+        metrics.gauge("ctb_pending_applies","Commands whose discord side has not been applied yet",lambda: sum(session.applyQueue.getPendingCount() for session in self.sessions.sessions.values()))
+        metrics.gauge("ctb_rest_queue_length","Discord calls waiting in the REST scheduler",self.scheduler.getQueueLength)
+        metrics.gauge("ctb_startup_seconds","Time from the bot starting to it first being ready",lambda: self.startupTime if self.startupTime != None else float("nan"))
+        metrics.gauge("ctb_resident_memory_bytes","Resident memory of the bot",getMemoryUsage)
+        metrics.gauge("ctb_cached_members","Members in discord.py's member cache",lambda: sum(len(guild.members) for guild in self.bot.guilds))
+        logging.getLogger("discord.http").addHandler(rateLimitCounter) #Adding the same handler twice does nothing
+        http = getattr(self.bot,"http",None)
+        if http != None and not hasattr(http,"untimedRequest"): #Time every REST call the bot makes
+            http.untimedRequest = http.request
+            http.request = self.timedRequest
+        if TRACING and trace != None:
+            metrics.tracer = trace.get_tracer("ClocktowerBot")
+        if METRICS_PORT != 0:
+            await self.startMetricsServer()
+        if SCRIPTS_DIR != None and os.path.isdir(SCRIPTS_DIR):
+            self.scriptWatcher = asyncio.create_task(self.watchCharacterScripts())
+
+    async def cog_unload(self):
+        if self.scriptWatcher != None:
+            self.scriptWatcher.cancel()
+        if self.treeSync != None:
+            self.treeSync.cancel()
+        logging.getLogger("discord.http").removeHandler(rateLimitCounter)
+        http = getattr(self.bot,"http",None)
+        if http != None and hasattr(http,"untimedRequest"):
+            http.request = http.untimedRequest
+            del http.untimedRequest
+        if self.metricsRunner != None:
+            await self.metricsRunner.cleanup()
+            self.metricsRunner = None
+        for session in self.sessions.sessions.values(): #Write out events still buffered
+            if session.journal != None:
+                await session.journal.flush()
+
+    async def timedRequest(self,route: discord.http.Route,**kwargs): #Wraps the bot's REST calls, 429 retries are inside the call so they are timed too
+        start = time.perf_counter()
+        try:
+            return await self.bot.http.untimedRequest(route,**kwargs)
+        finally:
+            metrics.observeRest(route.method,route.path,time.perf_counter() - start)
+
+    async def startMetricsServer(self): #Serves the metrics for Prometheus to scrape
+        app = web.Application()
+        app.router.add_get("/metrics",self.serveMetrics)
+        self.metricsRunner = web.AppRunner(app,access_log=None)
+        await self.metricsRunner.setup()
+        await web.TCPSite(self.metricsRunner,METRICS_HOST,METRICS_PORT).start()
+        log.info("Serving metrics on http://%s:%d/metrics",METRICS_HOST,METRICS_PORT)
+
+    async def serveMetrics(self,request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(),headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def interaction_check(self,interaction: discord.Interaction) -> bool: #Runs before every command of the cog, in the command's own task
+        currentSession.set(interaction.guild_id)
+        if interaction.type == discord.InteractionType.application_command and interaction.command != None:
+            timing = metrics.beginCommand(interaction.command.name,interaction.guild_id)
+            interaction.extras["timing"] = timing
+            currentCommand.set(timing) #Lock waits and REST calls of this task are added to the command
+        return True
+
+    def endCommandTiming(self,interaction: discord.Interaction,outcome: str): #Reports the command's timing, only the first call for an interaction counts
+        timing = interaction.extras.pop("timing",None)
+        if timing != None:
+            metrics.endCommand(timing,outcome)
+
+    @commands.Cog.listener()
+    async def on_app_command_completion(self,interaction: discord.Interaction,command: app_commands.Command):
+        self.endCommandTiming(interaction,"ok")
+
+    async def cog_app_command_error(self,interaction: discord.Interaction,error: app_commands.AppCommandError): #Not reached when a command's own error handler raises, so that handler ends the timing too
+        self.endCommandTiming(interaction,type(error).__name__)
+
+    async def watchCharacterScripts(self): #Reloads characters when scripts change, parsing runs in a worker thread so the event loop is never blocked
+        while True:
+            await asyncio.sleep(SCRIPTS_POLL)
+            try:
+                if await asyncio.to_thread(self.characterLoader.hasChanged):
+                    characterData = await asyncio.to_thread(self.characterLoader.load)
+                    self.characterData = characterData #Swapping the whole index is atomic, commands see either the old or the new one
+                    characterLog.info("Reloaded characters: %d characters in %d editions",len(characterData.records),len(characterData.byEdition))
+            except Exception:
+                characterLog.exception("Exception has occured while reloading characters")
+
+    async def queryMembers(self,guild: discord.Guild,ids: List[int]) -> List[discord.Member]: #Members by id, those not cached are asked for over the gateway 100 at a time instead of listing the guild
+        members = []
+        missing = []
+        for id in ids:
+            member = guild.get_member(id)
+            if member != None:
+                members.append(member)
+            else:
+                missing.append(id)
+        for start in range(0,len(missing),100):
+            members += await guild.query_members(user_ids=missing[start:start + 100],limit=100,cache=False) #Not cached, players are kept by their GameState
+        return members
+
+    async def refreshRoster(self,guild: discord.Guild): #Replaces the members of the game with fresh ones, e.g. after recovering them by id
+        gameState = self.sessions.getSession(guild).gameState
+        for member in await self.queryMembers(guild,gameState.getRosterIds()):
+            gameState.replaceMember(member)
+        missing = [player.member.id for player in gameState.players if isinstance(player.member,MissingMember)]
+        if len(missing) > 0: #Left the guild, they stay in the roster but are never moved or given roles
+            journalLog.warning("Players not found in guild %s: %s",guild.name,missing,extra={"session": guild.id})
+
+    async def getRoleMembers(self,guild: discord.Guild,roles: List[discord.Role],scanGuild: bool = False) -> List[discord.Member]: #Members with any of roles, unless scanGuild only members in voice or already in the game are checked
+        if scanGuild and not guild.chunked: #Lists the whole guild, one REST call per 1000 members
+            return [member async for member in guild.fetch_members(limit=None) if any(role in member.roles for role in roles)]
+        members = {member.id: member for role in roles for member in role.members} #Every member with the role if the guild is chunked, else those in voice
+        for member in await self.queryMembers(guild,self.sessions.getSession(guild).gameState.getRosterIds()):
+            if any(role in member.roles for role in roles):
+                members[member.id] = member
+        return list(members.values())
+
+    async def recoverSession(self,guild: discord.Guild): #Rebuilds the game of a guild from its journal, reattaching to its channels by id
+        session = self.sessions.getSession(guild)
+        try:
+            snapshot = await asyncio.to_thread(session.journal.load)
+            if snapshot == None:
+                return
+            session.gameState = GameState.fromSnapshot(snapshot,guild)
+            await self.refreshRoster(guild)
+            for channel in [session.gameState.channels.category] + guild.text_channels + guild.voice_channels:
+                if channel != None:
+                    session.handles.setChannel(channel)
+            journalLog.info("Recovered game in guild: %s, %d players on day %d phase %d",guild.name,len(session.gameState.players),session.gameState.gameDay,session.gameState.dayPhase,extra={"session": guild.id})
+        except Exception:
+            journalLog.exception("Could not recover game in guild: %s",guild.name,extra={"session": guild.id})
 
     @commands.Cog.listener()
+    @timedEvent
     async def on_ready(self): #On bot startup
-        print(f"Logged in as {bot.user.name}")
+        log.info("Logged in as %s",bot.user.name)
+        if self.startupTime == None:
+            self.startupTime = time.perf_counter() - STARTED_AT
+            log.info("Ready in %.2fs using %.1fMB, %s gateway, %d guilds, %d members cached",self.startupTime,getMemoryUsage() / 2**20,GATEWAY_MODE,len(self.bot.guilds),sum(len(guild.members) for guild in self.bot.guilds))
+        if not self.recovered:
+            self.recovered = True
+            for guild in self.bot.guilds:
+                if self.sessions.hasJournal(guild):
+                    await self.recoverSession(guild)
+        if self.treeSync == None: #Once per run, not on reconnects
+            self.treeSync = asyncio.create_task(self.syncCommandTree()) #In the background, commands already work while it runs
+
+    async def syncCommandTree(self): #Sync slash commands to discord if they changed
         try:
-            synced = await bot.tree.sync() #Sync slash command to the server
-            print(f"Synced {len(synced)} commands.")
-        except Exception as e:
-            print("Exception has occured while syncing tree:",e)
+            await CommandTreeSync(self.bot.tree,COMMAND_HASHES).sync(self.bot.application_id,SYNC_GUILDS,FORCE_SYNC)
+        except Exception:
+            log.exception("Exception has occured while syncing tree")
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_member_update(self,before: discord.Member,after: discord.Member): #Keep the cached member of players fresh
+        if self.sessions.hasSession(after.guild):
+            self.sessions.getSession(after.guild).gameState.updateMember(after)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_raw_member_remove(self,payload: discord.RawMemberRemoveEvent): #A player who left the guild can no longer be resolved, raw as players may not be in discord.py's member cache
+        guild = discord.Object(id=payload.guild_id)
+        if self.sessions.hasSession(guild):
+            self.sessions.getSession(guild).gameState.invalidateMember(payload.user)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_role_create(self,role: discord.Role): #Keep role handles fresh
+        if self.sessions.hasSession(role.guild):
+            self.sessions.getSession(role.guild).handles.setRole(role)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_role_update(self,before: discord.Role,after: discord.Role):
+        if self.sessions.hasSession(after.guild):
+            handles = self.sessions.getSession(after.guild).handles
+            handles.removeRole(before) #Role might have been renamed away from a bot role
+            handles.setRole(after)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_role_delete(self,role: discord.Role):
+        if self.sessions.hasSession(role.guild):
+            self.sessions.getSession(role.guild).handles.removeRole(role)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_channel_create(self,channel: discord.abc.GuildChannel): #Keep channel handles fresh
+        if self.sessions.hasSession(channel.guild):
+            self.sessions.getSession(channel.guild).handles.setChannel(channel)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_channel_update(self,before: discord.abc.GuildChannel,after: discord.abc.GuildChannel):
+        if self.sessions.hasSession(after.guild):
+            handles = self.sessions.getSession(after.guild).handles
+            handles.removeChannel(before)
+            handles.setChannel(after)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_channel_delete(self,channel: discord.abc.GuildChannel):
+        if self.sessions.hasSession(channel.guild):
+            self.sessions.getSession(channel.guild).handles.removeChannel(channel)
+
+    def getRole(self,guild: discord.Guild,role: Role) -> discord.Role | None: #Resolves a bot role through the session's handle cache
+        return self.sessions.getSession(guild).handles.getRole(guild,role)
+
+    @commands.Cog.listener()
+    @timedEvent
+    async def on_guild_remove(self,guild: discord.Guild): #Bot was removed from a guild, its session can no longer run
+        self.sessions.removeSession(guild)
 
     @app_commands.command(name="ping")
     async def ping(self,interaction: discord.Interaction): # a slash command will be created with the name "ping"
@@ -349,12 +2287,14 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.checks.has_permissions(manage_roles=True)
     @app_commands.guild_only()
     async def setupRoles(self,interaction: discord.Interaction): # create roles used by the bot if they do not exist
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
         for role in Role:
-            if get(interaction.guild.roles, name=role.value):
-                print(f"Role: {role.value} already exists")
+            if self.getRole(interaction.guild,role):
+                commandLog.info("Role: %s already exists",role.value)
             else:
-                await interaction.guild.create_role(name=role.value, colour=discord.Colour(0x0062ff))
+                created = await self.scheduler.call(RestPriority.provisioning,("roles",interaction.guild.id),interaction.guild.create_role,name=role.value,colour=discord.Colour(0x0062ff))
+                session.handles.setRole(created)
         await interaction.edit_original_response(content="Initialised roles")
      
     @app_commands.command(
@@ -365,30 +2305,31 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_permissions(manage_roles=True)
     async def setStoryTeller(self,interaction: discord.Interaction, member: discord.Member): # Set who is the storyteller for a unactive game
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True)
-        await self.commandLock.acquire()
-        if (self.gameState.active):
-            await interaction.edit_original_response(content="You cannot change the storyteller during an active game")
-            self.commandLock.release()
-        else:
-            print(member)
-            try: #Roles might not exist
-                storyRole = get(interaction.guild.roles, name=Role.storyTeller.value) #Get storyteller role from server
-                if (member in self.gameState.getPlayersAsMembers(interaction.guild)): #If new storyteller is a player
-                    playerRole = get(interaction.guild.roles, name=Role.player.value) #Get player role from server
-                    if (playerRole in member.roles):
-                        await member.remove_roles(playerRole) #Remove the role
-                    self.gameState.removePlayer(member) #remove them from player list
-                if (self.gameState.storyteller != None): #If there was a previous storyteller, remove their role
-                    await self.gameState.storyteller.remove_roles(storyRole)
-                await member.add_roles(storyRole)
-                self.gameState.setStoryTeller(member)
-                await interaction.edit_original_response(content=f"{member} is now the storyteller")
-            except Exception as e:
-                print("Exception has occured while swappign storyteller:",e)
-                await interaction.edit_original_response(content="Something went wrong swapping storytellers")
-            finally:
-                self.commandLock.release()
+        async with session.commandLock: #Only changing the game state holds the lock, roles are given after
+            if (session.gameState.active):
+                await interaction.edit_original_response(content="You cannot change the storyteller during an active game")
+                return
+            commandLog.debug("Setting storyteller: %s",member)
+            previous = session.gameState.storyteller
+            wasPlayer = member in session.gameState.getPlayersAsMembers(interaction.guild)
+            if wasPlayer: #If new storyteller is a player
+                session.gameState.removePlayer(member) #remove them from player list
+                session.record("playerRemoved",member=member.id)
+            session.gameState.setStoryTeller(member)
+            session.record("storytellerSet",member=member.id)
+
+        async def apply(): #Roles might not exist
+            storyRole = self.getRole(interaction.guild,Role.storyTeller) #Get storyteller role from server
+            playerRole = self.getRole(interaction.guild,Role.player) #Get player role from server
+            if wasPlayer and (playerRole in member.roles):
+                await self.editRoles(member.remove_roles,playerRole) #Remove the role
+            if (previous != None) and (previous != member) and not isinstance(previous,MissingMember): #If there was a previous storyteller, remove their role
+                await self.editRoles(previous.remove_roles,storyRole)
+            await self.editRoles(member.add_roles,storyRole)
+            await interaction.edit_original_response(content=f"{member} is now the storyteller")
+        self.applyLater(interaction,"set_storyteller",apply,"Something went wrong swapping storytellers")
             
     @app_commands.command(
         name="add_player",
@@ -398,28 +2339,26 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_permissions(manage_roles=True)
     async def addPlayer(self,interaction: discord.Interaction, member: discord.Member): # add one player to an active game
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True)
-        await self.commandLock.acquire()
-        if (member == self.gameState.storyteller):
-            await interaction.edit_original_response(content="You cannot make the storyteller a player")
-            self.commandLock.release()
-        elif (self.gameState.active):
-            await interaction.edit_original_response(content="You cannot add players during an active game")
-            self.commandLock.release()
-        else:
-            print(member)
-            try: #Roles might not exist
-                playerRole = get(interaction.guild.roles, name=Role.player.value) #Get player role from server
-                if not (playerRole in member.roles):
-                    await member.add_roles(playerRole) #Give them the player role if they do not have it already
-                self.gameState.addPlayer(member) #Add player to game
-                self.gameState.channelReady = False #Change of players means a new channel setup must be made
-                await interaction.edit_original_response(content=f"Added player: {member} to the game")
-            except Exception as e:
-                print("Exception has occured while assigning players:",e)
-                await interaction.edit_original_response(content="Something went wrong assigning players")
-            finally:
-                self.commandLock.release()
+        async with session.commandLock: #Only changing the game state holds the lock, the role is given after
+            if (member == session.gameState.storyteller):
+                await interaction.edit_original_response(content="You cannot make the storyteller a player")
+                return
+            if (session.gameState.active):
+                await interaction.edit_original_response(content="You cannot add players during an active game")
+                return
+            commandLog.debug("Adding player: %s",member)
+            session.gameState.addPlayer(member) #Add player to game
+            session.gameState.channelReady = False #Change of players means a new channel setup must be made
+            session.record("playerAdded",member=member.id)
+
+        async def apply(): #Roles might not exist
+            playerRole = self.getRole(interaction.guild,Role.player) #Get player role from server
+            if not (playerRole in member.roles):
+                await self.editRoles(member.add_roles,playerRole) #Give them the player role if they do not have it already
+            await interaction.edit_original_response(content=f"Added player: {member} to the game")
+        self.applyLater(interaction,"add_player",apply,"Something went wrong assigning players")
             
     @app_commands.command(
         name="remove_player",
@@ -429,25 +2368,23 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.checks.has_permissions(manage_roles=True)
     @app_commands.guild_only()
     async def removePlayer(self,interaction: discord.Interaction, member: discord.Member): # remove one player from an active game
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True)
-        await self.commandLock.acquire()
-        if (self.gameState.active):
-            await interaction.response.edit_original_response(content="You cannot remove players during an active game")
-            self.commandLock.release()
-        else:
-            print(member)
-            try: #Roles might not exist
-                playerRole = get(interaction.guild.roles, name=Role.player.value) #Get player role from server
-                if (playerRole in member.roles):
-                     await member.remove_roles(playerRole) #Remove the role
-                self.gameState.removePlayer(member) #Remove player to game
-                self.gameState.channelReady = False #Change of players means a new channel setup must be made
-                await interaction.response.edit_original_response(content=f"Removed player: {member}")
-            except Exception as e:
-                print("Exception has occured while removing players:",e)
-                await interaction.response.edit_original_response(content="Something went wrong removing players")
-            finally:
-                self.commandLock.release()
+        async with session.commandLock: #Only changing the game state holds the lock, the role is removed after
+            if (session.gameState.active):
+                await interaction.edit_original_response(content="You cannot remove players during an active game")
+                return
+            commandLog.debug("Removing player: %s",member)
+            session.gameState.removePlayer(member) #Remove player to game
+            session.gameState.channelReady = False #Change of players means a new channel setup must be made
+            session.record("playerRemoved",member=member.id)
+
+        async def apply(): #Roles might not exist
+            playerRole = self.getRole(interaction.guild,Role.player) #Get player role from server
+            if (playerRole in member.roles):
+                await self.editRoles(member.remove_roles,playerRole) #Remove the role
+            await interaction.edit_original_response(content=f"Removed player: {member}")
+        self.applyLater(interaction,"remove_player",apply,"Something went wrong removing players")
      
     @app_commands.command(
         name="show_game",
@@ -455,133 +2392,149 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     )
     @app_commands.guild_only()
     async def printGameState(self,interaction: discord.Interaction): #Print game state for testing
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True)
-        await self.commandLock.acquire()
         try:
-            embed = discord.embeds.Embed()
-            embed.colour = discord.Color.brand_red()
+            async with session.commandLock: #Only reading the game state holds the lock
+                embed = discord.embeds.Embed()
+                embed.colour = discord.Color.brand_red()
         
-            #Storyteller field
-            if (self.gameState.storyteller != None):
-                embed.add_field(name="Storyteller: ",value=f"<@{self.gameState.storyteller.id}>",inline=False)
-            else:
-                embed.add_field(name="Storyteller: ",value=f"No one is set as storyteller yet",inline=False)
+                #Storyteller field
+                if (session.gameState.storyteller != None):
+                    embed.add_field(name="Storyteller: ",value=f"<@{session.gameState.storyteller.id}>",inline=False)
+                else:
+                    embed.add_field(name="Storyteller: ",value=f"No one is set as storyteller yet",inline=False)
 
-            if (self.gameState.active == False): #If the game is not currently active
-                embed.title = f"Current Users for the next game"
+                if (session.gameState.active == False): #If the game is not currently active
+                    embed.title = f"Current Users for the next game"
             
-                #Players field
-                embed.add_field(name="**-Players-**",value="",inline=False)       
-                if (len(self.gameState.players) > 0): #We have some players set
-                    for i in range(0, len(self.gameState.players)):
-                        embed.add_field(name=f"Player {i+1}: ",value=f"<@{self.gameState.players[i].member.id}>",inline=False)
-                else: #No Players
-                    embed.add_field(name="No players have been added",value="",inline=False)
+                    #Players field
+                    embed.add_field(name="**-Players-**",value="",inline=False)       
+                    if (len(session.gameState.players) > 0): #We have some players set
+                        for i in range(0, len(session.gameState.players)):
+                            embed.add_field(name=f"Player {i+1}: ",value=f"<@{session.gameState.players[i].member.id}>",inline=False)
+                    else: #No Players
+                        embed.add_field(name="No players have been added",value="",inline=False)
                 
-                if self.gameState.channelReady:
-                    embed.set_footer(text=f"Run /start_game to start the game when ready")
-                else:
-                    embed.set_footer(text=f"Once all players and storyteller are added, run /setup_channels to prepare the game")
-            else: #If the game is active
-                embed.title = "Current game"
+                    if session.gameState.channelReady:
+                        embed.set_footer(text=f"Run /start_game to start the game when ready")
+                    else:
+                        embed.set_footer(text=f"Once all players and storyteller are added, run /setup_channels to prepare the game")
+                else: #If the game is active
+                    embed.title = "Current game"
             
-                #Players field
-                embed.add_field(name="**Players**",value="",inline=False)
-                if (len(self.gameState.players) > 0): #We have some players set
-                    for i in range(0, len(self.gameState.players)):
-                        if self.gameState.players[i].isAlive:
-                            embed.add_field(name=f"Player {i+1}: ",value=f"<@{self.gameState.players[i].member.id}> :bust_in_silhouette:",inline=False)
-                        elif self.gameState.players[i].hasGhostVote:
-                            embed.add_field(name=f"Player {i+1}: ",value=f"<@{self.gameState.players[i].member.id}> :skull::large_blue_diamond: ",inline=False)
-                        else:
-                            embed.add_field(name=f"Player {i+1}: ",value=f"<@{self.gameState.players[i].member.id}> :skull:",inline=False)
+                    #Players field
+                    embed.add_field(name="**Players**",value="",inline=False)
+                    if (len(session.gameState.players) > 0): #We have some players set
+                        for i in range(0, len(session.gameState.players)):
+                            if session.gameState.players[i].isAlive:
+                                embed.add_field(name=f"Player {i+1}: ",value=f"<@{session.gameState.players[i].member.id}> :bust_in_silhouette:",inline=False)
+                            elif session.gameState.players[i].hasGhostVote:
+                                embed.add_field(name=f"Player {i+1}: ",value=f"<@{session.gameState.players[i].member.id}> :skull::large_blue_diamond: ",inline=False)
+                            else:
+                                embed.add_field(name=f"Player {i+1}: ",value=f"<@{session.gameState.players[i].member.id}> :skull:",inline=False)
                         
-                else: #No Players
-                    embed.add_field(name="No players have been added",value="",inline=False)
+                    else: #No Players
+                        embed.add_field(name="No players have been added",value="",inline=False)
                 
-                embed.set_footer(text=f"Player list is cyclic: Player 1 and Player {len(self.gameState.players) + 1} are neighbours")
+                    embed.set_footer(text=f"Player list is cyclic: Player 1 and Player {len(session.gameState.players) + 1} are neighbours")
             await interaction.edit_original_response(embed=embed)
-        except Exception as e:
-             print("Exception has occured while printing game state:",e)
+        except Exception:
+             commandLog.exception("Exception has occured while printing game state")
              await interaction.edit_original_response(content="Something went wrong")
-        finally:
-            self.commandLock.release()
     
     @app_commands.command(
         name="sync_roles",
         description="Syncs the bot to the bot-specific roles on the server and removes excess roles",
     )
+    @app_commands.describe(scan_guild="Check every member of the server, not only those in voice or already in the game")
     @app_commands.checks.has_permissions(manage_roles=True)
     @app_commands.guild_only()
-    async def syncRoles(self,interaction: discord.Interaction): #Sync the discord roles to the bots game state, if possible
+    async def syncRoles(self,interaction: discord.Interaction,scan_guild: bool = False): #Sync the discord roles to the bots game state, if possible
+        session = self.sessions.getSession(interaction.guild)
     
         await interaction.response.defer(thinking=True)
-        await self.commandLock.acquire()
-        if self.gameState.active: #Changing the playlist mid-game will break things
+        if session.gameState.active: #Changing the playlist mid-game will break things
             await interaction.edit_original_response(content="You cannot change the game's state while a match is active")
-            self.commandLock.release()
-        else:
-            try: #Roles might not exist or calling members may fail
-                memberList = interaction.guild.fetch_members() #Get all the servers members, might be dangerous but this bot has a limited scope in users
-                newGameState = GameState()
-                playerRole = get(interaction.guild.roles, name=Role.player.value) #Get player role from server
-                storyRole = get(interaction.guild.roles, name=Role.storyTeller.value) #Get storyteller role from server
-                async for member in memberList:
-                    if (storyRole in member.roles) and (playerRole in member.roles): #A user is both storyteller and player
-                        await interaction.edit_original_response(content=f"{member} cannot be both a player and a storyteller")
-                        return
-                    if (storyRole in member.roles) and (newGameState.storyteller != None): #If a user is set as storyteller while another is a storyteller
-                        await interaction.edit_original_response(content=f"{member} and {newGameState.storyteller} cannot be both be storytellers")
-                        return
-                    if playerRole in member.roles:
-                        newGameState.addPlayer(member)
-                    if storyRole in member.roles:
-                        newGameState.setStoryTeller(member)
-                    
-                self.gameState = newGameState #Update gamestate
-                self.gameState.channelReady = False #Change of players means a new channel setup must be made
+            return
+        try: #Roles might not exist or calling members may fail
+            newGameState = GameState()
+            playerRole = self.getRole(interaction.guild,Role.player) #Get player role from server
+            storyRole = self.getRole(interaction.guild,Role.storyTeller) #Get storyteller role from server
+            for member in await self.getRoleMembers(interaction.guild,[playerRole,storyRole],scan_guild): #Members are gathered without the lock, it can take many gateway requests
+                if (storyRole in member.roles) and (playerRole in member.roles): #A user is both storyteller and player
+                    await interaction.edit_original_response(content=f"{member} cannot be both a player and a storyteller")
+                    return
+                if (storyRole in member.roles) and (newGameState.storyteller != None): #If a user is set as storyteller while another is a storyteller
+                    await interaction.edit_original_response(content=f"{member} and {newGameState.storyteller} cannot be both be storytellers")
+                    return
+                if playerRole in member.roles:
+                    newGameState.addPlayer(member)
+                if storyRole in member.roles:
+                    newGameState.setStoryTeller(member)
+                
+            async with session.commandLock:
+                if session.gameState.active: #A game started while members were gathered
+                    await interaction.edit_original_response(content="You cannot change the game's state while a match is active")
+                    return
+                session.gameState = newGameState #Update gamestate
+                session.gameState.channelReady = False #Change of players means a new channel setup must be made
+                session.snapshot() #The whole roster changed at once
+            if scan_guild or interaction.guild.chunked:
                 await interaction.edit_original_response(content=f"Synced member roles to the bot successfully")
-            except Exception as e:
-                print("Exception has occured while syncing player roles:",e)
-                await interaction.edit_original_response(content="Something went wrong syncing roles")
-            finally:
-                self.commandLock.release()
+            else:
+                await interaction.edit_original_response(content=f"Synced member roles to the bot successfully, only members in voice or already in the game were checked: use scan_guild to check everyone")
+        except Exception:
+            commandLog.exception("Exception has occured while syncing player roles")
+            await interaction.edit_original_response(content="Something went wrong syncing roles")
             
-    async def createStoryText(self,interaction: discord.Interaction): #Create storyteller text channel
-        storyRole = get(interaction.guild.roles, name=Role.storyTeller.value) #Get storyteller role from server
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            storyRole: discord.PermissionOverwrite(read_messages=True)
-        }
-        self.gameState.channels.storytellerText = await interaction.guild.create_text_channel(name=ChannelNames.storytellerText.value, overwrites=overwrites, category=self.gameState.channels.category)
+    def getOverwrites(self,guild: discord.Guild,kind: str,state: str = None,owner: discord.Member = None) -> dict: #Overwrites a kind of channel should have in a state, resolved against the guild
+        template = dict(OVERWRITE_TEMPLATES[kind])
+        template.update(STATE_OVERWRITES.get((kind,state),{}))
+        overwrites = {}
+        for target, overwrite in template.items():
+            if target == EVERYONE:
+                overwrites[guild.default_role] = overwrite
+            elif target == OWNER:
+                overwrites[owner] = overwrite
+            else:
+                overwrites[self.getRole(guild,target)] = overwrite
+        return overwrites
+
+    async def applyOverwrites(self,channel: discord.abc.GuildChannel,overwrites: dict,priority: RestPriority = RestPriority.voice) -> bool: #Replaces all of a channel's overwrites in one edit, only if they differ. Returns if an edit was made
+        if ChannelProvisioner.overwritesMatch(channel.overwrites,overwrites):
+            return False
+        await self.scheduler.call(priority,("channel",channel.id),channel.edit,overwrites=overwrites)
+        return True
+
+    def applyLater(self,interaction: discord.Interaction,name: str,job,failure: str = "Something went wrong"): #Queues job() on the session's apply queue, answering the command with failure if it raises
+        session = self.sessions.getSession(interaction.guild)
+        async def run():
+            try:
+                await job()
+            except Exception:
+                commandLog.exception("Exception has occured while applying %s",name)
+                await interaction.edit_original_response(content=failure)
+        session.applyQueue.submit(name,run)
+
+    async def editRoles(self,edit,*roles: discord.Role): #Makes a member.add_roles or member.remove_roles call through the scheduler
+        await self.scheduler.call(RestPriority.roles,("members",edit.__self__.guild.id),edit,*roles)
+
+    async def announce(self,guild: discord.Guild,message: str): #Sends a message to the town, after players have been moved
+        channel = self.sessions.getSession(guild).gameState.channels.getTownText()
+        await self.scheduler.call(RestPriority.announcement,("channel",channel.id),channel.send,message)
+
+    def getStoryTextSpec(self,guild: discord.Guild) -> ChannelSpec: #Storyteller text channel
+        return ChannelSpec(ChannelNames.storytellerText.value,discord.ChannelType.text,self.getOverwrites(guild,"storytellerText"),"storytellerText")
     
-    async def createStoryVoice(self,interaction: discord.Interaction): #Create storyteller voice channel
-        storyRole = get(interaction.guild.roles, name=Role.storyTeller.value) #Get storyteller role from server
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            storyRole: discord.PermissionOverwrite(read_messages=True)
-        }
-        self.gameState.channels.storytellerVoice = await interaction.guild.create_voice_channel(name=ChannelNames.storytellerVoice.value, overwrites=overwrites, category=self.gameState.channels.category)
+    def getStoryVoiceSpec(self,guild: discord.Guild) -> ChannelSpec: #Storyteller voice channel
+        return ChannelSpec(ChannelNames.storytellerVoice.value,discord.ChannelType.voice,self.getOverwrites(guild,"storytellerVoice"),"storytellerVoice")
     
-    async def createTownText(self,interaction: discord.Interaction): #Create hub voice channel
-        dayRole = get(interaction.guild.roles, name=Role.day.value) #Get day role from server
-        storyRole = get(interaction.guild.roles, name=Role.storyTeller.value)
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(read_messages=True,send_messages=False),
-            dayRole: discord.PermissionOverwrite(send_messages=True),
-            storyRole: discord.PermissionOverwrite(send_messages=True)
-        }
-        self.gameState.channels.townText = await interaction.guild.create_text_channel(name=ChannelNames.townText.value, overwrites=overwrites, category=self.gameState.channels.category)
+    def getTownTextSpec(self,guild: discord.Guild) -> ChannelSpec: #Hub text channel
+        return ChannelSpec(ChannelNames.townText.value,discord.ChannelType.text,self.getOverwrites(guild,"townText"),"townText")
     
-    async def createTownVoice(self,interaction: discord.Interaction): #Create hub text channel
-        dayRole = get(interaction.guild.roles, name=Role.day.value) #Get day role from server
-        storyRole = get(interaction.guild.roles, name=Role.storyTeller.value)
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            dayRole: discord.PermissionOverwrite(read_messages=True),
-            storyRole: discord.PermissionOverwrite(read_messages=True)
-        }
-        self.gameState.channels.townVoice = await interaction.guild.create_voice_channel(name=ChannelNames.townVoice.value, overwrites=overwrites, category=self.gameState.channels.category)
+    def getTownVoiceSpec(self,guild: discord.Guild) -> ChannelSpec: #Hub voice channel
+        return ChannelSpec(ChannelNames.townVoice.value,discord.ChannelType.voice,self.getOverwrites(guild,"townVoice"),"townVoice")
 
     def getInitRoomName(self,playerNumber: int): #Returns the name of a private room that should be used to create a players room
         #Names used for each players private room
@@ -604,37 +2557,28 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
             name += str(playerNumber // len(privateRoomNames)) #Append a unique number to it (e.g. Blue Room 2)
         return name
     
-    async def createPrivateVoice(self,interaction: discord.Interaction, players: List[discord.Member]): #Create private rooms for each player
-        storyRole = get(interaction.guild.roles, name=Role.storyTeller.value)
+    def getPrivateVoiceSpecs(self,guild: discord.Guild, players: List[discord.Member]) -> List[ChannelSpec]: #Private rooms for each player
+        kind = "roleGatedPrivateRooms" if self.sessions.getSession(guild).gameState.roleGatedRooms else "privateRooms"
+        specs = []
         for i in range(0,len(players)):
-            overwrites = {
-                interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-                players[i]: discord.PermissionOverwrite(read_messages=True),
-                storyRole: discord.PermissionOverwrite(read_messages=True)
-            }
-            room = await interaction.guild.create_voice_channel(name=self.getInitRoomName(i), overwrites=overwrites, category=self.gameState.channels.category)
-            self.gameState.channels.addPrivateRoom(room) # Add channel to channels
-            self.gameState.addPrivateRoom(players[i],room) # pair player to channel
+            overwrites = self.getOverwrites(guild,kind,owner=players[i])
+            specs.append(ChannelSpec(self.getInitRoomName(i),discord.ChannelType.voice,overwrites,"privateRooms",players[i]))
+        return specs
         
-    async def createPublicVoice(self,interaction: discord.Interaction,count=8): #Creates the given amount of public rooms
-        storyRole = get(interaction.guild.roles, name=Role.storyTeller.value)
-        roamRole = get(interaction.guild.roles, name=Role.roam.value)
+    def getPublicVoiceSpecs(self,guild: discord.Guild,count=8) -> List[ChannelSpec]: #The given amount of public rooms
+        overwrites = self.getOverwrites(guild,"publicRooms")
+        specs = []
         for i in range(0,count):
-            overwrites = {
-                interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False,connect=False),
-                roamRole: discord.PermissionOverwrite(read_messages=True,connect=True),
-                storyRole: discord.PermissionOverwrite(read_messages=True,connect=True)
-            }
-            room = await interaction.guild.create_voice_channel(name=ChannelNames.dayRooms.value[i], overwrites=overwrites, category=self.gameState.channels.category)
-            self.gameState.channels.addPublicRoom(room)
-
-    def setupChannelLocks(self,channels: List[discord.VoiceChannel]):
+            specs.append(ChannelSpec(ChannelNames.dayRooms.value[i],discord.ChannelType.voice,overwrites,"publicRooms"))
+        return specs
+
+    def setupChannelLocks(self,gameState: GameState,channels: List[discord.VoiceChannel]):
         roomLock = {}
         roomMembers = {}
         for channel in channels:
             roomLock[channel] = False
             roomMembers[channel] = []
-        self.gameState.channelLocks = ChannelLocks(roomLock,roomMembers)
+        gameState.channelLocks = ChannelLocks(roomLock,roomMembers)
 
     @app_commands.command(
         name="setup_channels",
@@ -643,239 +2587,208 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.checks.has_permissions(manage_roles=True)
     @app_commands.guild_only()
     async def setupChannels(self,interaction: discord.Interaction): #Creates the text and voice channels for the bot#
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
-        if self.gameState.active:
-            await interaction.edit_original_response(content=f"Cannot setup channels during an active game")
-            self.commandLock.release()
-            return
-        if self.gameState.getPlayersAsMembers(interaction.guild) == []:
-            await interaction.edit_original_response(content=f"Cannot setup channels with no added players")
-            self.commandLock.release()
-            return
-        try:
-            category = get(interaction.guild.categories,name=ChannelNames.category.value)
-            if category: # If category already exists delete it adn its channels
-                print(f"Category already exists, delete all channels inside and it")
-                channels = category.channels
-                for channel in channels:
-                    await channel.delete()
-                await category.delete()
-            
-            #Create category
-            self.gameState.channels.category = await interaction.guild.create_category(ChannelNames.category.value)
-
-            #Create the channels needed for the game to run
-            await self.createStoryText(interaction)
-            await self.createStoryVoice(interaction)
-            await self.createTownText(interaction)
-            await self.createTownVoice(interaction)
-            await self.createPublicVoice(interaction,8)
-            await self.createPrivateVoice(interaction,self.gameState.getPlayersAsMembers(interaction.guild))
+        async with session.commandLock: #Only reading the roster holds the lock, the channels are made after
+            if session.gameState.active:
+                await interaction.edit_original_response(content=f"Cannot setup channels during an active game")
+                return
+            players = session.gameState.getPlayersAsMembers(interaction.guild)
+            if players == []:
+                await interaction.edit_original_response(content=f"Cannot setup channels with no added players")
+                return
+            gameState = session.gameState
+            roster = gameState.getRosterIds()
+            gameState.channelReady = False #No game can start until the new channels are stored
+        await interaction.edit_original_response(content=f"Setting up channels for {len(players)} players")
+        self.applyLater(interaction,"setup_channels",lambda: self.provisionChannels(interaction,gameState,roster,players),"Something went setting up channels")
+
+    async def provisionChannels(self,interaction: discord.Interaction,gameState: GameState,roster: List[int],players: List[discord.Member]): #Makes the channels of a game and stores them if the players have not changed since
+        guild = interaction.guild
+        session = self.sessions.getSession(guild)
+        category = session.handles.getChannel(guild,ChannelNames.category.value)
+        if category == None: #Reuse the category and its channels if it already exists
+            category = await self.scheduler.call(RestPriority.provisioning,("channels",guild.id),guild.create_category,ChannelNames.category.value)
+
+        #The channels needed for the game to run, in the order they are shown
+        specs = [self.getStoryTextSpec(guild),self.getStoryVoiceSpec(guild),self.getTownTextSpec(guild),self.getTownVoiceSpec(guild)]
+        specs += self.getPublicVoiceSpecs(guild,8)
+        specs += self.getPrivateVoiceSpecs(guild,players)
+
+        provisioner = ChannelProvisioner(gameState.transitionConcurrency,self.scheduler)
+        placed = await provisioner.apply(guild,category,specs)
+
+        async with session.commandLock:
+            if session.gameState is not gameState or gameState.getRosterIds() != roster or gameState.active: #Players changed while the channels were made
+                await interaction.edit_original_response(content=f"The players changed while channels were set up, run /setup_channels again")
+                return
+            #Store the channels, a fresh GameChannels so rooms from a previous setup are not kept
+            gameState.channels = GameChannels()
+            gameState.channels.category = category
+            gameState.playerChannelDict = {}
+            session.handles.setChannel(category)
+            for spec, channel in placed:
+                session.handles.setChannel(channel)
+                if spec.slot == "publicRooms":
+                    gameState.channels.addPublicRoom(channel)
+                elif spec.slot == "privateRooms":
+                    gameState.channels.addPrivateRoom(channel) # Add channel to channels
+                    gameState.addPrivateRoom(spec.player,channel) # pair player to channel
+                else:
+                    setattr(gameState.channels,spec.slot,channel)
         
-            self.setupChannelLocks(self.gameState.channels.publicRooms)
+            self.setupChannelLocks(gameState,gameState.channels.publicRooms)
         
-            self.gameState.channelReady = True
-            await interaction.edit_original_response(content=f"Succesfully created channels")
-        except Exception as e:
-            print("Exception has occured while setting up channels:",e)
-            self.gameState.channelReady = False
-            await interaction.edit_original_response(content=f"Something went setting up channels")
-        finally:
-            self.commandLock.release()
+            gameState.channelReady = True
+            snapshot = gameState.toSnapshot()
+            session.record("channelsReady",channels=snapshot["channels"],privateRooms=snapshot["privateRooms"],roleGatedRooms=snapshot["roleGatedRooms"])
+        await interaction.edit_original_response(content=f"Succesfully set up channels: {provisioner.summary()}")
     
-    """
-    Sets the roles of a list of users
-    guild - guild of the sver
-    members - memers to change roles of
-    roles - The bot specific roles to set to
-    """
-    async def setRoles(self,guild:discord.Guild, members: List[discord.Member], roles: List[discord.Member]):
-        try:
-            excessRoleList = [
-                get(guild.roles, name=Role.alive.value),
-                get(guild.roles, name=Role.dead.value),
-                get(guild.roles, name=Role.day.value),
-                get(guild.roles, name=Role.night.value),
-                get(guild.roles, name=Role.roam.value),
-            ]
-            for member in members:
-                newRoles = member.roles
-                for role in excessRoleList:
-                    if (role in newRoles):
-                        newRoles.remove(role)
-                for role in roles:
-                    if not (role in newRoles):
-                        newRoles.append(role)
-                print(f"user: {member} roles {roles}")
-                await member.edit(roles=newRoles)
-        
-        except Exception as e:
-            raise e
-    
-    async def alivePlayers(self,guild: discord.Guild, members: List[discord.Member]): #give players the alive role, remove dead role if they have it
-        try: #Roles might not exist or calling members may fail
-            aliveRole = get(guild.roles, name=Role.alive.value)
-            deadRole = get(guild.roles, name=Role.dead.value)
-            for member in members:
-                roles = member.roles
-                if deadRole in roles:
-                    roles.remove(deadRole)
-                if not (aliveRole in member.roles):
-                    roles.append(aliveRole)
-                await member.edit(roles=roles)
-        except Exception as e:
-            raise e
-    
-    async def killPlayers(self,guild: discord.Guild, members: List[discord.Member]): #give players the dead role, remove alive role if they have it
-        try: #Roles might not exist or calling members may fail
-            aliveRole = get(guild.roles, name=Role.alive.value)
-            deadRole = get(guild.roles, name=Role.dead.value)
-            for member in members:
-                roles = member.roles
-                if aliveRole in roles:
-                    roles.remove(aliveRole)
-                if not (deadRole in member.roles):
-                    roles.append(deadRole)
-                await member.edit(roles=roles)
-        except Exception as e:
-            raise e
-    
-    async def unlockPlayersPrivateRoom(self,guild: discord.Guild ,members: List[discord.Member]): #Give players permission to enter their private room
-        try: #Roles might not exist or calling members may fail
-            for member in members:
-                privateRoom = self.gameState.getRoomOfPlayer(member) #player's private channel
-                await privateRoom.set_permissions(member,read_messages=True)
-        except Exception as e:
-            raise e
-    
-    async def lockPlayersPrivateRoom(self,guild: discord.Guild,members: List[discord.Member]): #Remove players permission to enter their private room
-        try: #Roles might not exist or calling members may fail
-            for member in members:
-                privateRoom = self.gameState.getRoomOfPlayer(member) #player's private channel
-                await privateRoom.set_permissions(member,read_messages=False)
-        except Exception as e:
-            raise e
-
-    async def sendPlayersToPrivateRoom(self,guild: discord.Guild, members: List[discord.Member]): #give players the Night role, remove day and roam roles and send them to their private room
-        try: #Roles might not exist or calling members may fail
-            dayRole = get(guild.roles, name=Role.day.value)
-            nightRole = get(guild.roles, name=Role.night.value)
-            roamRole = get(guild.roles, name=Role.roam.value)
-
-            #Players need to be able to access their room to be sent to it
-            await self.unlockPlayersPrivateRoom(guild,members)        
-        
-            for member in members:
-                roles = member.roles
-                if dayRole in roles:
-                    roles.remove(dayRole)
-                if roamRole in roles:
-                    roles.remove(roamRole)
-                if not (nightRole in roles):
-                    roles.append(nightRole)
-                await member.edit(roles=roles) #You must add roles atmoically or errors occour, it sucks
-        except Exception as e:
-            raise e
+    def reconcileRolesStep(self,guild: discord.Guild,desiredRoles: Dict[int,List[Role]] = None) -> TransitionStep: #Step that brings a players bot roles in line with desiredRoles (the game state now if None) with at most one edit
+        session = self.sessions.getSession(guild)
+        reconciler = RoleReconciler(guild,session.handles) #Resolve roles once for the whole transition
+        if desiredRoles == None:
+            desiredRoles = session.gameState.getDesiredRoleMap()
+        async def action(member: discord.Member,send):
+            member = await self.getCurrentMember(guild,member,send) #Roles may have been changed by someone else since the member was stored
+            roles = reconciler.getRoleEdit(desiredRoles,member)
+            if roles == None: #Already has the right roles, no call needed
+                return False
+            edited = await send(member.edit,roles=roles) #You must add roles atmoically or errors occour, it sucks
+            if edited != None: #The edited member, the one edited is not updated by discord.py
+                session.gameState.updateMember(edited)
+        return TransitionStep("roles",lambda member: ("members",guild.id),action,RestPriority.roles)
+
+    async def getCurrentMember(self,guild: discord.Guild,member: discord.Member,send) -> discord.Member: #The member with its current roles, fetched with send(function, *args) if discord.py does not keep it up to date
+        cached = guild.get_member(member.id)
+        if cached != None: #Members in discord.py's cache get their member updates
+            return cached
+        fetched = await send(guild.fetch_member,member.id) #Not cached (e.g. not in voice with the slim gateway), its updates are dropped so the stored member may be stale
+        self.sessions.getSession(guild).gameState.updateMember(fetched)
+        return fetched
+
+    async def reconcilePlayerRoles(self,guild: discord.Guild, members: List[discord.Member],desiredRoles: Dict[int,List[Role]] = None) -> TransitionPlan: #Sets players roles to match desiredRoles (the game state now if None), skipping players already matching
+        return await self.runPlayerSteps(guild,members,[self.reconcileRolesStep(guild,desiredRoles)])
     
+    def setPlayersAlive(self,session: GameSession, members: List[discord.Member], alive: bool): #Mark players as alive or dead, their alive and dead roles are reconciled after
         for member in members:
-            try: #Try to move them from current vc to new vc, fails is user is in no vc
-                privateRoom = self.gameState.getRoomOfPlayer(member) #player's private channel
-                await member.move_to(privateRoom) #move them to their channel 
-            except Exception as e:
-                print(e)
+            player = session.gameState.getPlayer(member)
+            if player != None:
+                player.setIsAlive(alive)
+                session.record("revived" if alive else "killed",member=member.id)
     
-    async def movePlayersToPrivateRoom(self,guild: discord.Guild, members: List[discord.Member]): #move players to their private room without changing roles
-        #Players need to be able to access their room to be sent to it
-        await self.unlockPlayersPrivateRoom(guild,members)    
-
-        for member in members:
-            try: #Try to move them from current vc to new vc, fails is user is in no vc
-                privateRoom = self.gameState.getRoomOfPlayer(member) #player's private channel
-                await member.move_to(privateRoom) #move them to their channel 
-            except Exception as e:
-                print(e)
-
-    async def sendPlayersToTown(self,guild: discord.Guild, members: List[discord.Member]): #Give players the Day Role, remove night and roam roles and force them into town
-        try: #Roles might not exist or calling members may fail
-            dayRole = get(guild.roles, name=Role.day.value)
-            nightRole = get(guild.roles, name=Role.night.value)
-            roamRole = get(guild.roles, name=Role.roam.value)
-
-            #Players should be blocked from their rooms
-            await self.lockPlayersPrivateRoom(guild, members)        
-
-            for member in members:
-                roles = member.roles
-                if nightRole in roles:
-                    roles.remove(nightRole)
-                if roamRole in roles:
-                    roles.remove(roamRole)
-                if not (dayRole in roles):
-                    roles.append(dayRole)
-                await member.edit(roles=roles) #You must add roles atmoically or eronious errors occour, it sucks I hate asynchronous programming
-        except Exception as e:
-            raise e
+    def getPrivateRoomSteps(self,guild: discord.Guild,state: str) -> List[TransitionStep]: #Steps opening or closing private rooms, none if the Night role already does it
+        if self.sessions.getSession(guild).gameState.roleGatedRooms:
+            return []
+        return [self.privateRoomStep(guild,state)]
+
+    def privateRoomStep(self,guild: discord.Guild,state: str) -> TransitionStep: #Step that gives a players private room its overwrites for state, "night" lets them in and "day" keeps them out
+        gameState = self.sessions.getSession(guild).gameState
+        async def action(member: discord.Member,send):
+            room = gameState.getRoomOfPlayer(member)
+            overwrites = self.getOverwrites(guild,"privateRooms",state,member)
+            if ChannelProvisioner.overwritesMatch(room.overwrites,overwrites): #Already right, e.g. a retried transition
+                return False
+            await send(room.edit,overwrites=overwrites)
+        return TransitionStep("room",lambda member: ("channel",gameState.getRoomOfPlayer(member).id),action,RestPriority.voice) #The move after it waits on it, so it must not queue behind provisioning
+
+    def moveStep(self,guild: discord.Guild,destination) -> TransitionStep: #Step that moves a player to destination(member) if they are in a voice channel
+        async def action(member: discord.Member,send):
+            if member.voice == None or member.voice.channel == destination(member): #Discord can only move members who are connected to voice
+                return False
+            await send(member.move_to,destination(member))
+        return TransitionStep("move",lambda member: ("members",guild.id),action,RestPriority.voice)
+
+    async def runPlayerSteps(self,guild: discord.Guild,members: List[discord.Member],steps: List[TransitionStep]) -> TransitionPlan: #Runs the steps for all players at once
+        session = self.sessions.getSession(guild)
+        return await session.transitionEngine.run(members,steps,session.gameState.transitionConcurrency)
+
+    async def resumePlayerMovement(self,guild: discord.Guild) -> TransitionPlan: #Retries only the failed and pending steps of the current phase's transition, or runs it again if it went through
+        session = self.sessions.getSession(guild)
+        plan = session.transitionPlan
+        if plan == None or plan.phase != session.gameState.getTime() or plan.isSuccess(): #Nothing to resume, players may have wandered off since
+            return await self.handlePlayerMovement(guild)
+        members = []
+        for member in session.gameState.getPlayersAsMembers(guild): #The stored members may be stale, take the ones discord.py keeps up to date where it has them
+            cached = guild.get_member(member.id)
+            members.append(cached if cached != None else member) #The role step fetches the others before checking them
+        plan.steps = [self.reconcileRolesStep(guild) if step.name == "roles" else step for step in plan.steps] #Roles as the game has them now, e.g. a player was killed since
+        plan = await session.transitionEngine.resume(plan,members,session.gameState.transitionConcurrency)
+        metrics.observeTransition(session.gameState.getDayPhaseName(),plan.getCallCount())
+        return plan
+
+    async def sendPlayersToPrivateRoom(self,guild: discord.Guild, members: List[discord.Member],desiredRoles: Dict[int,List[Role]] = None) -> TransitionPlan: #give players the Night role, remove day and roam roles and send them to their private room
+        session = self.sessions.getSession(guild)
+        return await self.runPlayerSteps(guild,members,self.getPrivateRoomSteps(guild,"night") + [ #Players need to be able to access their room to be sent to it
+            self.reconcileRolesStep(guild,desiredRoles), #Gives the Night role, which opens their room if rooms are role gated
+            self.moveStep(guild,session.gameState.getRoomOfPlayer),
+        ])
     
-        town = self.gameState.channels.townVoice
-        for member in members:
-            try: #Try to move them from current vc to new vc, fails is user is in no vc
-                await member.move_to(town) #move them to their channel 
-            except Exception as e:
-                print(e)
+    async def movePlayersToPrivateRoom(self,guild: discord.Guild, members: List[discord.Member]) -> TransitionPlan: #move players to their private room without changing roles
+        session = self.sessions.getSession(guild)
+        return await self.runPlayerSteps(guild,members,self.getPrivateRoomSteps(guild,"night") + [ #Players need to be able to access their room to be sent to it
+            self.moveStep(guild,session.gameState.getRoomOfPlayer),
+        ])
+
+    async def sendPlayersToTown(self,guild: discord.Guild, members: List[discord.Member],desiredRoles: Dict[int,List[Role]] = None) -> TransitionPlan: #Give players the Day Role, remove night and roam roles and force them into town
+        session = self.sessions.getSession(guild)
+        town = session.gameState.channels.townVoice
+        return await self.runPlayerSteps(guild,members,self.getPrivateRoomSteps(guild,"day") + [ #Players should be blocked from their rooms
+            self.reconcileRolesStep(guild,desiredRoles),
+            self.moveStep(guild,lambda member: town),
+        ])
             
-    async def movePlayersToTown(self,guild: discord.Guild, members: List[discord.Member]): #Moves players to townsquare without chaing their perms
-        town = self.gameState.channels.townVoice
-        for member in members:
-            try: #Try to move them from current vc to new vc, fails is user is in no vc
-                await member.move_to(town) #move them to their channel 
-            except Exception as e:
-                print(e)    
+    async def movePlayersToTown(self,guild: discord.Guild, members: List[discord.Member]) -> TransitionPlan: #Moves players to townsquare without chaing their perms
+        session = self.sessions.getSession(guild)
+        town = session.gameState.channels.townVoice
+        return await self.runPlayerSteps(guild,members,[self.moveStep(guild,lambda member: town)])
             
-    async def movePlayersToStorytellerPrivate(self,guild: discord.Guild, members: List[discord.Member]):#Moves players to storytellers corner
-        corner = self.gameState.channels.storytellerVoice
-        for member in members:
-            try: #Try to move them from current vc to new vc, fails is user is in no vc
-                await member.move_to(corner) #move them to their channel 
-            except Exception as e:
-                print(e)  
-
-    async def allowPlayersRoam(self,guild: discord.Guild, members: List[discord.Member]): #Give players the Roam role, lets them visit public rooms
-        try:
-            roamRole = get(guild.roles, name=Role.roam.value)
-            for member in members:
-                print(f"user: {member} roles {member.roles}")
-                if not (roamRole in member.roles):
-                    await member.add_roles(roamRole)
-        except Exception as e:
-            raise e
+    async def movePlayersToStorytellerPrivate(self,guild: discord.Guild, members: List[discord.Member]) -> TransitionPlan: #Moves players to storytellers corner
+        session = self.sessions.getSession(guild)
+        corner = session.gameState.channels.storytellerVoice
+        return await self.runPlayerSteps(guild,members,[self.moveStep(guild,lambda member: corner)])
+
+    async def allowPlayersRoam(self,guild: discord.Guild, members: List[discord.Member],desiredRoles: Dict[int,List[Role]] = None) -> TransitionPlan: #Bring players to town and give them the Roam role, lets them visit public rooms
+        session = self.sessions.getSession(guild)
+        town = session.gameState.channels.townVoice
+        return await self.runPlayerSteps(guild,members,[
+            self.moveStep(guild,lambda member: town),
+            self.reconcileRolesStep(guild,desiredRoles),
+        ])
     
-    async def denyPlayersRoam(self,guild: discord.Guild, members: List[discord.Member]): #Remove player(s)'s Roam role if they have it, denying them from public rooms
-        try:
-            roamRole = get(guild.roles, name=Role.roam.value)
-            for member in members:
-                print(f"user: {member} roles {member.roles}")
-                if roamRole in member.roles:
-                    await member.remove_roles(roamRole)
-        except Exception as e:
-            raise e
+    async def denyPlayersRoam(self,guild: discord.Guild, members: List[discord.Member],desiredRoles: Dict[int,List[Role]] = None) -> TransitionPlan: #Bring players to town and remove their Roam role, denying them from public rooms
+        session = self.sessions.getSession(guild)
+        town = session.gameState.channels.townVoice
+        return await self.runPlayerSteps(guild,members,[
+            self.moveStep(guild,lambda member: town),
+            self.reconcileRolesStep(guild,desiredRoles),
+        ])
     
-    async def handlePlayerMovement(self,guild: discord.guild): #Handles player movement based on the phase of the game
-        if self.gameState.dayPhase == 0: #Night movement, send to private room
-            await self.sendPlayersToPrivateRoom(guild,self.gameState.getPlayersAsMembers(guild))
-        elif self.gameState.dayPhase == 1: #Dawn movement, bring to town, announce night actions
-            await self.sendPlayersToTown(guild,self.gameState.getPlayersAsMembers(guild))
-        elif self.gameState.dayPhase == 2: #Midday movement, allow players to privately talk
-            await self.movePlayersToTown(guild,self.gameState.getPlayersAsMembers(guild))
-            await self.allowPlayersRoam(guild,self.gameState.getPlayersAsMembers(guild))
-        elif self.gameState.dayPhase == 3: #Dusk movement, deny players private talk, bring to town for nominations
-            await self.movePlayersToTown(guild,self.gameState.getPlayersAsMembers(guild))
-            await self.denyPlayersRoam(guild,self.gameState.getPlayersAsMembers(guild))
+    async def handlePlayerMovement(self,guild: discord.guild,members: List[discord.Member] = None,phase: Tuple[int,int] = None,desiredRoles: Dict[int,List[Role]] = None) -> TransitionPlan: #Handles player movement based on the phase of the game, or of the roster, phase and roles taken when the change was queued
+        session = self.sessions.getSession(guild)
+        if members == None:
+            members = session.gameState.getPlayersAsMembers(guild)
+        if phase == None:
+            phase = session.gameState.getTime()
+        dayPhase = phase[1]
+        if dayPhase == 0: #Night movement, send to private room
+            report = await self.sendPlayersToPrivateRoom(guild,members,desiredRoles)
+        elif dayPhase == 1: #Dawn movement, bring to town, announce night actions
+            report = await self.sendPlayersToTown(guild,members,desiredRoles)
+        elif dayPhase == 2: #Midday movement, allow players to privately talk
+            report = await self.allowPlayersRoam(guild,members,desiredRoles)
+        elif dayPhase == 3: #Dusk movement, deny players private talk, bring to town for nominations
+            report = await self.denyPlayersRoam(guild,members,desiredRoles)
         else: #Error state, should not be called
-            raise Exception(f"dayPhase: {self.gameState.dayPhase} not in range o to 3")
+            raise Exception(f"dayPhase: {dayPhase} not in range o to 3")
+        report.phase = phase
+        session.transitionPlan = report #Kept so a retry only redoes what did not go through
+        metrics.observeTransition(session.gameState.getDayPhaseName(dayPhase),report.getCallCount())
+        return report
     
-    async def declareGamePhase(self): #Bot states the phase of the game into chat
-        await self.gameState.channels.getTownText().send(self.gameState.getGameTimeMsg())
+    async def declareGamePhase(self,guild: discord.Guild): #Bot states the phase of the game into chat
+        session = self.sessions.getSession(guild)
+        await self.announce(guild,session.gameState.getGameTimeMsg())
 
     @app_commands.command(
         name="start_game",
@@ -884,28 +2797,35 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def startGame(self,interaction: discord.Interaction):
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True)
-        await self.commandLock.acquire()
-        try:
-            if self.gameState.active:
+        async with session.commandLock: #Only changing the game state holds the lock, players are moved after
+            if session.gameState.active:
                 await interaction.edit_original_response(content=f"A game is already running, end it before starting a new one")
                 return
-            if not self.gameState.channelReady:
+            if not session.gameState.channelReady:
                 await interaction.edit_original_response(content=f"Channels have not been setup yet, run /setup_chanels to create and set them to the bot")
                 return 
 
-            await self.setRoles(interaction.guild,self.gameState.getPlayersAsMembers(interaction.guild),[get(interaction.guild.roles, name=Role.alive.value),get(interaction.guild.roles, name=Role.player.value),get(interaction.guild.roles, name=Role.night.value)]) #Remove any excess flag roles that users might have for some reason
-    
-            await self.movePlayersToPrivateRoom(interaction.guild,self.gameState.getPlayersAsMembers(interaction.guild)) #move all players to their private room
-            self.gameState.active = True    
-
-            await interaction.edit_original_response(content=f"The game is set, all players have been sent to their rooms for the first night")
-    
-            await self.declareGamePhase() # Declare the time, the first night
-        except Exception as e:
-            print(e)
-        finally:
-            self.commandLock.release()
+            session.gameState.setTime(1,0) #Games always start on the first night
+            session.gameState.active = True    
+            session.record("gameStarted",day=session.gameState.gameDay,phase=session.gameState.dayPhase)
+            announcement = session.gameState.getGameTimeMsg()
+            members = session.gameState.getPlayersAsMembers(interaction.guild) #What the game is when queued, commands queued after it change the game before this runs
+            phase = session.gameState.getTime()
+            desiredRoles = session.gameState.getDesiredRoleMap()
+        await interaction.edit_original_response(content=f"The game is set, players are being sent to their rooms for the first night")
+
+        async def apply():
+            guild = interaction.guild
+            if session.gameState.active and session.gameState.getTime() == phase: #Otherwise the game moved on or ended before the first night was applied
+                plan = await self.handlePlayerMovement(guild,members,phase,desiredRoles) #Night transition, it also removes any excess flag roles players might have, and a retry redoes its role edits too
+                summary = plan.summary()
+            else:
+                summary = "The game moved on before players were sent to their rooms"
+            await self.announce(guild,announcement) # Declare the time, the first night
+            await interaction.edit_original_response(content=f"The game is set, all players have been sent to their rooms for the first night\n{summary}")
+        self.applyLater(interaction,"start_game",apply,"Something went wrong starting the game, use /retry_player_movement to move players")
     
     
     @app_commands.command(
@@ -922,21 +2842,25 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def endGame(self,interaction: discord.Interaction, reason: app_commands.Choice[str] = None): #Ends an active game, with a given reason
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
-        if not self.gameState.active:
-            await interaction.edit_original_response(content=f"There is no active game to end")
-            return    
-
-        self.gameState.endGame()
+        async with session.commandLock:
+            if not session.gameState.active:
+                await interaction.edit_original_response(content=f"There is no active game to end")
+                return    
+
+            session.gameState.endGame()
+            session.roomLockScheduler.cancelAll() #Rooms of a finished game should not be locked later
+            if session.voteTask != None:
+                session.voteTask.cancel()
+            session.record("gameEnded")
+        await interaction.edit_original_response(content=f"The game has been ended!")
 
         if reason == None:
-            await self.gameState.channels.getTownText().send(f"The game is over!")
+            announcement = f"The game is over!"
         else:
-            await self.gameState.channels.getTownText().send(reason.value)
-
-        await interaction.edit_original_response(content=f"The game has been ended!")
-        self.commandLock.release()
+            announcement = reason.value
+        self.applyLater(interaction,"end_game",lambda: self.announce(interaction.guild,announcement)) #After the game's queued moves, so it is the last message of the game
 
     @app_commands.command(
         name="advance_phase",
@@ -954,33 +2878,42 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def nextGamePhase(self,interaction: discord.Interaction, time: app_commands.Choice[int] = None, day: int = None):
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
-
-        if not self.gameState.active: # Cant advance an inactive game
-            await interaction.edit_original_response(content=f"Requires a game to be running")
-            return
+        async with session.commandLock: #Only changing the game state holds the lock, players are moved after
+            if not session.gameState.active: # Cant advance an inactive game
+                await interaction.edit_original_response(content=f"Requires a game to be running")
+                return
     
-        if (day != None) and (day < 0): # Cant pass negative value
-            await interaction.edit_original_response(content=f"Cannot set day number to: {day}")
-            return
+            if (day != None) and (day < 0): # Cant pass negative value
+                await interaction.edit_original_response(content=f"Cannot set day number to: {day}")
+                return
     
-        if time == None: #If no argument passed
-            if not (day == None):
-                self.gameState.gameDay = day
-            self.gameState.incrementDayPhase()
-        else:
-            if day == None: #if a day was not given
-                self.gameState.advanceDayPhase(time.value)
+            if time == None: #If no argument passed
+                if not (day == None):
+                    session.gameState.gameDay = day
+                session.gameState.incrementDayPhase()
             else:
-                self.gameState.setTime(day,time.value)
-        
-        await self.handlePlayerMovement(interaction.guild)
-
-        await self.declareGamePhase()
-
-        await interaction.edit_original_response(content=f"Advanced to day: {self.gameState.gameDay}, phase: {self.gameState.dayPhase} and attempted to move players to the correct channel")
-        self.commandLock.release()    
+                if day == None: #if a day was not given
+                    session.gameState.advanceDayPhase(time.value)
+                else:
+                    session.gameState.setTime(day,time.value)
+            session.record("phaseAdvanced",day=session.gameState.gameDay,phase=session.gameState.dayPhase)
+            phase = session.gameState.getTime()
+            announcement = session.gameState.getGameTimeMsg()
+            members = session.gameState.getPlayersAsMembers(interaction.guild) #What the game is when queued, commands queued after it change the game before this runs
+            desiredRoles = session.gameState.getDesiredRoleMap()
+        await interaction.edit_original_response(content=f"Advanced to day: {phase[0]}, phase: {phase[1]}, moving players to the correct channel")
+
+        async def apply():
+            if session.gameState.active and session.gameState.getTime() == phase: #Otherwise the game moved on before this phase was applied, only the latest phase moves players
+                plan = await self.handlePlayerMovement(interaction.guild,members,phase,desiredRoles)
+                summary = plan.summary()
+            else:
+                summary = "Players were moved for a later phase instead"
+            await self.announce(interaction.guild,announcement)
+            await interaction.edit_original_response(content=f"Advanced to day: {phase[0]}, phase: {phase[1]} and attempted to move players to the correct channel\n{summary}")
+        self.applyLater(interaction,"advance_phase",apply,"Something went wrong moving players, use /retry_player_movement to try again")
 
     @app_commands.command(
         name="retry_player_movement",
@@ -989,24 +2922,19 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def retryPlayerMovement(self,interaction: discord.Interaction):
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
-        if not self.gameState.active:
+        if not session.gameState.active:
             await interaction.edit_original_response(content=f"Requires a game to be running")
             return
-    
-        await self.handlePlayerMovement(interaction.guild) 
 
-        await interaction.edit_original_response(content=f"Attempted to move players to the appropriate channel")
-        self.commandLock.release()
-  
-    async def killPlayerWithReason(self,interaction: discord.Interaction, member: discord.Member, reason: str = None): #Kill and announce a player is dead with a given reason   
-        await self.killPlayers(interaction.guild,[member]) # Mark their roles as dead
-
-        if reason == None:
-            await self.gameState.channels.getTownText().send(f"{member} is dead!")
-        else:
-            await self.gameState.channels.getTownText().send(f"{member} {reason}")
+        async def apply():
+            if not session.gameState.active: #Ended while queued
+                await interaction.edit_original_response(content=f"Requires a game to be running")
+                return
+            plan = await self.resumePlayerMovement(interaction.guild) 
+            await interaction.edit_original_response(content=f"Attempted to move players to the appropriate channel\n{plan.summary()}")
+        self.applyLater(interaction,"retry_player_movement",apply)
         
     @app_commands.command(
         name="storyteller_private",
@@ -1016,22 +2944,22 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def movePlayerToStortellerChannel(self,interaction: discord.Interaction, member: discord.Member): #Moves select player to the storyteller's channel
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
-        try:
-            if not self.gameState.active:
-                await interaction.edit_original_response(content=f"Requires a game to be running")
-                return
-        
-            if member.voice != None:
-                await self.movePlayersToStorytellerPrivate(interaction.guild,[member])
-                await interaction.edit_original_response(content=f"Moved {member.name} to {self.gameState.channels.storytellerVoice.name}")
+        if not session.gameState.active:
+            await interaction.edit_original_response(content=f"Requires a game to be running")
+            return
+        if member.voice == None:
+            await interaction.edit_original_response(content=f"Can't move {member.name}, they need to be connected to a voice channel first, its a discord limitation") 
+            return
+
+        async def apply():
+            plan = await self.movePlayersToStorytellerPrivate(interaction.guild,[member])
+            if plan.isSuccess():
+                await interaction.edit_original_response(content=f"Moved {member.name} to {session.gameState.channels.storytellerVoice.name}")
             else:
-                await interaction.edit_original_response(content=f"Can't move {member.name}, they need to be connected to a voice channel first, its a discord limitation") 
-        except Exception as e:
-            print(e)
-        finally:
-            self.commandLock.release()    
+                await interaction.edit_original_response(content=plan.summary())
+        self.applyLater(interaction,"storyteller_private",apply,"Something went wrong moving the player")
 
     @app_commands.command(
         name="kill_player",
@@ -1048,25 +2976,30 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def killPlayer(self,interaction: discord.Interaction, member: discord.Member, reason: app_commands.Choice[str] = None): #Marks that a player is dead and announces the death to all players
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
         #note, in the rules of BonCT, it is possible for an already dead player to be killed again, see: vigormortis role    
+        async with session.commandLock: #Only changing the game state holds the lock, roles are changed after
+            if not session.gameState.active:
+                await interaction.edit_original_response(content=f"Requires a game to be running")
+                return
     
-        if not self.gameState.active:
-            await interaction.edit_original_response(content=f"Requires a game to be running")
-            return
-    
-        if not (member in self.gameState.getPlayersAsMembers(interaction.guild)):
-            await interaction.edit_original_response(content=f"{member} is not listed as a player")
-            return
-    
+            if not (member in session.gameState.getPlayersAsMembers(interaction.guild)):
+                await interaction.edit_original_response(content=f"{member} is not listed as a player")
+                return
+
+            self.setPlayersAlive(session,[member],False)
+            desiredRoles = session.gameState.getDesiredRoleMap()
+        await interaction.edit_original_response(content=f"Killed player: {member}")
+
         if reason == None:
-            string = None
+            announcement = f"{member} is dead!"
         else:
-            string = reason.value
-        await self.killPlayerWithReason(interaction,member,string)
-        await interaction.edit_original_response(content=f"Killed player: {member}")
-        self.commandLock.release()
+            announcement = f"{member} {reason.value}"
+        async def apply():
+            await self.reconcilePlayerRoles(interaction.guild,[member],desiredRoles) # Mark their roles as dead
+            await self.announce(interaction.guild,announcement)
+        self.applyLater(interaction,"kill_player",apply,f"Killed player: {member}, but something went wrong changing their roles")
     
     @app_commands.command(
         name="ressurect_player",
@@ -1076,21 +3009,25 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def alivePlayer(self,interaction: discord.Interaction,member: discord.Member): #Marks a player as alive and announced it to all players
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
-
-        if not self.gameState.active:
-            await interaction.edit_original_response(content=f"Requires a game to be running")
-            return
+        async with session.commandLock: #Only changing the game state holds the lock, roles are changed after
+            if not session.gameState.active:
+                await interaction.edit_original_response(content=f"Requires a game to be running")
+                return
     
-        if not (member in self.gameState.getPlayersAsMembers(interaction.guild)):
-            await interaction.edit_original_response(content=f"{member} is not listed as a player")
-            return
+            if not (member in session.gameState.getPlayersAsMembers(interaction.guild)):
+                await interaction.edit_original_response(content=f"{member} is not listed as a player")
+                return
 
-        await self.alivePlayers(interaction.guild,[member])
+            self.setPlayersAlive(session,[member],True)
+            desiredRoles = session.gameState.getDesiredRoleMap()
+        await interaction.edit_original_response(content=f"Ressurected player: {member}")
 
-        await self.gameState.channels.getTownText().send(f"{member} is alive!")
-        self.commandLock.release()
+        async def apply():
+            await self.reconcilePlayerRoles(interaction.guild,[member],desiredRoles)
+            await self.announce(interaction.guild,f"{member} is alive!")
+        self.applyLater(interaction,"ressurect_player",apply,f"Ressurected player: {member}, but something went wrong changing their roles")
     
     @app_commands.command(
         name="open_door",
@@ -1099,44 +3036,43 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_any_role('ctb-Player','ctb-StoryTeller')
     async def openPublicRoomCommand(self,interaction: discord.Interaction): #Allows a member in the game to open a locked public room they are in
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
         try:
-            if not self.gameState.active:
-                await interaction.edit_original_response(content=f"Requires a game to be running")
-                return
-            if not (interaction.user in self.gameState.getAllUsers(interaction.guild)): #If user is not in the game
-                await interaction.edit_original_response(content=f"You are not a member of the currently running game")
-                return 
+            async with session.commandLock: #Only checking the game state holds the lock, the room mutex orders the edit with scheduled locks
+                if not session.gameState.active:
+                    await interaction.edit_original_response(content=f"Requires a game to be running")
+                    return
+                if not (interaction.user in session.gameState.getAllUsers(interaction.guild)): #If user is not in the game
+                    await interaction.edit_original_response(content=f"You are not a member of the currently running game")
+                    return 
         
-            channel = interaction.user.voice.channel        
+                channel = interaction.user.voice.channel        
 
-            if not (channel in self.gameState.channels.publicRooms): #If the channel the user is in is not a public room
-                await interaction.edit_original_response(content=f"You must be in a public room voice channel to use this command")
-                return 
+                if not (channel in session.gameState.channels.publicRooms): #If the channel the user is in is not a public room
+                    await interaction.edit_original_response(content=f"You must be in a public room voice channel to use this command")
+                    return 
         
-            if not self.gameState.channelLocks.isRoomLocked(channel): #If the public room the user is in is not locked
-                await interaction.edit_original_response(content=f"This room is already open")
-                return 
+                if not session.gameState.channelLocks.isRoomLocked(channel): #If the public room the user is in is not locked
+                    await interaction.edit_original_response(content=f"This room is already open")
+                    return 
         
             #Open room now
-            await self.voiceStateLock.acquire()
-            self.gameState.channelLocks.unlockRoom(channel)
-            roamRole = get(channel.guild.roles, name=Role.roam.value)
-            await channel.set_permissions(roamRole,read_messages=True,connect=True)
-            self.voiceStateLock.release()
+            roomLock = session.gameState.channelLocks.getRoomMutex(channel)
+            await roomLock.acquire()
+            try:
+                session.gameState.channelLocks.unlockRoom(channel)
+                session.record("roomUnlocked",room=channel.id)
+                await self.applyOverwrites(channel,self.getOverwrites(channel.guild,"publicRooms"))
+                #Close it again in the future, lock in openCooldown seconds (Usually longer than the default), replaces any pending lock of the room
+                session.roomLockScheduler.schedule(channel,session.gameState.openCooldown)
+            finally:
+                roomLock.release()
         
             await interaction.edit_original_response(content=f"Opened channel: {channel.name}")
-            self.commandLock.release() #Release command lock before waiting on the scheduled task
-        
-            #Create a task to close it again in the future, lock in openCooldown seconds (Usually longer than the default)
-            task = asyncio.create_task(self.lockChannelInSeconds(channel,self.voiceStateLock,self.gameState.openCooldown))
-            await self.commandLock.acquire()
-        except Exception as e:
-            print(e)
-        finally:
-            self.commandLock.release()
-        
+        except Exception:
+            commandLog.exception("Exception has occured while opening channel")
+
     @app_commands.command(
         name="lock_door",
         description="Prevents players from joining the public room you are in"
@@ -1144,43 +3080,110 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_any_role('ctb-Player','ctb-StoryTeller')
     async def lockPublicRoomCommand(self,interaction: discord.Interaction): #Allows a member in the game to lock an open public room they are in
+        session = self.sessions.getSession(interaction.guild)
         await interaction.response.defer(thinking=True,ephemeral=True)
-        await self.commandLock.acquire()
         try:
-            if not self.gameState.active:
-                await interaction.edit_original_response(content=f"Requires a game to be running")
-                return
-            if not (interaction.user in self.gameState.getAllUsers(interaction.guild)): #If user is not in the game
-                await interaction.edit_original_response(content=f"You are not a member of the currently running game")
-                return 
+            async with session.commandLock: #Only checking the game state holds the lock, the room mutex orders the edit with scheduled locks
+                if not session.gameState.active:
+                    await interaction.edit_original_response(content=f"Requires a game to be running")
+                    return
+                if not (interaction.user in session.gameState.getAllUsers(interaction.guild)): #If user is not in the game
+                    await interaction.edit_original_response(content=f"You are not a member of the currently running game")
+                    return 
         
-            channel = interaction.user.voice.channel        
+                channel = interaction.user.voice.channel        
 
-            if not (channel in self.gameState.channels.publicRooms): #If the channel the user is in is not a public room
-                await interaction.edit_original_response(content=f"You must be in a public room voice channel to use this command")
-                return 
+                if not (channel in session.gameState.channels.publicRooms): #If the channel the user is in is not a public room
+                    await interaction.edit_original_response(content=f"You must be in a public room voice channel to use this command")
+                    return 
         
-            if self.gameState.channelLocks.isRoomLocked(channel): #If the public room the user is in is locked
-                await interaction.edit_original_response(content=f"This room is already locked")
-                return 
+                if session.gameState.channelLocks.isRoomLocked(channel): #If the public room the user is in is locked
+                    await interaction.edit_original_response(content=f"This room is already locked")
+                    return 
         
             #lock room now
-            await self.voiceStateLock.acquire()
-            self.gameState.channelLocks.lockRoom(channel)
-            roamRole = get(channel.guild.roles, name=Role.roam.value)
-            await channel.set_permissions(roamRole,read_messages=True,connect=False)
-            self.voiceStateLock.release()
+            roomLock = session.gameState.channelLocks.getRoomMutex(channel)
+            await roomLock.acquire()
+            try:
+                session.roomLockScheduler.cancel(channel) #Already locked, a pending lock would only repeat the call
+                session.gameState.channelLocks.lockRoom(channel)
+                session.record("roomLocked",room=channel.id)
+                await self.applyOverwrites(channel,self.getOverwrites(channel.guild,"publicRooms","locked"))
+            finally:
+                roomLock.release()
         
             await interaction.edit_original_response(content=f"Locked channel: {channel.name}")
-        except Exception as e:
-            print(e)
+        except Exception:
+            commandLog.exception("Exception has occured while locking channel")
+
+    class VoteView(discord.ui.View): #Buttons players vote with, clicks only touch the vote and never wait on the command lock
+        def __init__(self,vote: Vote,onChange):
+            super().__init__(timeout=None) #The vote stops the view once it is over
+            self.vote = vote
+            self.onChange = onChange #Called after a hand changes, shows it on the vote message
+            if vote.type == VotingType.pointCountdown: #Players pick a player instead of raising a hand
+                self.remove_item(self.raiseHand)
+                self.remove_item(self.lowerHand)
+                select = discord.ui.Select(placeholder="Point at a player",options=[
+                    discord.SelectOption(label=player.member.name,value=str(player.member.id)) for player in vote.order[:25] #Discord allows 25 options
+                ])
+                async def pointCallback(interaction: discord.Interaction):
+                    await self.setPoint(interaction,int(select.values[0]))
+                select.callback = pointCallback
+                self.add_item(select)
+
+        @discord.ui.button(label="Raise hand", style=discord.ButtonStyle.success)
+        async def raiseHand(self,interaction: discord.Interaction,button: discord.ui.Button):
+            await self.setHand(interaction,True)
+
+        @discord.ui.button(label="Lower hand", style=discord.ButtonStyle.secondary)
+        async def lowerHand(self,interaction: discord.Interaction,button: discord.ui.Button):
+            await self.setHand(interaction,False)
+
+        async def setHand(self,interaction: discord.Interaction,raised: bool):
+            error = self.vote.setHand(interaction.user,raised)
+            if error != None:
+                await interaction.response.send_message(content=error,ephemeral=True)
+                return
+            if self.vote.isBlind(): #Only the voter may know, and the message has nothing to show
+                await interaction.response.send_message(content="Your hand is raised" if raised else "Your hand is lowered",ephemeral=True)
+                return
+            await interaction.response.defer() #Acknowledge the click, the vote message shows the hand on its next edit
+            self.onChange()
+
+        async def setPoint(self,interaction: discord.Interaction,targetId: int):
+            error = self.vote.setPoint(interaction.user,targetId)
+            if error != None:
+                await interaction.response.send_message(content=error,ephemeral=True)
+                return
+            await interaction.response.defer()
+            self.onChange()
+
+    async def runCircleTally(self,session: GameSession,vote: Vote,view: discord.ui.View,message: ThrottledMessage): #Counts hands clockwise, one player every votingCircledownDelay seconds
+        loop = asyncio.get_running_loop()
+        delay = session.gameState.votingCircledownDelay
+        start = loop.time() + delay #Players get one step to raise their hands before the first is counted
+        try:
+            for step in range(len(vote.order)):
+                #Deadlines are fixed from the start, a slow edit or busy loop never pushes the rest of the count back
+                await asyncio.sleep(max(0,start + step * delay - loop.time()))
+                for player in vote.countNext():
+                    session.record("ghostVoteConsumed",member=player.member.id)
+                message.update(content=vote.render())
         finally:
-            self.commandLock.release()
+            vote.finish()
+            view.stop()
+            await message.close(content=vote.render(),view=None)
 
-    class VoteView(discord.ui.View):
-        @discord.ui.button(label="Start Vote", style=discord.ButtonStyle.primary)
-        async def button_callback(self, interaction, button):
-            await interaction.response.send_message(content="whae",embed=None,view=None)
+    async def runCountdown(self,session: GameSession,vote: Vote,view: discord.ui.View,message: ThrottledMessage): #Counts every hand once votingCountdownDelay seconds have passed
+        try:
+            await asyncio.sleep(session.gameState.votingCountdownDelay) #Players see the countdown through a discord timestamp, it needs no edits
+            for player in vote.countAll():
+                session.record("ghostVoteConsumed",member=player.member.id)
+        finally:
+            vote.finish()
+            view.stop()
+            await message.close(content=vote.render(),view=None)
 
     @app_commands.command(
         name="run_vote",
@@ -1198,105 +3201,128 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
     async def runVote(self,interaction: discord.Interaction, nominator: discord.Member = None, nominee: discord.Member = None, type: int = 0):
-        #await interaction.response.defer(thinking=True,ephemeral=False)
-        await self.commandLock.acquire()
+        session = self.sessions.getSession(interaction.guild)
+        if not (type in [votingType.value for votingType in VotingType]): #Discord only offers the choices, but the value is not checked before it reaches the bot
+            await interaction.response.send_message(content=f"Unknown vote type: {type}",ephemeral=True)
+            return
+        async with session.commandLock: #Only starting the vote needs the lock, counting and clicks run without it
+            if not session.gameState.active:
+                await interaction.response.send_message(content=f"Requires a game to be running",ephemeral=True)
+                return
+            if session.vote != None and not session.vote.finished:
+                await interaction.response.send_message(content=f"A vote is already running, wait for it to finish",ephemeral=True)
+                return
+            vote = Vote(session.gameState,nominator,nominee,VotingType(type))
+            if vote.type != VotingType.circleTally:
+                vote.startCountdown(session.gameState.votingCountdownDelay)
+            session.vote = vote
 
         try:
-            nominatorStr = "Unknown"
-            nomineeStr = "Unknown"
-
-            if nominator != None:
-                nominatorStr = nominator.name
-
-            if nominee != None:
-                nomineeStr = nominee.name
-
-            await interaction.response.send_message(content=f"{nominatorStr} has nominated {nomineeStr}",view=GameCommands.VoteView())
-        except Exception as e:
-            print(e)
-        finally:
-            self.commandLock.release()
+            message = ThrottledMessage(interaction.edit_original_response)
+            view = GameCommands.VoteView(vote,lambda: message.update(content=vote.render()))
+            await interaction.response.send_message(content=vote.render(),view=view)
+            if vote.type == VotingType.circleTally:
+                session.voteTask = asyncio.create_task(self.runCircleTally(session,vote,view,message))
+            else:
+                session.voteTask = asyncio.create_task(self.runCountdown(session,vote,view,message))
+        except Exception:
+            commandLog.exception("Exception has occured while starting vote")
+            vote.finish()
     
     @app_commands.command(
         name="character",
         description="Prints information and rules on a given character role"
     )
-    @app_commands.choices(character=characterData.choices)
+    @app_commands.describe(character="The character to show, start typing to search")
     @app_commands.guild_only()
-    async def declareCharacter(self,interaction: discord.Interaction, character: app_commands.Choice[str]): #Prints in chat the summary of a character role
+    async def declareCharacter(self,interaction: discord.Interaction, character: str): #Prints in chat the summary of a character role
         await interaction.response.defer(thinking=True)
         try:
-            embed = self.characterData.getEmbedOfCharacter(character.value)
+            embed = self.characterData.getEmbedOfCharacter(character)
             if embed != None:
                 await interaction.edit_original_response(embed=embed)
             else:
                 await interaction.edit_original_response(content="Could not find character")
-        except Exception as e:
-            print(e)
+        except Exception:
+            commandLog.exception("Exception has occured while declaring character")
         
     @app_commands.command(
         name="you_are_the",
         description="Used by the storyteller to tell players their character"
     )
-    @app_commands.choices(character=characterData.choices)
+    @app_commands.describe(character="The character to show, start typing to search")
     @app_commands.guild_only()
     @app_commands.checks.has_role('ctb-StoryTeller')
-    async def youAreTheCharacter(self,interaction: discord.Interaction, character: app_commands.Choice[str]): #Just like /character except it declares what character a plaer is
+    async def youAreTheCharacter(self,interaction: discord.Interaction, character: str): #Just like /character except it declares what character a plaer is
         await interaction.response.defer(thinking=True)
         try:
-            embed = self.characterData.getEmbedOfCharacter(character.value)
+            embed = self.characterData.getEmbedOfCharacter(character)
             if embed != None:
                 embed.title = "You are the:"
                 await interaction.edit_original_response(embed=embed)
             else:
                 await interaction.edit_original_response(content="Could not find character")
-        except Exception as e:
-            print(e)
+        except Exception:
+            commandLog.exception("Exception has occured while declaring character")
 
+    @declareCharacter.autocomplete('character')
+    @youAreTheCharacter.autocomplete('character')
+    async def characterAutocomplete(self,interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]: #Suggests characters matching what the user has typed so far
+        return self.characterData.search.getChoices(current)
     
-    async def lockChannelInSeconds(self,channel: discord.VoiceChannel,locker: asyncio.Lock, secs: int = 5, ): #Prevents players from joining a channel in time seconds from now
-        print(f"Locking channel: {channel.name} in {secs} seconds")
-        await asyncio.sleep(secs) #Wait seconds, this is okay because nothing waits on this task
-        #This command doesnt wait the exact amount of seconds, since there may be a delay to accquire rights to change channel permissions
-        await locker.acquire()
-        try:
-            #Channel might have changed in the time we waited, get updated version
-            recentChannel = bot.get_channel(channel.id)
-            if (len(self.gameState.filterPlayers(recentChannel.members)) != 0): #The room is not empty, lock it
-                roamRole = get(recentChannel.guild.roles, name=Role.roam.value)
-                await recentChannel.set_permissions(roamRole,read_messages=True,connect=False) #Prevent roaming players from connecting
-                self.gameState.channelLocks.lockRoom(recentChannel)
-                print(f"Locked channel: {recentChannel.name}")
-            else:
-                print(f"Cancelled locking of channel: {channel.name}")
-        except:
-            print(f"locking is being cancelled")
-            raise
-        finally:
-            locker.release()
+    async def lockPublicRooms(self,rooms: List[discord.VoiceChannel]): #Prevents players from joining rooms whose lock deadline has passed, called by the room lock scheduler
+        guild = rooms[0].guild
+        session = self.sessions.getSession(guild)
+        lockedOverwrites = self.getOverwrites(guild,"publicRooms","locked") #Resolved once for every room of the batch
+
+        async def lockRoom(room: discord.VoiceChannel):
+            roomLock = session.gameState.channelLocks.getRoomMutex(room)
+            await roomLock.acquire()
+            try:
+                #Channel might have changed in the time we waited, get updated version
+                recentChannel = self.bot.get_channel(room.id) or room
+                if (len(session.gameState.filterPlayers(recentChannel.members)) != 0): #The room is not empty, lock it
+                    await self.applyOverwrites(recentChannel,lockedOverwrites) #Prevent roaming players from connecting
+                    session.gameState.channelLocks.lockRoom(recentChannel)
+                    session.record("roomLocked",room=recentChannel.id)
+                    roomLog.info("Locked channel: %s",recentChannel.name)
+                else:
+                    roomLog.debug("Cancelled locking of channel: %s",room.name)
+            except Exception as e:
+                roomLog.warning("Could not lock channel: %s: %s",room.name,e)
+            finally:
+                roomLock.release()
+
+        #Every due room at once, each only waits on its own lock
+        await asyncio.gather(*[lockRoom(room) for room in rooms])
 
     async def handleMemberJoinPublic(self,member: discord.Member, channel: discord.VoiceChannel): #Handle member joining a public room
-        await self.voiceStateLock.acquire()
-        if not self.gameState.channelLocks.isRoomLocked(channel): #if the room is open
-            self.gameState.channelLocks.addMembersToRoom(channel,[member])
-            if (len(self.gameState.filterPlayers(channel.members)) == 1): #If there is only one member in the chat
-                self.voiceStateLock.release()
-            
-                #Create an asynciio task to lock down this channel in a set amount of time
-                task = asyncio.create_task(self.lockChannelInSeconds(channel,self.voiceStateLock,self.gameState.lockCooldown))
-                await self.voiceStateLock.acquire()
-        self.voiceStateLock.release()
+        session = self.sessions.getSession(channel.guild)
+        roomLock = session.gameState.channelLocks.getRoomMutex(channel)
+        await roomLock.acquire()
+        try:
+            if not session.gameState.channelLocks.isRoomLocked(channel): #if the room is open
+                session.gameState.channelLocks.addMembersToRoom(channel,[member])
+                if (len(session.gameState.filterPlayers(channel.members)) == 1): #If there is only one member in the chat
+                    #Lock down this channel in a set amount of time
+                    session.roomLockScheduler.schedule(channel,session.gameState.lockCooldown)
+        finally:
+            roomLock.release()
     
     async def handleMemberLeavePublic(self,member: discord.Member, channel: discord.VoiceChannel): # Handle member leaving a public room
-        await self.voiceStateLock.acquire()
-        if self.gameState.channelLocks.isRoomLocked(channel): # if room is locked
-            print(f"{channel.members}")
-            if (len(self.gameState.filterPlayers(channel.members)) == 0): #The room is now empty
-                self.gameState.channelLocks.unlockRoom(channel)
-                roamRole = get(channel.guild.roles, name=Role.roam.value)
-                await channel.set_permissions(roamRole,read_messages=True,connect=True)
-        self.gameState.channelLocks.removeMembersToRoom(channel,[member])
-        self.voiceStateLock.release()
+        session = self.sessions.getSession(channel.guild)
+        roomLock = session.gameState.channelLocks.getRoomMutex(channel)
+        await roomLock.acquire()
+        try:
+            if (len(session.gameState.filterPlayers(channel.members)) == 0): #The room is now empty
+                session.roomLockScheduler.cancel(channel) #Nobody left to lock the room for
+                if session.gameState.channelLocks.isRoomLocked(channel): # if room is locked
+                    session.gameState.channelLocks.unlockRoom(channel)
+                    session.record("roomUnlocked",room=channel.id)
+                    await self.applyOverwrites(channel,self.getOverwrites(channel.guild,"publicRooms"))
+            session.gameState.channelLocks.removeMembersToRoom(channel,[member])
+        finally:
+            roomLock.release()
 
     """
     Called whenver a member changes their voice state:
@@ -1306,25 +3332,28 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
         - When a member is muted or deafened by an admin (such as this bot)
     """
     @commands.Cog.listener()
+    @timedEvent
     async def on_voice_state_update(self,member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
-        print(f"Member: {member.name} moved from voicestate {before.channel} to {after.channel}")
+        currentSession.set(member.guild.id) #Each event runs in its own task
+        voiceLog.debug("Member: %s moved from voicestate %s to %s",member.name,before.channel,after.channel)
+        if not self.sessions.hasSession(member.guild): #No game has been set up in this guild, nothing to control
+            return
+        session = self.sessions.getSession(member.guild)
 
-        if GameState.isMemberPlayer(member): # Only control players
+        if session.gameState.isMemberPlayer(member): # Only control players
             if before.channel == after.channel: #If users did not change channels or did not move to/from a channel
-                print(f"Player: {member.name} did not move to or from a channel")
+                voiceLog.debug("Player: %s did not move to or from a channel",member.name)
                 return #We only care about moving to or from channels. not changes inside of channels
 
             #handle previous channel
-            if before.channel in self.gameState.channels.publicRooms: #we only care about controlling public rooms in the bot
-                print(f"Player: {member.name} left public room: {before.channel}")
+            if before.channel in session.gameState.channels.publicRooms: #we only care about controlling public rooms in the bot
+                voiceLog.debug("Player: %s left public room: %s",member.name,before.channel)
                 await self.handleMemberLeavePublic(member,before.channel)
-                print("Done before")
     
             #handle new channel
-            if after.channel in self.gameState.channels.publicRooms: #we only care about controlling public rooms in the bot
-                print(f"Player: {member.name} entered public room: {after.channel}")
+            if after.channel in session.gameState.channels.publicRooms: #we only care about controlling public rooms in the bot
+                voiceLog.debug("Player: %s entered public room: %s",member.name,after.channel)
                 await self.handleMemberJoinPublic(member,after.channel)
-                print("Done after")
     
     #Handle MissingPermissions exceptions raise from commands that require a permission/role
     #TODO this just FEELS wrong to write out all the decorators like this. but I cant find a better soloution
@@ -1345,6 +3374,7 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
     @youAreTheCharacter.error
     @runVote.error
     async def missingPermisionError(self,interaction: discord.Interaction,error: app_commands.AppCommandError):
+        self.endCommandTiming(interaction,type(error).__name__)
         if isinstance(error, app_commands.checks.MissingPermissions):
             await interaction.response.send_message(content="You don't have permission to use this command.",ephemeral=True)
         
@@ -1359,7 +3389,19 @@ class GameCommands(commands.Cog): #Cog that holds all the bots commands for runn
         else:
             raise error
 
-#Give commands to the bot
-asyncio.run(bot.add_cog(GameCommands(bot)))
-#Run the bot
-bot.run(TOKEN,log_handler=handler,log_level=logging.DEBUG)
\ No newline at end of file
+async def main(): #Adds the cog and runs the bot on one event loop, so tasks the cog starts when loaded (script watcher, metrics server) keep running
+    async with bot:
+        #Give commands to the bot
+        await bot.add_cog(GameCommands(bot))
+        #Run the bot, bot.start leaves logging alone so the handlers set up below are the only ones
+        await bot.start(TOKEN)
+
+if __name__ == "__main__": #Only run the bot when started directly, so tests and benchmarks can import the module
+    logListener = setupLogging()
+    logListener.start()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt: #Ctrl+C, async with bot has already closed the connection
+        pass
+    finally:
+        logListener.stop() #Writes out records still on the queue
\ No newline at end of file
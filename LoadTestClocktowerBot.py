@@ -0,0 +1,517 @@
+import argparse
+import asyncio
+import collections
+import copy
+import itertools
+import json
+import logging
+import random
+import sys
+import time
+from typing import Dict, List
+
+import discord
+
+sys.path.append('../ClocktowerBot')
+
+from ClocktowerBot import GameCommands, SessionRegistry, VotingType, currentCommand, metrics
+
+"""
+Offline load test of GameCommands, run with: python LoadTestClocktowerBot.py --guilds 200
+Guilds, members, roles and channels are simulated in memory and every discord call the cog makes goes through SimulatedRest,
+which adds latency, paces calls to each rate limit bucket the way discord.py does from discord's rate limit headers,
+answers calls over the global limit (and a share of random calls) with 429s left to the cog's RestScheduler to back off and retry, and counts every call. Each guild plays a scripted game and the latency of every command is reported
+"""
+
+def percentile(samples: List[float],percent: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1,int(len(ordered) * percent / 100))]
+
+class SimulatedRest: #Stands in for discord's REST API
+    def __init__(self,latency: float = 0.02,jitter: float = 0.01,bucketLimit: int = 5,bucketWindow: float = 1.0,globalLimit: int = None,errorRate: float = 0.0,seed: int = 0):
+        self.latency = latency #Round trip time (in secs) of every call
+        self.jitter = jitter #Extra random time (in secs) added to each call
+        self.bucketLimit = bucketLimit #How many calls a rate limit bucket allows per bucketWindow
+        self.bucketWindow = bucketWindow
+        self.globalLimit = globalLimit #How many calls per second the whole bot may make, None for no limit
+        self.errorRate = errorRate #Chance of a 429 on any call, e.g. a limit shared with other bots
+        self.rng = random.Random(seed)
+        self.history: Dict[object,collections.deque] = {} #Dict (bucket -> times of recent calls)
+        self.calls = collections.Counter() #Calls made per route, retries included
+        self.rateLimited = collections.Counter() #429s answered per route
+
+    def take(self,bucket,limit: int,window: float) -> float: #Uses one call of a bucket, returns how long to wait if it is exhausted
+        now = asyncio.get_running_loop().time()
+        recent = self.history.setdefault(bucket,collections.deque())
+        while recent and recent[0] <= now - window:
+            recent.popleft()
+        if len(recent) >= limit:
+            return recent[0] + window - now
+        recent.append(now)
+        return 0
+
+    async def request(self,route: str,bucket = None): #Makes one call, answering with a 429 the caller has to retry. Calls without a bucket (interaction replies) are not rate limited
+        start = time.perf_counter()
+        if bucket != None:
+            wait = self.take(bucket,self.bucketLimit,self.bucketWindow)
+            while wait > 0: #discord.py holds calls to a bucket whose remaining calls ran out until it resets, instead of sending them
+                await asyncio.sleep(wait)
+                wait = self.take(bucket,self.bucketLimit,self.bucketWindow)
+        self.calls[route] += 1
+        await asyncio.sleep(self.latency + self.rng.uniform(0,self.jitter))
+        retryAfter = 0
+        if bucket != None and self.globalLimit != None:
+            retryAfter = self.take("global",self.globalLimit,1.0)
+        if retryAfter == 0 and bucket != None and self.rng.random() < self.errorRate:
+            retryAfter = self.bucketWindow
+        metrics.observeRest("SIMULATED",route,time.perf_counter() - start) #Reported like the bot's real REST calls
+        if retryAfter > 0:
+            self.rateLimited[route] += 1
+            metrics.observeRateLimit("bucket")
+            raise discord.HTTPException(SimulatedHttpResponse(429,{"Retry-After": str(retryAfter)}),{"message": "You are being rate limited.","retry_after": retryAfter})
+
+class SimulatedHttpResponse: #The parts of an aiohttp response discord.HTTPException reads
+    def __init__(self,status: int,headers: dict):
+        self.status = status
+        self.reason = {404: "Not Found",429: "Too Many Requests"}.get(status,"")
+        self.headers = headers
+
+class SimulatedObject: #Compared by type and id, like discord models
+    ids = itertools.count(1000)
+
+    def __init__(self,name: str):
+        self.id = next(SimulatedObject.ids)
+        self.name = name
+
+    def __eq__(self,other) -> bool:
+        return isinstance(other,SimulatedObject) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __str__(self) -> str:
+        return self.name
+
+class SimulatedRole(SimulatedObject):
+    def __init__(self,guild: "SimulatedGuild",name: str):
+        super().__init__(name)
+        self.guild = guild
+
+class SimulatedVoiceState:
+    def __init__(self,channel: "SimulatedChannel"):
+        self.channel = channel
+
+class SimulatedMember(SimulatedObject):
+    def __init__(self,guild: "SimulatedGuild",name: str):
+        super().__init__(name)
+        self.guild = guild
+        self.roles: List[SimulatedRole] = [guild.default_role] #Lists are replaced, never changed in place, so snapshots keep the roles they were taken with
+        self.bot = False
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    @property
+    def voice(self) -> SimulatedVoiceState | None: #Read from the guild like discord.py does, so it is current even on a stale member
+        return self.guild.voiceStates.get(self.id)
+
+    @property
+    def server(self) -> "SimulatedMember": #The member as discord has it, edits are made to it
+        return self.guild.memberIndex[self.id]
+
+    def snapshot(self) -> "SimulatedMember": #A copy that does not see later changes, like a member discord.py does not keep up to date
+        return copy.copy(self.server)
+
+    async def add_roles(self,*roles):
+        for role in roles:
+            await self.guild.rest.request("add_role",("members",self.guild.id))
+            if not (role in self.server.roles):
+                self.server.roles = self.server.roles + [role]
+
+    async def remove_roles(self,*roles):
+        for role in roles:
+            await self.guild.rest.request("remove_role",("members",self.guild.id))
+            self.server.roles = [current for current in self.server.roles if current != role]
+
+    async def edit(self,roles: List[SimulatedRole] = None,voice_channel = None) -> "SimulatedMember": #Returns the edited member, self only changes if it is discord's own member
+        await self.guild.rest.request("edit_member",("members",self.guild.id))
+        if roles != None:
+            self.server.roles = list(roles)
+        if voice_channel != None:
+            self.guild.setVoice(self,voice_channel)
+        return self.snapshot()
+
+    async def move_to(self,channel):
+        if self.voice == None: #Discord refuses to move members who are not connected
+            await self.guild.rest.request("edit_member",("members",self.guild.id))
+            raise discord.ClientException("Member is not connected to voice")
+        await self.edit(voice_channel=channel)
+
+class SimulatedChannel(SimulatedObject):
+    def __init__(self,guild: "SimulatedGuild",name: str,type: discord.ChannelType,category = None,overwrites: dict = None,position: int = 0):
+        super().__init__(name)
+        self.guild = guild
+        self.type = type
+        self.category = category
+        self.overwrites = dict(overwrites) if overwrites != None else {}
+        self.position = position
+        self.messages: List[str] = []
+
+    @property
+    def category_id(self) -> int | None:
+        return self.category.id if self.category != None else None
+
+    @property
+    def members(self) -> List[SimulatedMember]: #Members connected to a voice channel
+        return [member for member in self.guild.members if member.voice != None and member.voice.channel == self]
+
+    @property
+    def channels(self) -> List["SimulatedChannel"]: #Channels inside a category
+        return sorted([channel for channel in self.guild.channels if channel.category == self],key=lambda channel: channel.position)
+
+    async def set_permissions(self,target,overwrite: discord.PermissionOverwrite = None,**permissions):
+        await self.guild.rest.request("set_permissions",("channel",self.id))
+        self.overwrites[target] = overwrite if overwrite != None else discord.PermissionOverwrite(**permissions)
+
+    async def edit(self,overwrites: dict = None,**fields):
+        await self.guild.rest.request("edit_channel",("channel",self.id))
+        if overwrites != None:
+            self.overwrites = dict(overwrites)
+
+    async def delete(self):
+        await self.guild.rest.request("delete_channel",("channel",self.id))
+        self.guild.channelIndex.pop(self.id,None)
+
+    async def send(self,content: str = None,embed: discord.Embed = None,view = None):
+        await self.guild.rest.request("send_message",("channel",self.id))
+        self.messages.append(content)
+
+class SimulatedGuild(SimulatedObject): #One guild, its members, roles and channels
+    def __init__(self,rest: SimulatedRest,memberCount: int,slim: bool = False):
+        super().__init__("guild")
+        self.name = f"Guild {self.id}"
+        self.rest = rest
+        self.slim = slim #Only members in voice are cached and kept up to date, like the slim gateway's member cache
+        self.dispatch = None #Called with (member, before, after) on voice moves, like the gateway's voice state updates
+        self.default_role = SimulatedRole(self,"@everyone")
+        self.roleIndex: Dict[int,SimulatedRole] = {}
+        self.memberIndex: Dict[int,SimulatedMember] = {}
+        self.channelIndex: Dict[int,SimulatedChannel] = {}
+        self.voiceStates: Dict[int,SimulatedVoiceState] = {} #Dict (member id -> voice state) of members connected to voice
+        for i in range(memberCount):
+            member = SimulatedMember(self,f"member{i}")
+            self.memberIndex[member.id] = member
+        self.lobby = self.addChannel(SimulatedChannel(self,"General",discord.ChannelType.voice)) #Where players wait before the game
+
+    def addChannel(self,channel: SimulatedChannel) -> SimulatedChannel:
+        self.channelIndex[channel.id] = channel
+        return channel
+
+    @property
+    def members(self) -> List[SimulatedMember]:
+        return list(self.memberIndex.values())
+
+    @property
+    def roles(self) -> List[SimulatedRole]:
+        return [self.default_role] + list(self.roleIndex.values())
+
+    @property
+    def channels(self) -> List[SimulatedChannel]:
+        return list(self.channelIndex.values())
+
+    @property
+    def categories(self) -> List[SimulatedChannel]:
+        return [channel for channel in self.channels if channel.type == discord.ChannelType.category]
+
+    @property
+    def text_channels(self) -> List[SimulatedChannel]:
+        return [channel for channel in self.channels if channel.type == discord.ChannelType.text]
+
+    @property
+    def voice_channels(self) -> List[SimulatedChannel]:
+        return [channel for channel in self.channels if channel.type == discord.ChannelType.voice]
+
+    def get_member(self,id: int) -> SimulatedMember | None:
+        if self.slim and not (id in self.voiceStates):
+            return None
+        return self.memberIndex.get(id)
+
+    async def fetch_member(self,id: int) -> SimulatedMember:
+        await self.rest.request("get_member",("guild",self.id))
+        if not (id in self.memberIndex):
+            raise discord.NotFound(SimulatedHttpResponse(404,{}),"Unknown Member")
+        return self.memberIndex[id].snapshot()
+
+    def get_role(self,id: int) -> SimulatedRole | None:
+        return self.roleIndex.get(id)
+
+    def get_channel(self,id: int) -> SimulatedChannel | None:
+        return self.channelIndex.get(id)
+
+    async def fetch_members(self):
+        await self.rest.request("list_members",("guild",self.id))
+        for member in self.members:
+            yield member
+
+    async def create_role(self,name: str,colour = None) -> SimulatedRole:
+        await self.rest.request("create_role",("guild",self.id))
+        role = SimulatedRole(self,name)
+        self.roleIndex[role.id] = role
+        return role
+
+    async def create_category(self,name: str) -> SimulatedChannel:
+        await self.rest.request("create_channel",("guild",self.id))
+        return self.addChannel(SimulatedChannel(self,name,discord.ChannelType.category))
+
+    async def create_text_channel(self,name: str,overwrites: dict = None,category = None,position: int = 0) -> SimulatedChannel:
+        await self.rest.request("create_channel",("guild",self.id))
+        return self.addChannel(SimulatedChannel(self,name,discord.ChannelType.text,category,overwrites,position))
+
+    async def create_voice_channel(self,name: str,overwrites: dict = None,category = None,position: int = 0) -> SimulatedChannel:
+        await self.rest.request("create_channel",("guild",self.id))
+        return self.addChannel(SimulatedChannel(self,name,discord.ChannelType.voice,category,overwrites,position))
+
+    def setVoice(self,member: SimulatedMember,channel: SimulatedChannel | None): #Moves a member and sends the voice state update the gateway would
+        before = member.voice if member.voice != None else SimulatedVoiceState(None)
+        if channel != None:
+            self.voiceStates[member.id] = SimulatedVoiceState(channel)
+        else:
+            self.voiceStates.pop(member.id,None)
+        if self.dispatch != None:
+            self.dispatch(member,before,member.voice if member.voice != None else SimulatedVoiceState(None))
+
+class SimulatedResponse: #interaction.response, the first reply to an interaction
+    def __init__(self,interaction: "SimulatedInteraction"):
+        self.interaction = interaction
+
+    async def defer(self,thinking: bool = False,ephemeral: bool = False):
+        await self.interaction.reply("defer")
+
+    async def send_message(self,content: str = None,embed = None,view = None,ephemeral: bool = False):
+        await self.interaction.reply("send_message",content)
+        if view != None:
+            self.interaction.view = view
+
+class SimulatedInteraction:
+    def __init__(self,guild: SimulatedGuild,user: SimulatedMember):
+        self.guild = guild
+        self.user = user
+        self.response = SimulatedResponse(self)
+        self.start = time.perf_counter()
+        self.acked = None #Seconds until the first reply, discord fails interactions not answered within 3
+        self.content: str = None #Last content the command replied with
+        self.view = None #View sent with the reply, e.g. the buttons of a vote
+
+    async def reply(self,route: str,content: str = None): #Interaction callbacks have no shared rate limit
+        await self.guild.rest.request(f"interaction_{route}")
+        if self.acked == None:
+            self.acked = time.perf_counter() - self.start
+        if content != None:
+            self.content = content
+
+    async def edit_original_response(self,content: str = None,embed = None,view = None):
+        await self.reply("edit",content)
+
+class SimulatedBot: #The parts of the bot the cog uses
+    def __init__(self):
+        self.guilds: List[SimulatedGuild] = []
+
+    def get_channel(self,id: int):
+        for guild in self.guilds:
+            channel = guild.get_channel(id)
+            if channel != None:
+                return channel
+        return None
+
+class LoadTest: #Plays a scripted game in many guilds at once against one cog
+    def __init__(self,rest: SimulatedRest,guildCount: int,minPlayers: int = 5,maxPlayers: int = 20,days: int = 3,seed: int = 0,roomAccess: str = "overwrites",gateway: str = "full"):
+        self.rest = rest
+        self.guildCount = guildCount
+        self.minPlayers = minPlayers
+        self.maxPlayers = maxPlayers
+        self.days = days #Full days (night, dawn, midday, dusk) each game plays before it ends
+        self.rng = random.Random(seed)
+        self.roomAccess = roomAccess #How private rooms are opened and closed, see CTB_ROOM_ACCESS
+        self.gateway = gateway #Member cache of the simulated guilds, see CTB_GATEWAY
+        self.bot = SimulatedBot()
+        self.cog = GameCommands(self.bot)
+        self.cog.sessions = SessionRegistry(self.cog.lockPublicRooms,None,self.cog.scheduler) #No journal, the simulated guilds do not outlive the run
+        self.latency: Dict[str,List[float]] = {} #Dict (command -> seconds each call took)
+        self.acks: Dict[str,List[float]] = {} #Dict (command -> seconds until each call replied)
+        self.failures = collections.Counter() #Commands that raised or replied with an error, per command
+        self.lockWaits: Dict[str,List[float]] = {} #Dict (command -> seconds each call waited for the command lock)
+        self.restTimes: Dict[str,List[float]] = {} #Dict (command -> seconds each call spent in REST calls)
+        self.applied: Dict[str,List[float]] = {} #Dict (command -> seconds until the discord side of each call was applied)
+        self.events: List[asyncio.Task] = []
+
+    def dispatch(self,member,before,after): #Delivers a voice state update to the cog
+        self.events.append(asyncio.create_task(self.cog.on_voice_state_update(member,before,after)))
+
+    async def command(self,guild: SimulatedGuild,user: SimulatedMember,command,*args) -> SimulatedInteraction: #Runs one slash command as user and records how long it took
+        interaction = SimulatedInteraction(guild,user)
+        if guild.slim: #Members given to a command are resolved from the interaction, they are not kept up to date afterwards
+            args = [arg.snapshot() if isinstance(arg,SimulatedMember) else arg for arg in args]
+        timing = metrics.beginCommand(command.name,guild.id) #What interaction_check does for real commands
+        token = currentCommand.set(timing)
+        outcome = "ok"
+        try:
+            await command.callback(self.cog,interaction,*args)
+        except Exception as e:
+            outcome = type(e).__name__
+            self.failures[command.name] += 1
+            print(f"{command.name} raised:",e,file=sys.stderr)
+        finally:
+            currentCommand.reset(token)
+            metrics.endCommand(timing,outcome)
+        self.latency.setdefault(command.name,[]).append(time.perf_counter() - interaction.start)
+        await self.cog.sessions.getSession(guild).applyQueue.join() #The storyteller waits for players to arrive before going on
+        self.applied.setdefault(command.name,[]).append(time.perf_counter() - interaction.start)
+        if outcome == "ok" and interaction.content != None and interaction.content.startswith("Something went"):
+            self.failures[command.name] += 1
+        self.lockWaits.setdefault(command.name,[]).append(timing.lockWait)
+        self.restTimes.setdefault(command.name,[]).append(timing.restTime)
+        if interaction.acked != None:
+            self.acks.setdefault(command.name,[]).append(interaction.acked)
+        return interaction
+
+    async def click(self,guild: SimulatedGuild,user: SimulatedMember,view,players: List[SimulatedMember]): #A player votes, by hand or by pointing at a player
+        interaction = SimulatedInteraction(guild,user)
+        if view.vote.type == VotingType.pointCountdown:
+            await view.setPoint(interaction,self.rng.choice(players).id)
+        else:
+            await view.setHand(interaction,self.rng.random() < 0.6)
+        self.latency.setdefault("vote_click",[]).append(time.perf_counter() - interaction.start)
+        self.acks.setdefault("vote_click",[]).append(interaction.acked)
+
+    async def playGame(self,guild: SimulatedGuild,playerCount: int):
+        cog = self.cog
+        members = guild.members
+        storyteller, players = members[0], members[1:playerCount + 1]
+        for member in [storyteller] + players: #Everyone waits in voice, so they can be moved
+            guild.setVoice(member,guild.lobby)
+
+        await self.command(guild,storyteller,cog.setupRoles)
+        await self.command(guild,storyteller,cog.setStoryTeller,storyteller)
+        for player in players:
+            await self.command(guild,storyteller,cog.addPlayer,player)
+        cog.sessions.getSession(guild).gameState.roleGatedRooms = self.roomAccess == "roles" #Fixed when the channels are set up
+        await self.command(guild,storyteller,cog.setupChannels)
+        session = cog.sessions.getSession(guild)
+        session.gameState.lockCooldown = 0.2 #Public rooms lock within the run instead of seconds later
+        session.gameState.openCooldown = 0.3
+        session.gameState.votingCircledownDelay = 0.05
+        session.gameState.votingCountdownDelay = 0.3
+        await self.command(guild,storyteller,cog.startGame)
+
+        for day in range(self.days):
+            for phase in range(4 if day < self.days - 1 else 3):
+                await self.command(guild,storyteller,cog.nextGamePhase)
+                if session.gameState.dayPhase == 1 and day > 0: #Deaths are announced at dawn
+                    await self.command(guild,storyteller,cog.killPlayer,self.rng.choice(players),None)
+                elif session.gameState.dayPhase == 2: #Players wander into the public rooms and use the doors
+                    rooms = session.gameState.channels.publicRooms
+                    for player in players:
+                        guild.setVoice(player,self.rng.choice(rooms))
+                    await asyncio.sleep(0.3)
+                    player = self.rng.choice(players)
+                    await self.command(guild,player,cog.openPublicRoomCommand)
+                    await self.command(guild,player,cog.lockPublicRoomCommand)
+                elif session.gameState.dayPhase == 3: #Nominations
+                    nominator, nominee = self.rng.sample(players,2)
+                    interaction = await self.command(guild,storyteller,cog.runVote,nominator,nominee,day % len(VotingType)) #A different kind of vote each day
+                    if interaction.view != None:
+                        await asyncio.gather(*[self.click(guild,player,interaction.view,players) for player in players])
+                        await session.voteTask
+        await self.command(guild,storyteller,cog.printGameState)
+        await self.command(guild,storyteller,cog.endGame,None)
+
+    async def run(self) -> dict:
+        games = []
+        for i in range(self.guildCount):
+            playerCount = self.rng.randint(self.minPlayers,self.maxPlayers)
+            guild = SimulatedGuild(self.rest,playerCount + 5,self.gateway == "slim") #A few members who do not play
+            guild.dispatch = self.dispatch
+            self.bot.guilds.append(guild)
+            games.append(self.playGame(guild,playerCount))
+        await self.cog.cog_load() #Registers the metrics gauges, like adding the cog to the bot does
+        start = time.perf_counter()
+        await asyncio.gather(*games)
+        await asyncio.gather(*self.events)
+        for session in self.cog.sessions.sessions.values():
+            session.roomLockScheduler.cancelAll()
+        duration = time.perf_counter() - start
+        await self.cog.cog_unload()
+        return self.getReport(duration)
+
+    def getReport(self,duration: float) -> dict:
+        commands = {}
+        for name, samples in sorted(self.latency.items()):
+            commands[name] = {
+                "calls": len(samples),
+                "failures": self.failures[name],
+                "p50_ms": percentile(samples,50) * 1000,
+                "p95_ms": percentile(samples,95) * 1000,
+                "p99_ms": percentile(samples,99) * 1000,
+                "max_ms": max(samples) * 1000,
+                "ack_p99_ms": percentile(self.acks[name],99) * 1000 if name in self.acks else None,
+                "lock_p99_ms": percentile(self.lockWaits[name],99) * 1000 if name in self.lockWaits else None,
+                "rest_p99_ms": percentile(self.restTimes[name],99) * 1000 if name in self.restTimes else None,
+                "applied_p99_ms": percentile(self.applied[name],99) * 1000 if name in self.applied else None,
+            }
+        return {
+            "guilds": self.guildCount,
+            "room_access": self.roomAccess,
+            "gateway": self.gateway,
+            "duration_s": duration,
+            "commands": commands,
+            "rest_calls": dict(self.rest.calls),
+            "rest_calls_total": sum(self.rest.calls.values()),
+            "rate_limited": dict(self.rest.rateLimited),
+        }
+
+def printReport(report: dict):
+    print(f"{report['guilds']} guilds ({report['room_access']} room access, {report['gateway']} gateway) in {report['duration_s']:.2f}s, {report['rest_calls_total']} REST calls, {sum(report['rate_limited'].values())} rate limited")
+    print(f"{'command':<26}{'calls':>7}{'fails':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'ack p99':>10}{'lock p99':>10}{'rest p99':>10}{'applied p99':>12}")
+    for name, result in report["commands"].items():
+        optional = "".join(f"{result[key]:10.1f}" if result[key] != None else f"{'-':>10}" for key in ["ack_p99_ms","lock_p99_ms","rest_p99_ms"])
+        optional += f"{result['applied_p99_ms']:12.1f}" if result.get("applied_p99_ms") != None else f"{'-':>12}"
+        print(f"{name:<26}{result['calls']:>7}{result['failures']:>7}{result['p50_ms']:10.1f}{result['p95_ms']:10.1f}{result['p99_ms']:10.1f}{result['max_ms']:10.1f}{optional}")
+    print(f"{'route':<26}{'calls':>7}{'429s':>7}")
+    for route, calls in sorted(report["rest_calls"].items()):
+        print(f"{route:<26}{calls:>7}{report['rate_limited'].get(route,0):>7}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays scripted games in simulated guilds and reports command latency and REST calls")
+    parser.add_argument("--guilds",type=int,default=100)
+    parser.add_argument("--min-players",type=int,default=5)
+    parser.add_argument("--max-players",type=int,default=20)
+    parser.add_argument("--days",type=int,default=3)
+    parser.add_argument("--latency",type=float,default=0.02,help="Seconds each REST call takes")
+    parser.add_argument("--jitter",type=float,default=0.01)
+    parser.add_argument("--bucket-limit",type=int,default=5,help="Calls a rate limit bucket allows per window, discord.py waits for the window to reset once they are used")
+    parser.add_argument("--bucket-window",type=float,default=1.0)
+    parser.add_argument("--global-limit",type=int,default=None,help="Calls per second across every guild")
+    parser.add_argument("--error-rate",type=float,default=0.0,help="Chance of a 429 on any call")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--room-access",choices=["overwrites","roles"],default="overwrites",help="How private rooms are opened and closed, see CTB_ROOM_ACCESS")
+    parser.add_argument("--gateway",choices=["full","slim"],default="full",help="Member cache of the simulated guilds, see CTB_GATEWAY")
+    parser.add_argument("--json",help="Also write the report to this file")
+    parser.add_argument("--verbose",action="store_true",help="Show what the bot logs")
+    parser.add_argument("--metrics",help="Also write the bot's metrics, in the Prometheus text format, to this file")
+    args = parser.parse_args()
+
+    rest = SimulatedRest(args.latency,args.jitter,args.bucket_limit,args.bucket_window,args.global_limit,args.error_rate,args.seed)
+    loadTest = LoadTest(rest,args.guilds,args.min_players,args.max_players,args.days,args.seed,args.room_access,args.gateway)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO,format="%(asctime)s %(levelname)-8s %(name)s: %(message)s")
+    else:
+        logging.getLogger("ctb").addHandler(logging.NullHandler()) #Keeps warnings from falling back to stderr
+    report = asyncio.run(loadTest.run())
+    printReport(report)
+    if args.json != None:
+        with open(args.json,"w") as file:
+            json.dump(report,file,indent=2)
+    if args.metrics != None:
+        with open(args.metrics,"w") as file:
+            file.write(metrics.render())
@@ -6,10 +6,14 @@ from discord.ext import commands
 import pytest
 import sys 
 import pytest_asyncio
+import aiohttp
 
 sys.path.append('../ClocktowerBot')
 
-from ClocktowerBot import GameCommands
+import ClocktowerBot
+from ClocktowerBot import ApplyQueue, GameCommands, MissingMember, CharacterData, CommandTreeSync, CharacterLoader, GameJournal, GameState, Metrics, MetricHistogram, RestPriority, RestScheduler, Role, TimedLock, TransitionEngine, TransitionStep, Vote, VotingType, metrics, parseLogLevels
+from LoadTestClocktowerBot import LoadTest, SimulatedChannel, SimulatedRest, SimulatedGuild
+from BenchmarkClocktowerBot import benchmarkGatewayCache, getRegressions
 
 pytest_plugins = ('pytest_asyncio',)
 
@@ -35,4 +39,376 @@ async def test_ping(bot):
     msg = await dpytest.message("/ping")
     print(msg.content)
     print (dpytest.get_message(True) )
-    assert dpytest.verify().message().content("Pong!")
\ No newline at end of file
+    assert dpytest.verify().message().content("Pong!")
+
+def test_character_search():
+    search = CharacterData('characters.xml').search
+    assert [record.name for record in search.search("fort")][0] == "Fortune Teller"
+    assert [record.name for record in search.search("demon")][0] == "Imp" #Matches the character type
+    assert [record.name for record in search.search("poisnr")][0] == "Poisoner" #Fuzzy match of a typo
+    assert len(search.getChoices("")) <= 25
+
+@pytest.mark.asyncio
+async def test_game_journal_replay(tmp_path):
+    journal = GameJournal(str(tmp_path),"guild")
+    journal.snapshotEvery = 3
+    for type, data in [("storytellerSet",{"member": 1}),("playerAdded",{"member": 2}),("playerAdded",{"member": 3}),("gameStarted",{"day": 1,"phase": 0}),("killed",{"member": 3}),("phaseAdvanced",{"day": 1,"phase": 2}),("roomLocked",{"room": 10})]:
+        journal.record(type,**data)
+        if journal.needsSnapshot(): #A session snapshots its GameState, the replay of the journal so far stands in for it
+            await journal.flush()
+            replayed = GameJournal(str(tmp_path),"guild").load()
+            journal.snapshot(replayed)
+    await journal.flush()
+
+    recovered = GameJournal(str(tmp_path),"guild").load()
+    assert recovered["storyteller"] == 1
+    assert [(player["id"],player["isAlive"]) for player in recovered["players"]] == [(2,True),(3,False)]
+    assert (recovered["active"],recovered["gameDay"],recovered["dayPhase"]) == (True,1,2)
+    assert recovered["lockedRooms"] == [10]
+    assert len(open(journal.logPath).readlines()) < 3 #Compacted, replay does not grow with the game
+
+    events = open(journal.logPath).read()
+    with open(journal.logPath,"w") as file: #A crash lost the truncation, events already in the snapshot are still logged
+        file.write('{"seq": 2, "type": "playerAdded", "member": 4}\n' + events)
+    assert GameJournal(str(tmp_path),"guild").load() == recovered #Not applied twice
+
+@pytest.mark.asyncio
+async def test_recover_uncached_roster():
+    loadTest = LoadTest(SimulatedRest(latency=0,jitter=0),guildCount=1)
+    guild = SimulatedGuild(loadTest.rest,4)
+    storyteller, *players = guild.members
+    rooms = [guild.addChannel(SimulatedChannel(guild,f"room{index}",discord.ChannelType.voice)) for index in range(len(players))]
+    state = GameState()
+    state.setStoryTeller(storyteller)
+    for player, room in zip(players,rooms):
+        state.addPlayer(player)
+        state.addPrivateRoom(player,room)
+    snapshot = state.toSnapshot()
+
+    members = dict(guild.memberIndex)
+    guild.memberIndex.clear() #A slim member cache after a restart, no player is cached
+    left = players.pop() #Left the guild while the bot was down
+    async def query_members(user_ids,limit,cache):
+        return [members[id] for id in user_ids if id != left.id]
+    guild.query_members = query_members
+    session = loadTest.cog.sessions.getSession(guild)
+    session.gameState = GameState.fromSnapshot(snapshot,guild)
+    await loadTest.cog.refreshRoster(guild)
+    for player, room in zip(players,rooms):
+        assert session.gameState.getRoomOfPlayer(player) == room
+        assert session.gameState.getPlayer(player).member is player
+    assert session.gameState.storyteller is storyteller
+    missing = session.gameState.playerIndex[left.id].member
+    assert isinstance(missing,MissingMember)
+    guild.memberIndex.update({id: member for id, member in members.items() if id != left.id})
+    assert session.gameState.getPlayersAsMembers(guild) == players #Never moved or given roles
+    assert missing.name in Vote(session.gameState,players[0],players[1],VotingType.circleTally).render() #Still shown in votes
+
+@pytest.mark.asyncio
+async def test_reconcile_stale_roles():
+    loadTest = LoadTest(SimulatedRest(latency=0,jitter=0),guildCount=1)
+    guild = SimulatedGuild(loadTest.rest,2,slim=True) #Nobody in voice, so no member is kept up to date
+    storyteller, player = guild.members
+    await loadTest.command(guild,storyteller,loadTest.cog.setupRoles)
+    await loadTest.command(guild,storyteller,loadTest.cog.addPlayer,player)
+    moderator = await guild.create_role("Moderator")
+    await player.add_roles(moderator) #Given by someone else after the player was added
+    session = loadTest.cog.sessions.getSession(guild)
+    stored = session.gameState.getPlayersAsMembers(guild)
+    assert not (moderator in stored[0].roles) #The member the game holds has not seen it
+
+    plan = await loadTest.cog.reconcilePlayerRoles(guild,stored)
+    assert plan.isSuccess()
+    assert moderator in player.server.roles #Not reverted by the full role list
+    assert loadTest.cog.getRole(guild,Role.night) in player.server.roles
+    assert session.gameState.getPlayersAsMembers(guild)[0].roles == player.server.roles #The edited member is kept
+    edits = loadTest.rest.calls["edit_member"]
+    plan = await loadTest.cog.reconcilePlayerRoles(guild,session.gameState.getPlayersAsMembers(guild))
+    assert loadTest.rest.calls["edit_member"] == edits #Nothing changed, so nothing is sent
+
+@pytest.mark.asyncio
+async def test_simulated_games():
+    def smallGame(rest: SimulatedRest,**options) -> LoadTest: #One game of the fewest players, the full runs are LoadTestClocktowerBot.py's
+        loadTest = LoadTest(rest,guildCount=1,minPlayers=5,maxPlayers=5,days=1,**options)
+        loadTest.cog.scheduler.globalLimit = 1000 #Nothing else shares the bot, its calls need not be spread over seconds
+        return loadTest
+    report = await smallGame(SimulatedRest(latency=0,jitter=0,bucketLimit=1000)).run()
+    assert sum(result["failures"] for result in report["commands"].values()) == 0
+    assert report["commands"]["advance_phase"]["calls"] == 3
+    assert report["rest_calls"]["create_channel"] >= 1 + 4 + 8 + 5 #Category, shared channels, public rooms and a room per player
+
+    gated = await smallGame(SimulatedRest(latency=0,jitter=0,bucketLimit=1000),roomAccess="roles").run()
+    assert sum(result["failures"] for result in gated["commands"].values()) == 0
+    assert gated["rest_calls"]["edit_channel"] < report["rest_calls"]["edit_channel"] #No private room edits at night and dawn
+
+    retried = metrics.rateLimited.get(scope="scheduler")
+    limited = await smallGame(SimulatedRest(latency=0,jitter=0,bucketLimit=1000,errorRate=0.1,bucketWindow=0.01)).run() #Discord answers some calls with 429s
+    assert sum(result["failures"] for result in limited["commands"].values()) == 0
+    assert sum(limited["rate_limited"].values()) > 0
+    assert metrics.rateLimited.get(scope="scheduler") - retried == sum(limited["rate_limited"].values()) #Every 429 was backed off and retried by the scheduler
+    assert "ctb_sessions 1" in metrics.render() #Gauges registered by cog_load
+
+def test_benchmark_regressions():
+    baseline = {"fast": 1e-6,"slow": 1e-3,"new": None}
+    results = {"fast": 1.8e-6,"slow": 2e-3,"added": 5.0}
+    assert getRegressions(results,baseline,0.5) == ["slow"] #Under a microsecond of difference is noise, paths without a baseline pass
+
+def test_circle_vote():
+    members = SimulatedGuild(SimulatedRest(),5).members
+    gameState = GameState()
+    for member in members:
+        gameState.addPlayer(member)
+    gameState.getPlayer(members[3]).setIsAlive(False)
+    vote = Vote(gameState,members[0],members[1],VotingType.circleTally)
+    assert [player.member for player in vote.order] == members[2:] + members[:2] #Clockwise of the nominee, ending on them
+    assert vote.required == 2
+    vote.setHand(members[3],True)
+    vote.setHand(members[4],True)
+    used = []
+    while not vote.isCounted():
+        used += vote.countNext()
+    assert vote.setHand(members[4],False) != None #Counted hands are final
+    assert vote.getVotes() == 2
+    assert [player.member for player in used] == [members[3]]
+    assert not gameState.getPlayer(members[3]).canVote() #Ghost vote is used up
+
+def test_blind_and_point_votes():
+    members = SimulatedGuild(SimulatedRest(),4).members
+    gameState = GameState()
+    for member in members:
+        gameState.addPlayer(member)
+    blind = Vote(gameState,members[0],members[1],VotingType.blindCountdownTally)
+    blind.setHand(members[2],True)
+    assert not (":raised_hand:" in blind.render()) #Hidden until the vote is over
+    blind.countAll()
+    blind.finish()
+    assert blind.getVotes() == 1 and ":white_check_mark:" in blind.render()
+
+    point = Vote(gameState,None,None,VotingType.pointCountdown)
+    for voter, target in [(0,2),(1,2),(2,3),(3,0)]:
+        point.setPoint(members[voter],members[target].id)
+    assert [(player.member,count) for player, count in point.getPointTally()][0] == (members[2],2)
+
+@pytest.mark.asyncio
+async def test_metrics():
+    registry = Metrics()
+    registry.gauge("ctb_test_gauge","Test gauge",lambda: 3)
+    timing = registry.beginCommand("kill_player")
+    timing.lockWait = 0.2
+    registry.endCommand(timing,"ok")
+    registry.observeRest("PUT",'/guilds/{guild_id}/members/"{user_id}"',0.04)
+    text = registry.render()
+    assert "# TYPE ctb_command_seconds histogram" in text
+    assert 'ctb_commands_total{command="kill_player",outcome="ok"} 1' in text
+    assert 'ctb_command_lock_wait_seconds_bucket{command="kill_player",le="0.1"} 0' in text
+    assert 'ctb_command_lock_wait_seconds_bucket{command="kill_player",le="0.25"} 1' in text
+    assert 'ctb_command_lock_wait_seconds_bucket{command="kill_player",le="+Inf"} 1' in text
+    assert 'route="/guilds/{guild_id}/members/\\"{user_id}\\""' in text #Quotes in labels are escaped
+    assert "ctb_test_gauge 3" in text
+
+    histogram = MetricHistogram("test","Test",(1,2))
+    for value in [0.5,1,1.5,5]:
+        histogram.observe(value)
+    assert histogram.render() == ['test_bucket{le="1"} 2','test_bucket{le="2"} 3','test_bucket{le="+Inf"} 4','test_sum 8.0','test_count 4']
+
+    lock = TimedLock("test")
+    await lock.acquire()
+    waiter = asyncio.create_task(lock.acquire())
+    await asyncio.sleep(0.01)
+    lock.release()
+    await waiter
+    lock.release()
+    assert metrics.lockContended.get(lock="test") == 1
+
+@pytest.mark.asyncio
+async def test_rest_scheduler():
+    scheduler = RestScheduler(globalLimit=50,bucketLimit=1,window=0.05,margin=0)
+    order = []
+    async def call(name):
+        order.append(name)
+    await scheduler.call(RestPriority.voice,"town",call,"first") #Fills the bucket for the window
+    waiting = [asyncio.create_task(scheduler.call(priority,"town",call,priority.name)) for priority in [RestPriority.announcement,RestPriority.provisioning,RestPriority.voice]]
+    await asyncio.sleep(0)
+    await scheduler.call(RestPriority.announcement,"other",call,"other") #A full bucket does not hold up other buckets
+    await asyncio.gather(*waiting)
+    assert order == ["first","other","voice","provisioning","announcement"]
+
+    attempts = []
+    async def limited():
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) == 1:
+            raise discord.RateLimited(0.05)
+        return "done"
+    assert await scheduler.call(RestPriority.roles,"members",limited) == "done"
+    assert attempts[1] - attempts[0] >= 0.04 #Retried once the bucket's retry_after passed
+
+    async def alwaysLimited():
+        raise discord.RateLimited(0.01)
+    with pytest.raises(discord.RateLimited): #Not a RuntimeError from re-raising outside the handler
+        await RestScheduler(retries=2,margin=0).call(RestPriority.roles,"members",alwaysLimited)
+    response = type("Response",(),{"status": 429,"reason": "Too Many Requests","headers": {"Retry-After": "0.01"}})()
+    async def alwaysTooMany():
+        raise discord.HTTPException(response,"You are being rate limited")
+    with pytest.raises(discord.HTTPException) as error:
+        await RestScheduler(retries=1,margin=0).call(RestPriority.roles,"members",alwaysTooMany)
+    assert error.value.status == 429
+
+    unlimited = RestScheduler(globalLimit=50,window=10,margin=0) #Buckets are paced by discord.py unless a bucket limit is set
+    start = asyncio.get_running_loop().time()
+    await asyncio.gather(*[unlimited.call(RestPriority.roles,"members",call,index) for index in range(20)])
+    assert asyncio.get_running_loop().time() - start < 1
+
+@pytest.mark.asyncio
+async def test_transition_resume():
+    members = SimulatedGuild(SimulatedRest(),3).members
+    calls = []
+    failing = {members[1].id}
+    def makeStep(name):
+        async def action(member,send):
+            if name == "roles" and member.id in failing:
+                raise Exception("Missing Permissions")
+            calls.append((name,member.id))
+        return TransitionStep(name,lambda member: "bucket",action,RestPriority.roles)
+    engine = TransitionEngine(RestScheduler(margin=0))
+    plan = await engine.run(members,[makeStep("roles"),makeStep("move")])
+    assert not plan.isSuccess()
+    assert plan.status[members[1].id] == {"roles": "Missing Permissions","move": "pending"} #A failed step stops the players later steps
+    assert "2/3 players moved successfully" in plan.summary()
+
+    failing.clear()
+    calls.clear()
+    await engine.resume(plan,members)
+    assert calls == [("roles",members[1].id),("move",members[1].id)] #Only the failed and pending steps run again
+    assert plan.isSuccess() and plan.getCallCount() == 2
+
+    cog = LoadTest(SimulatedRest(),guildCount=1).cog
+    guild = SimulatedGuild(SimulatedRest(),1)
+    assert cog.privateRoomStep(guild,"night").priority == cog.moveStep(guild,None).priority #The move waits on the room, neither queues behind provisioning
+
+@pytest.mark.asyncio
+async def test_apply_queue():
+    loadTest = LoadTest(SimulatedRest(latency=0,jitter=0),guildCount=1)
+    guild = SimulatedGuild(loadTest.rest,3)
+    storyteller = guild.members[0]
+    for command, args in [(loadTest.cog.nextGamePhase,(None,None)),(loadTest.cog.retryPlayerMovement,()),(loadTest.cog.killPlayer,(storyteller,None)),(loadTest.cog.endGame,(None,))]:
+        interaction = await loadTest.command(guild,storyteller,command,*args)
+        assert not loadTest.cog.sessions.getSession(guild).commandLock.locked() #Early returns used to keep the lock
+        assert interaction.content in ("Requires a game to be running","There is no active game to end")
+
+    interaction = await loadTest.command(guild,storyteller,loadTest.cog.runVote,None,None,9)
+    assert interaction.content == "Unknown vote type: 9" #Answered, not left waiting on a ValueError
+
+    queue = ApplyQueue()
+    applied = []
+    async def fail():
+        raise Exception("Missing Permissions")
+    async def apply():
+        applied.append("apply")
+    queue.submit("fail",fail)
+    queue.submit("apply",apply)
+    await queue.join()
+    assert applied == ["apply"] and queue.getPendingCount() == 0 #A failing job does not stop the ones after it
+
+async def setUpSimulatedGame(loadTest: LoadTest,guild: SimulatedGuild): #Roles, storyteller, players and channels, everyone but the storyteller plays
+    storyteller, *players = guild.members
+    await loadTest.command(guild,storyteller,loadTest.cog.setupRoles)
+    await loadTest.command(guild,storyteller,loadTest.cog.setStoryTeller,storyteller)
+    for player in players:
+        await loadTest.command(guild,storyteller,loadTest.cog.addPlayer,player)
+    await loadTest.command(guild,storyteller,loadTest.cog.setupChannels)
+
+async def refuse(**fields):
+    raise Exception("Missing Permissions")
+
+@pytest.mark.asyncio
+async def test_start_game_retry():
+    loadTest = LoadTest(SimulatedRest(latency=0,jitter=0),guildCount=1)
+    guild = SimulatedGuild(loadTest.rest,4)
+    storyteller, *players = guild.members
+    for member in guild.members:
+        guild.setVoice(member,guild.lobby)
+    await setUpSimulatedGame(loadTest,guild)
+    players[0].edit = refuse #Its role edit fails, so it is not moved either
+    await loadTest.command(guild,storyteller,loadTest.cog.startGame)
+    session = loadTest.cog.sessions.getSession(guild)
+    assert list(session.transitionPlan.getFailures().values()) == [[("roles","Missing Permissions")]]
+
+    del players[0].edit
+    await loadTest.command(guild,storyteller,loadTest.cog.retryPlayerMovement)
+    assert session.transitionPlan.isSuccess() #The role edit is redone with the move, not only the move
+    assert loadTest.cog.getRole(guild,Role.night) in players[0].roles
+    assert players[0].voice.channel == session.gameState.getRoomOfPlayer(players[0])
+
+@pytest.mark.asyncio
+async def test_resume_stale_member():
+    loadTest = LoadTest(SimulatedRest(latency=0,jitter=0),guildCount=1)
+    guild = SimulatedGuild(loadTest.rest,3,slim=True) #Nobody in voice, so the game only holds stale members
+    storyteller, *players = guild.members
+    await setUpSimulatedGame(loadTest,guild)
+    players[0].edit = refuse
+    await loadTest.command(guild,storyteller,loadTest.cog.startGame)
+    session = loadTest.cog.sessions.getSession(guild)
+    assert not session.transitionPlan.isSuccess()
+
+    del players[0].edit
+    await players[0].server.edit(roles=players[1].server.roles) #Someone else gave the night roles meanwhile
+    edits = loadTest.rest.calls["edit_member"]
+    await loadTest.command(guild,storyteller,loadTest.cog.retryPlayerMovement)
+    assert session.transitionPlan.isSuccess()
+    assert loadTest.rest.calls["edit_member"] == edits #Seen as done from discord's state, not from the stale member
+    assert session.transitionPlan.status[players[0].id]["roles"] == "skipped"
+
+def test_gateway_modes():
+    full = benchmarkGatewayCache(1000,"full",voiceCount=20)
+    slim = benchmarkGatewayCache(1000,"slim",voiceCount=20)
+    assert full["cached"] == 1000
+    assert slim["cached"] == 20 #Only members in voice
+    assert slim["intents"] == (discord.Intents.guilds.flag | discord.Intents.members.flag | discord.Intents.voice_states.flag)
+
+@pytest.mark.asyncio
+async def test_command_tree_sync(bot,tmp_path):
+    synced = []
+    async def sync(guild=None):
+        synced.append(guild)
+        return []
+    bot.tree.sync = sync
+    path = str(tmp_path / "commands.json")
+    assert await CommandTreeSync(bot.tree,path).sync(1) == 1
+    assert await CommandTreeSync(bot.tree,path).sync(1) == 0 #Unchanged, even after a restart
+    assert await CommandTreeSync(bot.tree,path).sync(1,force=True) == 1
+
+    @bot.tree.command(name="new_command")
+    async def newCommand(interaction: discord.Interaction):
+        pass
+    assert await CommandTreeSync(bot.tree,path).sync(1) == 1
+    assert await CommandTreeSync(bot.tree,path).sync(1,[42]) == 2 #Each guild is its own scope, and the global commands are removed
+    assert bot.tree.get_commands() == [] and len(bot.tree.get_commands(guild=discord.Object(id=42))) > 0 #Listed once, by the guild
+    assert [guild.id if guild != None else None for guild in synced] == [None,None,None,42,None]
+
+@pytest.mark.asyncio
+async def test_metrics_gauges(bot):
+    cog = bot.get_cog("GameCommands")
+    session = cog.sessions.getSession(bot.guilds[0]) #Gauges read every session, so one must exist
+    session.roomLockScheduler.schedule(discord.Object(id=1),60) #Only the id of the room is used until it is due
+    text = metrics.render()
+    assert "ctb_sessions 1" in text
+    assert "ctb_pending_room_locks 1" in text
+    assert "ctb_pending_applies 0" in text
+    session.roomLockScheduler.cancelAll()
+
+@pytest.mark.asyncio
+async def test_metrics_server(monkeypatch):
+    monkeypatch.setattr(ClocktowerBot,"METRICS_PORT",19477)
+    bot = commands.Bot(intents=discord.Intents.none(),command_prefix="!")
+    await bot.add_cog(GameCommands(bot)) #Started on the running loop, like main() does
+    try:
+        async with aiohttp.ClientSession() as http:
+            async with http.get("http://127.0.0.1:19477/metrics") as response:
+                assert response.status == 200
+                assert "ctb_sessions 0" in await response.text()
+    finally:
+        await bot.remove_cog("GameCommands")
+
+def test_log_levels(caplog):
+    assert parseLogLevels("ctb=debug, discord.gateway=WARNING,rest=verbose,ctb.votes") == {"ctb": 10,"discord.gateway": 30} #Typos are skipped, the bot still starts
+    assert len([record for record in caplog.records if "CTB_LOG_LEVELS" in record.getMessage()]) == 2